@@ -0,0 +1,277 @@
+""" Benchmarks of skrm on synthetic bdd files.
+
+usage: python -m benchmarks.bench_skrm [--sizes=1000,10000,100000] [--gpg=fake|real|envelope|both] [--output=FILE]
+                                       [--repeat=3] [--compare=BASELINE] [--tolerance=0.25]
+
+Results are written as JSON, along with the memory held by a parsed bdd of each size, and compared against a previous result file with --compare: the command exits
+with status 1 if any benchmark got slower than the baseline by more than the tolerance.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import getopt
+import platform
+import tempfile
+import subprocess
+import contextlib
+import tracemalloc
+
+from skrm import bdd_format
+from skrm import keyring_store
+from skrm import output
+from skrm import parallel_search
+from skrm.version import __version__
+from skrm.tag_index import TagIndex, tags_matcher
+from skrm.search_engine import SearchEngine, patterns_matcher
+from skrm.fuzzy_search import FuzzySearch
+from skrm.keyring_manager import KeyringManager
+
+
+COMMON_TAGS = ["Password", "WebSite", "Login", "Email", "Pin", "Bank", "Server", "Database", "prod", "staging", "dev"]
+RECIPIENT = "skrm benchmark"
+
+
+def generate_bdd(size, seed=0):
+    """ Return a synthetic bdd of the given size, with 2 to 9 tags per keyring and keys of 8 to 256 bytes """
+    rnd = random.Random(seed)
+    bdd = []
+    for i in range(size):
+        tags = rnd.sample(COMMON_TAGS, rnd.randint(0, 3))
+        tags += ["site%d" % rnd.randint(0, size // 4 + 1) for _ in range(rnd.randint(1, 5))]
+        tags.append("user%d" % i)
+        key = "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rnd.randint(8, 256)))
+        bdd.append([tag.encode("utf8") for tag in tags] + [key.encode("utf8")])
+    return bdd
+
+
+def timed(function, repeat):
+    """ Return the best wall time of repeat calls to function """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class FakeGpgKeyringManager(KeyringManager):
+    """ KeyringManager storing the bdd in clear instead of running gpg """
+    def load_raw_bdd(self, filename=None):
+        with open(filename or self.filename, "rb") as f:
+            return f.read()
+
+    def _save_raw_bdd(self, raw, filename=None):
+        with open(filename or self.filename, "wb") as f:
+            f.write(raw)
+
+
+@contextlib.contextmanager
+def silenced():
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+@contextlib.contextmanager
+def ephemeral_gpg_home():
+    """ Create a temporary gpg home directory holding a key without passphrase for RECIPIENT """
+    home = tempfile.mkdtemp()
+    os.chmod(home, 0o700)
+    old_home = os.environ.get("GNUPGHOME")
+    os.environ["GNUPGHOME"] = home
+    try:
+        subprocess.check_call(["gpg", "--batch", "--passphrase", "", "--quick-gen-key", RECIPIENT, "default", "default", "never"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        yield home
+    finally:
+        if old_home is None:
+            del os.environ["GNUPGHOME"]
+        else:
+            os.environ["GNUPGHOME"] = old_home
+        subprocess.call(["gpgconf", "--homedir", home, "--kill", "all"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def bench_in_memory(size, repeat):
+    """ Benchmark parsing, serializing, matching and output of a bdd of the given size """
+    results = {}
+    bdd = generate_bdd(size)
+    manager = KeyringManager("", "", [])
+    raw_v1 = bdd_format.serialize_v1(bdd)
+    raw_v2 = bdd_format.serialize_v2(bdd)
+    tags = ["password", "site%d" % (size // 8)]
+    patterns = ["pass", "site%d$" % (size // 8)]
+
+    results["parse_raw_v1"] = timed(lambda: manager.parse_raw(raw_v1), repeat)
+    results["parse_raw_v2"] = timed(lambda: manager.parse_raw(raw_v2), repeat)
+    manager.bdd_version = bdd_format.VERSION_1
+    results["parse_bdd_v1"] = timed(lambda: manager.parse_bdd(bdd), repeat)
+    manager.bdd_version = bdd_format.VERSION_2
+    results["parse_bdd_v2"] = timed(lambda: manager.parse_bdd(bdd), repeat)
+
+    # a lookup without an index, the way Vault.scan matches the keyrings of a streamed bdd
+    get_matcher = tags_matcher(tags)
+    results["get_scan"] = timed(lambda: [keyring for keyring in bdd if get_matcher(keyring)], repeat)
+    results["tag_index_build"] = timed(lambda: TagIndex(bdd), repeat)
+    index = TagIndex(bdd)
+    results["tag_index_get"] = timed(lambda: index.get(tags), repeat)
+    search_matcher = patterns_matcher(patterns)
+    results["search_scan"] = timed(lambda: [keyring for keyring in bdd if search_matcher(keyring)], repeat)
+    engine = SearchEngine(index)
+    results["search_engine"] = timed(lambda: engine.search(patterns), repeat)
+    # a search of a closed bdd: parsed and indexed, or matched on the decrypted buffer by every cpu
+    results["search_parsed_indexed"] = timed(lambda: SearchEngine(TagIndex(manager.parse_raw(raw_v2))).search(patterns),
+                                             repeat)
+    results["search_parallel"] = timed(lambda: parallel_search.search(raw_v2, patterns, os.cpu_count() or 1), repeat)
+    results["fuzzy_index_build"] = timed(lambda: FuzzySearch(index), repeat)
+    fuzzy = FuzzySearch(index)
+    results["fuzzy_search"] = timed(lambda: fuzzy.top(["pasword", "sitte%d" % (size // 8)]), repeat)
+
+    manager.tags = ["password"]
+    matches = manager.index_matches(bdd, index.get)
+    with silenced():
+        results["print_matches"] = timed(lambda: manager.print_matches(matches), repeat)
+    for output_format in [output.JSON, output.TSV, output.NULL]:
+        results["write_matches_" + output_format] = timed(lambda: _write_matches(matches, output_format), repeat)
+    return results
+
+
+def _write_matches(matches, output_format):
+    writer = output.OutputWriter(io.BytesIO(), output_format)
+    for i, keyring in matches:
+        writer.write(i, keyring)
+    writer.flush()
+
+
+def traced_size(function):
+    """ Return the result of function and the number of bytes it allocated and still holds """
+    tracemalloc.start()
+    try:
+        result = function()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def measure_memory(size):
+    """ Return the bytes held by a parsed bdd of the given size, as a list of lists and as a KeyringStore.
+    The store keeps the decrypted buffer its keys are sliced from, it is counted with it. """
+    raw = bdd_format.serialize_v2(generate_bdd(size))
+    bdd, lists_size = traced_size(lambda: bdd_format.parse(raw))
+    del bdd
+    store, store_size = traced_size(lambda: keyring_store.parse(raw))
+    return {"bdd_lists": lists_size, "keyring_store": store_size + len(raw)}
+
+
+def bench_run(size, repeat, manager_class, recipient="", encryption="gpg"):
+    """ Benchmark the full run() path of a get and an add on a bdd file of the given size """
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "bdd.gpg")
+        prefs = os.path.join(tmp_dir, "user.prefs")
+        with open(prefs, "w") as f:
+            f.write("encryption=" + encryption + "\n")
+        setup = manager_class(prefs, filename, ["--recipient=" + recipient])
+        args = ["--recipient=" + recipient, "--no-agent"]
+        with silenced():
+            setup.save_bdd(generate_bdd(size))
+            results["run_get"] = timed(lambda: manager_class(prefs, filename, args + ["password", "site1"]).run(), repeat)
+            results["run_add"] = timed(lambda: manager_class(prefs, filename, args + ["--add=key", "bench"]).run(), repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def run_benchmarks(sizes, gpg_modes, repeat=3, real_gpg_max_size=100000):
+    report = {"skrm_version": __version__,
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "results": [],
+              "memory": []}
+
+    def add(mode, size, results):
+        for name, seconds in sorted(results.items()):
+            report["results"].append({"name": name, "gpg": mode, "size": size, "seconds": seconds})
+
+    for size in sizes:
+        add("none", size, bench_in_memory(size, repeat))
+        for name, size_bytes in sorted(measure_memory(size).items()):
+            report["memory"].append({"name": name, "size": size, "bytes": size_bytes})
+        if "fake" in gpg_modes:
+            add("fake", size, bench_run(size, repeat, FakeGpgKeyringManager))
+    if "real" in gpg_modes or "envelope" in gpg_modes:
+        with ephemeral_gpg_home():
+            for size in sizes:
+                if size > real_gpg_max_size:
+                    continue
+                if "real" in gpg_modes:
+                    add("real", size, bench_run(size, repeat, KeyringManager, RECIPIENT))
+                if "envelope" in gpg_modes:
+                    add("envelope", size, bench_run(size, repeat, KeyringManager, RECIPIENT, "envelope"))
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """ Return the list of benchmarks slower than in the baseline by more than the tolerance """
+    previous = dict(((r["name"], r["gpg"], r["size"]), r["seconds"]) for r in baseline["results"])
+    regressions = []
+    for result in report["results"]:
+        before = previous.get((result["name"], result["gpg"], result["size"]))
+        if before and result["seconds"] > before * (1 + tolerance):
+            regressions.append(dict(result, baseline=before))
+    return regressions
+
+
+def main(argv):
+    sizes = [1000, 10000, 100000]
+    gpg_modes = ["fake", "real"]
+    output = None
+    baseline = None
+    tolerance = 0.25
+    repeat = 3
+    opts, args = getopt.getopt(argv, "", ["sizes=", "gpg=", "output=", "compare=", "tolerance=", "repeat="])
+    for opt, arg in opts:
+        if opt == "--sizes":
+            sizes = [int(size) for size in arg.split(",")]
+        elif opt == "--gpg":
+            gpg_modes = ["fake", "real"] if arg == "both" else arg.split(",")
+        elif opt == "--output":
+            output = arg
+        elif opt == "--compare":
+            baseline = arg
+        elif opt == "--tolerance":
+            tolerance = float(arg)
+        elif opt == "--repeat":
+            repeat = int(arg)
+
+    report = run_benchmarks(sizes, gpg_modes, repeat)
+    content = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(content)
+    else:
+        print(content)
+
+    if baseline:
+        with open(baseline, "r") as f:
+            regressions = compare(report, json.load(f), tolerance)
+        for regression in regressions:
+            sys.stderr.write("Regression: %(name)s (gpg %(gpg)s, %(size)d keyrings): %(seconds).6fs, was %(baseline).6fs\n"
+                             % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
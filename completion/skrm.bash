@@ -0,0 +1,19 @@
+# bash completion of skrm tags, source it from ~/.bashrc:
+#   source /path/to/skrm/completion/skrm.bash
+
+_skrm()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    if [[ "$cur" == -* ]]; then
+        return
+    fi
+    local tags=()
+    local word
+    for word in "${COMP_WORDS[@]:1:COMP_CWORD-1}"; do
+        [[ "$word" == -* ]] || tags+=("$word")
+    done
+    local IFS=$'\n'
+    COMPREPLY=($(skrm --complete="$cur" -- "${tags[@]}" 2>/dev/null))
+}
+
+complete -F _skrm skrm
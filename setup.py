@@ -31,9 +31,12 @@ setuptools.setup(
         "Topic :: Security :: Cryptography"
     ],
     packages=setuptools.find_packages(include=["skrm", "skrm.*"]),
+    extras_require={
+        "envelope": ["cryptography"],
+        },
     entry_points={
         'console_scripts': [
-            'skrm = skrm.__main__:keyring_manager.run'
+            'skrm = skrm.__main__:main'
             ],
         },
     test_suite="tests"
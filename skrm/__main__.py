@@ -1,10 +1,15 @@
-
 import sys
 import os
 
-from .keyring_manager import KeyringManager
+
+def main(argv=None):
+    """ Run the command line, importing only what the command needs """
+    from .keyring_manager import KeyringManager
+    keyring_manager = KeyringManager(os.path.expanduser("~/.skrm/user.prefs"),
+                                     os.path.expanduser("~/.skrm/bdd.gpg"),
+                                     sys.argv[1:] if argv is None else argv)
+    keyring_manager.run()
 
 
-keyring_manager = KeyringManager(os.path.expanduser("~/.skrm/user.prefs"),
-                                 os.path.expanduser("~/.skrm/bdd.gpg"),
-                                 sys.argv[1:])
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import socket
+import select
+import hashlib
+
+from . import bdd_format
+from . import changelog
+from . import shards
+from .tag_index import TagIndex
+from .search_engine import SearchEngine
+from .fuzzy_search import FuzzySearch
+
+CLIENT_TIMEOUT = 5.0 # seconds a client has to send its request and read the response
+
+
+def _files_digest(filenames):
+    h = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message).encode("utf8") + b"\n")
+
+
+def _receive(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        return None
+    return json.loads(data.decode("utf8"))
+
+
+def query(socket_path, request, timeout=5.0):
+    """ Send a request to the agent listening on socket_path.
+    Return the list of (keyId, keyring) matches, or None if no agent answered. """
+    if not os.path.exists(socket_path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(socket_path)
+        _send(conn, request)
+        response = _receive(conn)
+    except (OSError, ValueError):
+        return None
+    finally:
+        conn.close()
+    if not response or "matches" not in response:
+        return None
+    return [(i, bdd_format.keyring_from_text(keyring)) for i, keyring in response["matches"]]
+
+
+class CachedBdd:
+    """ A parsed bdd with its tag index and search engine kept in memory along with what identifies the file content it comes from """
+    def __init__(self, filename, loader):
+        self.filename = filename
+        self.loader = loader
+        self.signature = None
+        self.digest = None
+        self.bdd = None
+        self.index = None
+        self.search_engine = None
+        self._fuzzy_search = None
+
+    def _files(self):
+        if shards.is_sharded(self.filename):
+            return shards.list_files(self.filename)
+        return [self.filename] + changelog.list_segments(self.filename)
+
+    def _stat_signature(self, files):
+        signature = []
+        for filename in files:
+            st = os.stat(filename)
+            signature.append((filename, st.st_mtime_ns, st.st_size))
+        return signature
+
+    def fuzzy_search(self):
+        """ Return the fuzzy search of the bdd, its trigram index is only built for the first fuzzy request """
+        if self._fuzzy_search is None:
+            self._fuzzy_search = FuzzySearch(self.index)
+        return self._fuzzy_search
+
+    def refresh(self):
+        """ Reload the bdd if the file changed since it was loaded """
+        files = self._files()
+        signature = self._stat_signature(files)
+        if signature != self.signature:
+            digest = _files_digest(files)
+            if digest != self.digest:
+                self.bdd = self.loader(self.filename)
+                self.index = TagIndex(self.bdd)
+                self.search_engine = SearchEngine(self.index)
+                self._fuzzy_search = None
+                self.digest = digest
+            self.signature = signature
+        return self
+
+
+class Agent:
+    """ Resident process serving get, search and fuzzy requests from an in-memory bdd over a user-only unix socket.
+    The agent exits, dropping every decrypted bdd, once it has been idle for ttl seconds. """
+    def __init__(self, socket_path, ttl, loader, matcher):
+        self.socket_path = socket_path
+        self.ttl = ttl
+        self.loader = loader
+        self.matcher = matcher
+        self.cache = {}
+        self.running = False
+        self.client_timeout = CLIENT_TIMEOUT
+
+    def _bind(self):
+        directory = os.path.dirname(self.socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(self.socket_path):
+            if query(self.socket_path, {"command": "ping"}, timeout=1.0) is not None:
+                print("An agent is already running on " + self.socket_path)
+                sys.exit(1)
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(8)
+        return server
+
+    def _is_same_user(self, conn):
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+        import struct
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        return uid == os.getuid()
+
+    def handle(self, request):
+        command = request.get("command")
+        if command == "ping":
+            return {"matches": []}
+        if command == "stop":
+            self.running = False
+            return {"matches": []}
+        if command not in ("get", "search", "fuzzy"):
+            return {"error": "Unknown command: " + str(command)}
+        filename = request["file"]
+        if filename not in self.cache:
+            self.cache[filename] = CachedBdd(filename, self.loader)
+        matches = self.matcher(self.cache[filename].refresh(), request)
+        return {"matches": [(i, bdd_format.keyring_to_text(keyring)) for i, keyring in matches]}
+
+    def serve(self):
+        server = self._bind()
+        print("Agent listening on " + self.socket_path)
+        self.running = True
+        last_activity = time.time()
+        try:
+            while self.running:
+                remaining = self.ttl - (time.time() - last_activity)
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([server], [], [], remaining)
+                if not readable:
+                    continue
+                conn, _ = server.accept()
+                conn.settimeout(self.client_timeout) # a silent client must not block the agent
+                last_activity = time.time()
+                try:
+                    if not self._is_same_user(conn):
+                        continue
+                    request = _receive(conn)
+                    if request is None:
+                        continue
+                    try:
+                        response = self.handle(request)
+                    except Exception as e:
+                        response = {"error": str(e)}
+                    _send(conn, response)
+                except (OSError, ValueError):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            self.cache.clear()
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        print("Agent stopped")
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .locking import FileLock, fcntl # no background backups without file locks, backups are run synchronously
+
+
+# Backups handed off by save_bdd are uploaded by a detached worker process, so that commands return
+# as soon as the local bdd file is written. Requests are recorded in a state file next to the bdd file,
+# the worker waits for the debounce window to elapse without new request, then uploads the latest file once.
+# The state file also records the last successful backup and the last error, reported by --backup-status.
+#
+# A backup location may list several destinations separated by commas, uploaded concurrently. Destinations
+# of the form host:path are copied with scp, others are local paths. A manifest next to the bdd file records
+# the digest of the last file pushed to each destination, so that unchanged destinations are skipped.
+
+
+def scp(src, dst):
+    """ Copy src to dst with scp, raising IOError if it fails """
+    args = ["scp", src, dst]
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    stdout, stderr = p.communicate(None)
+    stderr = stderr.decode("utf8", "replace").rstrip()
+    if p.returncode != 0:
+        raise IOError(stderr or "scp exited with status " + str(p.returncode))
+    if stderr: # ssh warnings, like a host key added to known_hosts, don't fail the copy
+        sys.stderr.write("scp: " + stderr + "\n")
+
+
+def parse_locations(value):
+    """ Return the list of destinations of a comma separated backup location """
+    if not value:
+        return []
+    return [location.strip() for location in value.split(",") if location.strip()]
+
+
+def is_remote(location):
+    """ Return True for scp locations like host:path or user@host:path """
+    head, sep, tail = location.partition(":")
+    return bool(sep) and "/" not in head and not (len(head) == 1 and head.isalpha()) # C:\ drive letters are local
+
+
+def transfer(src, dst):
+    """ Copy src to dst, with scp if either is a remote location, atomically replacing local destinations """
+    if is_remote(src) or is_remote(dst):
+        scp(src, dst)
+        return
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)))
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def state_path(filename):
+    return filename + ".backup.json"
+
+
+def manifest_path(filename):
+    return filename + ".backup-manifest.json"
+
+
+def _worker_lock_path(filename):
+    return filename + ".backup.lock"
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_json(path, value):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+
+def read_state(filename):
+    return _read_json(state_path(filename))
+
+
+def update_state(filename, **values):
+    """ Update the backup state of the bdd file, under a lock so that concurrent commands don't lose updates """
+    path = state_path(filename)
+    with FileLock(path + ".lock"):
+        state = read_state(filename)
+        state.update(values)
+        _write_json(path, state)
+    return state
+
+
+def push(filename, src, destinations, upload=transfer, max_workers=8):
+    """ Upload src, a snapshot of the bdd file, to every destination whose last pushed digest differs, concurrently.
+    Return a dict giving for each destination "skipped", "uploaded" or the error raised by the upload. """
+    digest = file_digest(src)
+    path = manifest_path(filename)
+    with FileLock(path + ".lock"):
+        manifest = _read_json(path)
+    results = {}
+    pending = []
+    for destination in destinations:
+        if manifest.get(destination) == digest and (is_remote(destination) or os.path.exists(destination)):
+            results[destination] = "skipped"
+        else:
+            pending.append(destination)
+
+    def upload_one(destination):
+        try:
+            upload(src, destination)
+        except (IOError, OSError) as e:
+            return e
+        return "uploaded"
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            for destination, result in zip(pending, executor.map(upload_one, pending)):
+                results[destination] = result
+    with FileLock(path + ".lock"):
+        manifest = _read_json(path)
+        for destination, result in results.items():
+            if result == "uploaded":
+                manifest[destination] = digest
+        _write_json(path, manifest)
+    return results
+
+
+def is_worker_running(filename):
+    lock = FileLock(_worker_lock_path(filename), blocking=False)
+    if lock.acquire():
+        lock.release()
+        return False
+    return True
+
+
+def request_backup(filename, destination, debounce, retries):
+    """ Record a backup request and start a detached worker if none is running """
+    update_state(filename, requested=time.time(), destination=destination)
+    if is_worker_running(filename):
+        return
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = package_dir + os.pathsep + env.get("PYTHONPATH", "")
+    with open(os.devnull, "r+b") as devnull:
+        subprocess.Popen([sys.executable, "-m", "skrm.backup", os.path.abspath(filename), str(debounce), str(retries)],
+                         stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, start_new_session=True, env=env)
+
+
+def _pending(state):
+    return state.get("requested") is not None and state.get("requested") != state.get("handled")
+
+
+def _upload_latest(filename, state, debounce, retries, upload, backoff):
+    """ Wait for the debounce window, then upload a snapshot of the bdd file, retrying with an exponential backoff """
+    requested = state["requested"]
+    remaining = requested + debounce - time.time()
+    if remaining > 0:
+        time.sleep(remaining)
+        if read_state(filename).get("requested") != requested:
+            return # a newer request came in, wait for its own debounce window
+    destination = state["destination"]
+    fd, snapshot = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
+    try:
+        shutil.copyfile(filename, snapshot)
+        digest = file_digest(snapshot)
+        destinations = parse_locations(destination)
+        for attempt in range(retries + 1):
+            results = push(filename, snapshot, destinations, upload)
+            failed = [d for d in destinations if isinstance(results[d], Exception)]
+            if not failed:
+                update_state(filename, handled=requested,
+                             last_success={"time": time.time(), "destination": destination, "sha256": digest})
+                return
+            update_state(filename, last_error={"time": time.time(), "destination": ", ".join(failed),
+                                               "attempt": attempt + 1,
+                                               "error": "; ".join(str(results[d]) for d in failed)})
+            destinations = failed
+            if attempt < retries:
+                time.sleep(min(backoff * 2 ** attempt, 300))
+        update_state(filename, handled=requested)
+    finally:
+        os.remove(snapshot)
+
+
+def run_worker(filename, debounce, retries, upload=transfer, backoff=1.0):
+    """ Upload pending backups of the bdd file until no request is left """
+    lock = FileLock(_worker_lock_path(filename), blocking=False)
+    while True:
+        if not lock.acquire():
+            return # another worker handles the requests
+        try:
+            state = read_state(filename)
+            while _pending(state):
+                _upload_latest(filename, state, debounce, retries, upload, backoff)
+                state = read_state(filename)
+        finally:
+            lock.release()
+        # a request recorded while the lock was being released would otherwise be left to no worker
+        if not _pending(read_state(filename)):
+            return
+
+
+def format_status(filename):
+    state = read_state(filename)
+    if not state:
+        return "No backup recorded for " + filename
+    lines = []
+    success = state.get("last_success")
+    if success:
+        lines.append("Last backup: " + time.ctime(success["time"]) + " to " + success["destination"] +
+                     " (sha256 " + success["sha256"] + ")")
+    else:
+        lines.append("Last backup: never")
+    if _pending(state):
+        lines.append("Pending backup requested " + time.ctime(state["requested"]) +
+                     (", worker running" if fcntl and is_worker_running(filename) else ", no worker running"))
+    error = state.get("last_error")
+    if error and (not success or error["time"] > success["time"]):
+        lines.append("Last error: " + time.ctime(error["time"]) + " to " + error["destination"] +
+                     " (attempt " + str(error["attempt"]) + "): " + error["error"])
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    run_worker(sys.argv[1], float(sys.argv[2]), int(sys.argv[3]))
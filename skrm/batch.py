@@ -0,0 +1,98 @@
+import json
+import shlex
+
+from . import bdd_format
+from .vault import SkrmError
+
+
+# A batch is a stream of operations, one per line, either as a JSON object:
+#   {"op": "get", "tags": ["tag1", "tag2"]}
+#   {"op": "search", "tags": ["pattern"]}
+#   {"op": "add", "key": "KEY", "tags": ["tag1", "tag2"]}
+#   {"op": "update", "id": 1, "key": "KEY"}
+#   {"op": "remove", "id": 1}
+# or as shell-like words:
+#   get tag1 tag2
+#   search pattern
+#   add KEY tag1 tag2
+#   update 1 KEY
+#   remove 1
+# Empty lines and lines starting with '#' are ignored.
+
+
+def parse_line(line):
+    """ Return the operation described by a batch line as a dict, or None for empty lines and comments """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        operation = json.loads(line)
+        if not isinstance(operation, dict) or "op" not in operation:
+            raise ValueError("JSON operations must be objects with an \"op\" field.")
+        return operation
+    words = shlex.split(line)
+    op = words[0]
+    if op in ("get", "search"):
+        return {"op": op, "tags": words[1:]}
+    if op == "add" and len(words) >= 2:
+        return {"op": op, "key": words[1], "tags": words[2:]}
+    if op == "update" and len(words) == 3:
+        return {"op": op, "id": words[1], "key": words[2]}
+    if op == "remove" and len(words) == 2:
+        return {"op": op, "id": words[1]}
+    raise ValueError("Invalid operation: " + line)
+
+
+class BatchRunner:
+    """ Run the operations of a batch against a single decrypted vault.
+    Mutations are kept pending in the vault, to be committed once all the operations have run. """
+    def __init__(self, vault, output):
+        self.vault = vault
+        self.output = output
+
+    def _keyring_id(self, operation):
+        keyId = operation.get("id")
+        if isinstance(keyId, str) and keyId.isdigit():
+            keyId = int(keyId)
+        return keyId
+
+    def _matches(self, matches):
+        return [{"id": i, "keyring": bdd_format.keyring_to_text(keyring)} for i, keyring in matches]
+
+    def execute(self, operation):
+        """ Run one operation and return its result """
+        op = operation["op"]
+        tags = operation.get("tags", [])
+        if op == "get":
+            return {"matches": self._matches(self.vault.get(tags))}
+        if op == "search":
+            return {"matches": self._matches(self.vault.search(tags))}
+        if op == "add":
+            return {"id": self.vault.add(list(tags), operation["key"])}
+        if op == "update":
+            keyId = self._keyring_id(operation)
+            self.vault.update(keyId, operation["key"])
+            return {"id": keyId}
+        if op == "remove":
+            keyId = self._keyring_id(operation)
+            self.vault.remove(keyId)
+            return {"id": keyId}
+        raise ValueError("Unknown operation: " + str(op))
+
+    def run(self, stream):
+        """ Run every operation of the stream, writing one JSON line per operation as soon as it completes.
+        Return the number of failed operations. """
+        errors = 0
+        for line_number, line in enumerate(stream, 1):
+            try:
+                operation = parse_line(line)
+                if operation is None:
+                    continue
+                result = {"line": line_number, "op": operation["op"]}
+                result.update(self.execute(operation))
+            except (SkrmError, ValueError, KeyError, TypeError) as e:
+                errors += 1
+                result = {"line": line_number, "error": str(e)}
+            self.output.write(json.dumps(result) + "\n")
+            self.output.flush()
+        return errors
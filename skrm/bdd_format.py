@@ -0,0 +1,258 @@
+import struct
+
+
+VERSION_1 = 1
+VERSION_2 = 2
+VERSION_3 = 3
+
+# v1: tags and key separated by \x02, keyrings separated by \x03.
+KEYRING_SEPARATOR = b"\x03"
+TAG_SEPARATOR = b"\x02"
+
+# v2: header, offset table giving the position of each record relative to the first one, records.
+# A record is its number of fields followed by each field prefixed by its length.
+# v3: the v2 layout, the key of each record being sealed on its own by the envelope encryption (see crypto.py).
+RECORD_VERSIONS = (VERSION_2, VERSION_3)
+MAGIC = b"\x00SKRM"
+_HEADER = struct.Struct("<5sBI")
+_OFFSET = struct.Struct("<Q")
+_UINT = struct.Struct("<I")
+
+
+def _to_bytes(field):
+    if isinstance(field, str):
+        return field.encode("utf8")
+    return field
+
+
+def keyring_to_text(keyring):
+    """ Decode the fields of a keyring into str, keeping invalid utf8 bytes so that keyring_from_text restores them """
+    return [field.decode("utf8", "surrogateescape") if isinstance(field, bytes) else field for field in keyring]
+
+
+def keyring_from_text(keyring):
+    return [field.encode("utf8", "surrogateescape") for field in keyring]
+
+
+def detect_version(raw):
+    """ Return the format version of a decrypted bdd, or None if it is empty """
+    if not raw:
+        return None
+    if raw[:len(MAGIC)] == MAGIC:
+        return raw[len(MAGIC)] if len(raw) > len(MAGIC) and raw[len(MAGIC)] in RECORD_VERSIONS else VERSION_2
+    return VERSION_1
+
+
+def needs_v2(bdd):
+    """ Return True if a field contains one of the v1 separators and can only be stored with v2 """
+    for keyring in bdd:
+        for field in keyring:
+            field = _to_bytes(field)
+            if KEYRING_SEPARATOR in field or TAG_SEPARATOR in field:
+                return True
+    return False
+
+
+def parse_v1(raw):
+    bdd = []
+    if raw:
+        for keyring in raw.split(KEYRING_SEPARATOR):
+            bdd.append(keyring.split(TAG_SEPARATOR))
+    return bdd
+
+
+class V2Reader:
+    """ Random access to the records of a v2 bdd through memoryview slices of the decrypted buffer """
+    def __init__(self, raw):
+        self.view = memoryview(raw)
+        if len(self.view) < _HEADER.size:
+            raise ValueError("Corrupted bdd: truncated header.")
+        magic, self.version, self.count = _HEADER.unpack_from(self.view, 0)
+        if magic != MAGIC or self.version not in RECORD_VERSIONS:
+            raise ValueError("Corrupted bdd: unsupported format version " + str(self.version) + ".")
+        self.records_start = _HEADER.size + _OFFSET.size * self.count
+        if len(self.view) < self.records_start:
+            raise ValueError("Corrupted bdd: truncated offset table.")
+        self.offsets = struct.unpack_from("<%dQ" % self.count, self.view, _HEADER.size)
+
+    def __len__(self):
+        return self.count
+
+    def field_offsets(self, i):
+        """ Return the (offset, length) in the buffer of each field of record i """
+        view, unpack, uint_size, end = self.view, _UINT.unpack_from, _UINT.size, len(self.view)
+        pos = self.records_start + self.offsets[i]
+        try:
+            field_count, = unpack(view, pos)
+            pos += uint_size
+            fields = []
+            for _ in range(field_count):
+                length, = unpack(view, pos)
+                pos += uint_size
+                if pos + length > end:
+                    raise ValueError("Corrupted bdd: truncated record " + str(i) + ".")
+                fields.append((pos, length))
+                pos += length
+        except struct.error:
+            raise ValueError("Corrupted bdd: truncated record " + str(i) + ".")
+        return fields
+
+    def record_fields(self, i):
+        """ Return the memoryview slices of the fields of record i, without copying them """
+        view = self.view
+        return [view[start:start + length] for start, length in self.field_offsets(i)]
+
+    def record(self, i):
+        return [field.tobytes() for field in self.record_fields(i)]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+
+class StreamParser:
+    """ Incremental parser of a decrypted bdd of any version, fed with chunks as they are decrypted.
+    Only the bytes of the record being parsed are buffered, v1 trailing whitespace is stripped at the end
+    like load_raw_bdd does. """
+    def __init__(self):
+        self.version = None
+        self.buffer = bytearray()
+        self.pos = 0
+        self.parsed = 0
+        self.count = None
+        self._table_left = 0
+
+    def _compact(self):
+        if self.pos > 65536 and self.pos * 2 > len(self.buffer):
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+    def feed(self, chunk):
+        """ Parse a chunk of decrypted data and return the keyrings it completes """
+        self.buffer += chunk
+        if self.version is None:
+            if len(self.buffer) < len(MAGIC) and self.buffer == MAGIC[:len(self.buffer)]:
+                return []
+            self.version = VERSION_2 if self.buffer[:len(MAGIC)] == MAGIC else VERSION_1
+        keyrings = self._feed_v1() if self.version == VERSION_1 else self._feed_v2()
+        self._compact()
+        return keyrings
+
+    def _feed_v1(self):
+        keyrings = []
+        while True:
+            end = self.buffer.find(KEYRING_SEPARATOR, self.pos)
+            if end < 0:
+                return keyrings
+            keyrings.append(bytes(self.buffer[self.pos:end]).split(TAG_SEPARATOR))
+            self.pos = end + 1
+            self.parsed += 1
+
+    def _feed_v2(self):
+        keyrings = []
+        if self.count is None:
+            if len(self.buffer) - self.pos < _HEADER.size:
+                return keyrings
+            magic, version, self.count = _HEADER.unpack_from(self.buffer, self.pos)
+            if version not in RECORD_VERSIONS:
+                raise ValueError("Corrupted bdd: unsupported format version " + str(version) + ".")
+            self.version = version
+            self.pos += _HEADER.size
+            self._table_left = _OFFSET.size * self.count
+        if self._table_left: # records are stored in order, the offset table is only needed for random access
+            skipped = min(self._table_left, len(self.buffer) - self.pos)
+            self.pos += skipped
+            self._table_left -= skipped
+            if self._table_left:
+                return keyrings
+        while self.parsed < self.count:
+            record = self._read_record()
+            if record is None:
+                break
+            keyrings.append(record)
+            self.parsed += 1
+        if self.parsed == self.count and self.pos < len(self.buffer):
+            raise ValueError("Corrupted bdd: unexpected data after record " + str(self.count - 1) + ".")
+        return keyrings
+
+    def _read_record(self):
+        """ Return the record starting at pos if it is fully buffered, None otherwise """
+        pos = self.pos
+        end = len(self.buffer)
+        if end - pos < _UINT.size:
+            return None
+        field_count, = _UINT.unpack_from(self.buffer, pos)
+        pos += _UINT.size
+        fields = []
+        for _ in range(field_count):
+            if end - pos < _UINT.size:
+                return None
+            length, = _UINT.unpack_from(self.buffer, pos)
+            pos += _UINT.size
+            if end - pos < length:
+                return None
+            fields.append(bytes(self.buffer[pos:pos + length]))
+            pos += length
+        self.pos = pos
+        return fields
+
+    def close(self):
+        """ Return the keyrings left at the end of the data, raising ValueError if it is truncated """
+        if self.version == VERSION_1:
+            last = bytes(self.buffer[self.pos:]).rstrip()
+            if last or self.parsed:
+                self.parsed += 1
+                return [last.split(TAG_SEPARATOR)]
+            return []
+        if self.version is None and self.buffer.strip():
+            self.version = VERSION_1 # a v1 bdd shorter than the magic
+            return self.close()
+        if self.version in RECORD_VERSIONS and (self.count is None or self.parsed < self.count):
+            raise ValueError("Corrupted bdd: truncated record " + str(self.parsed) + ".")
+        return []
+
+
+def parse_v2(raw):
+    return list(V2Reader(raw))
+
+
+def parse(raw):
+    """ Parse a decrypted bdd of any version into a list of keyrings """
+    if detect_version(raw) in RECORD_VERSIONS:
+        return parse_v2(raw)
+    return parse_v1(raw)
+
+
+def serialize_v1(bdd):
+    return KEYRING_SEPARATOR.join(TAG_SEPARATOR.join(_to_bytes(field) for field in keyring) for keyring in bdd)
+
+
+def iter_v2_chunks(bdd, version=VERSION_2):
+    """ Yield the v2 serialization of the bdd chunk by chunk, one record at a time after the header and offset table.
+    The header is given the version of a format sharing the v2 layout. """
+    offsets = []
+    offset = 0
+    for keyring in bdd:
+        offsets.append(offset)
+        offset += _UINT.size
+        for field in keyring:
+            offset += _UINT.size + len(_to_bytes(field))
+    yield _HEADER.pack(MAGIC, version, len(offsets))
+    yield struct.pack("<%dQ" % len(offsets), *offsets)
+    for keyring in bdd:
+        chunks = [_UINT.pack(len(keyring))]
+        for field in keyring:
+            field = _to_bytes(field)
+            chunks.append(_UINT.pack(len(field)))
+            chunks.append(field)
+        yield b"".join(chunks)
+
+
+def serialize_v2(bdd, version=VERSION_2):
+    return b"".join(iter_v2_chunks(bdd, version))
+
+
+def serialize(bdd, version):
+    if version in RECORD_VERSIONS:
+        return serialize_v2(bdd, version)
+    return serialize_v1(bdd)
@@ -0,0 +1,96 @@
+import os
+
+from . import bdd_format
+
+
+# Mutations are appended as small encrypted segments stored in a directory next to the bdd file.
+# Segment names start with a digest of the encrypted bdd file they apply to, so segments left over
+# after the bdd file is rewritten (by a compaction or any full save) are never replayed.
+
+ADD = b"add"
+UPDATE = b"update"
+REMOVE = b"remove"
+
+
+def segment_dir(filename):
+    return filename + ".d"
+
+
+def base_digest(filename):
+    import hashlib
+    h = hashlib.sha256()
+    try:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except IOError: # the bdd file does not exist yet
+        pass
+    return h.hexdigest()[:16]
+
+
+def list_segments(filename):
+    """ Return the paths of the segments to replay on top of the bdd file, in order """
+    directory = segment_dir(filename)
+    if not os.path.isdir(directory):
+        return []
+    names = os.listdir(directory)
+    if not names:
+        return []
+    prefix = base_digest(filename) + "-"
+    return [os.path.join(directory, name) for name in sorted(names) if name.startswith(prefix)]
+
+
+def segments_size(segments):
+    return sum(os.path.getsize(segment) for segment in segments)
+
+
+def next_segment_path(filename, segments):
+    directory = segment_dir(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    return os.path.join(directory, "%s-%06d.gpg" % (base_digest(filename), len(segments) + 1))
+
+
+def clear_segments(filename):
+    import shutil
+    shutil.rmtree(segment_dir(filename), ignore_errors=True)
+
+
+def encode_ops(ops):
+    """ Serialize a list of operations: ("add", keyring), ("update", keyId, key) or ("remove", keyId) """
+    records = []
+    for op in ops:
+        if op[0] == "add":
+            records.append([ADD] + list(op[1]))
+        elif op[0] == "update":
+            records.append([UPDATE, str(op[1]), op[2]])
+        elif op[0] == "remove":
+            records.append([REMOVE, str(op[1])])
+        else:
+            raise ValueError("Unknown operation: " + str(op[0]))
+    return bdd_format.serialize_v2(records)
+
+
+def decode_ops(raw):
+    ops = []
+    for record in bdd_format.parse_v2(raw):
+        if record[0] == ADD:
+            ops.append(("add", record[1:]))
+        elif record[0] == UPDATE:
+            ops.append(("update", int(record[1]), record[2]))
+        elif record[0] == REMOVE:
+            ops.append(("remove", int(record[1])))
+        else:
+            raise ValueError("Corrupted change log: unknown operation " + repr(record[0]) + ".")
+    return ops
+
+
+def apply_ops(bdd, ops):
+    for op in ops:
+        if op[0] == "add":
+            bdd.append(list(op[1]))
+        elif op[0] == "update":
+            bdd[op[1]] = list(bdd[op[1]])[:-1] + [op[2]]
+        elif op[0] == "remove":
+            del bdd[op[1]]
+    return bdd
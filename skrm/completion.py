@@ -0,0 +1,238 @@
+import os
+import struct
+from bisect import bisect_left, bisect_right
+
+from .tag_index import fold_tag
+
+# Shell completion answers from a sidecar cache next to the bdd file, so that a keystroke doesn't run gpg.
+# The cache holds the distinct tags of the bdd, one line per case-folded tag sorted so that a prefix is found by
+# bisection, with the number of keyrings holding the tag and the tags it appears with in these keyrings:
+#   FOLDED \t DISPLAY \t COUNT \t LINE:COUNT,LINE,...
+# where a co-occurring tag is referred to by its line number, followed by its count unless it is 1.
+# Tags appearing with more than MAX_COOCCURRENCES others, the most common ones, have "*" instead of a list
+# and don't narrow suggestions.
+# The cache is not encrypted, it holds the tags (never the keys) in a file only readable by its owner, like ~/.skrm.
+# The lines are stored in chunks listed in a header along with the first tag of each, so that a lookup only reads
+# the chunks it needs. The header also identifies the bdd file the cache was built from: a cache left behind by a bdd
+# file replaced since (by a restore or a rekey) isn't used. The modules only needed to write the cache are imported
+# when it is written, so that a keystroke doesn't import them.
+
+MAGIC = b"SKRMTAGS2"
+MAX_COOCCURRENCES = 256
+CHUNK_LINES = 128
+
+
+def cache_path(filename):
+    return filename.rstrip(os.sep) + ".tags"
+
+
+def bdd_identity(filename):
+    """ Identify the bdd file the cache is built from, replaced by every full save """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return "%d %d %d" % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _keyring_tags(bdd):
+    """ Return the displayed form of each case-folded tag, the first one found, and the case-folded tags of each keyring """
+    folded_tags = getattr(bdd, "folded_tags", None)
+    if folded_tags is not None: # a KeyringStore, its tag table is in the order tags were found
+        display = {}
+        for tag, folded in zip(bdd.tags, bdd.folded):
+            display.setdefault(folded, tag.decode("utf8", "surrogateescape"))
+        return display, [folded_tags(i) for i in range(len(bdd))]
+    from . import bdd_format
+    display = {}
+    keyring_tags = []
+    for keyring in bdd:
+        tags = [fold_tag(keyring[j]) for j in range(len(keyring) - 1)]
+        for j, tag in enumerate(tags):
+            display.setdefault(tag, bdd_format._to_bytes(keyring[j]).decode("utf8", "surrogateescape"))
+        keyring_tags.append(tags)
+    return display, keyring_tags
+
+
+def build(bdd):
+    """ Return the lines of the cache of bdd """
+    from collections import Counter
+    from itertools import chain
+    display, keyring_tags = _keyring_tags(bdd)
+    # tags holding a separator of the cache format can't be typed in a shell anyway
+    vocabulary = sorted(tag for tag in display if "\t" not in tag and "\n" not in tag)
+    lines = dict((tag, n) for n, tag in enumerate(vocabulary))
+    holders = [[] for _ in vocabulary]
+    for tags in keyring_tags:
+        tags = set(map(lines.get, tags))
+        tags.discard(None)
+        for n in tags:
+            holders[n].append(tags)
+
+    out = []
+    for n, tag in enumerate(vocabulary):
+        cooccurring = set()
+        for tags in holders[n]:
+            cooccurring |= tags
+            if len(cooccurring) > MAX_COOCCURRENCES + 1:
+                break
+        cooccurring.discard(n)
+        if len(cooccurring) > MAX_COOCCURRENCES:
+            field = "*" # a truncated list doesn't narrow suggestions, there is no need to keep any of it
+        elif len(holders[n]) == 1: # most tags are held by a single keyring, every co-occurring tag counts once
+            field = ",".join(map(str, sorted(cooccurring)))
+        else:
+            counts = Counter(chain.from_iterable(holders[n]))
+            field = ",".join(str(m) if counts[m] == 1 else "%d:%d" % (m, counts[m]) for m in sorted(cooccurring))
+        out.append("\t".join([tag, display[tag], str(len(holders[n])), field]))
+    return out
+
+
+def write(filename, bdd):
+    """ Write the cache of bdd next to the bdd file, only readable by its owner, replacing it atomically """
+    import tempfile
+    lines = build(bdd)
+    chunks = []
+    header = [bdd_identity(filename) or ""]
+    offset = 0
+    for start in range(0, len(lines), CHUNK_LINES):
+        chunk = "\n".join(lines[start:start + CHUNK_LINES]).encode("utf8", "surrogateescape")
+        header.append("%d\t%d\t%s" % (offset, len(chunk), lines[start].split("\t", 1)[0]))
+        chunks.append(chunk)
+        offset += len(chunk)
+    header = "\n".join(header).encode("utf8", "surrogateescape")
+    path = cache_path(filename)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".skrm-") # created 0600
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC + struct.pack(">I", len(header)))
+            f.write(header)
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read(filename):
+    """ Return the Vocabulary cached for the bdd file, or None if there is no cache up to date """
+    path = cache_path(filename)
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            length, = struct.unpack(">I", f.read(4))
+            header = f.read(length).decode("utf8", "surrogateescape").split("\n")
+    except (IOError, OSError, struct.error):
+        return None
+    if header[0] != bdd_identity(filename):
+        return None
+    header_end = len(MAGIC) + 4 + length
+
+    def loader(offset, length):
+        def load():
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return _split(f.read(length))
+        return load
+
+    chunks = []
+    for n, entry in enumerate(header[1:]):
+        offset, length, first_tag = entry.split("\t", 2)
+        chunks.append((n * CHUNK_LINES, first_tag, loader(header_end + int(offset), int(length))))
+    return Vocabulary(chunks)
+
+
+def _split(content):
+    return content.decode("utf8", "surrogateescape").split("\n")
+
+
+class Vocabulary:
+    """ The sorted lines of a completion cache, in chunks that are only read when a lookup reaches them.
+    Each chunk is given by the number of its first line, its first tag, and a function returning its lines. """
+    def __init__(self, chunks):
+        self.starts = [start for start, first_tag, load in chunks]
+        self.first_tags = [first_tag for start, first_tag, load in chunks]
+        self.loaders = [load for start, first_tag, load in chunks]
+        self.chunks = {}
+
+    @classmethod
+    def from_lines(cls, lines):
+        return cls([(0, "", lambda: lines)] if lines else [])
+
+    def _chunk(self, c):
+        if c not in self.chunks:
+            self.chunks[c] = self.loaders[c]()
+        return self.chunks[c]
+
+    def line(self, n):
+        c = bisect_right(self.starts, n) - 1
+        return self._chunk(c)[n - self.starts[c]]
+
+    def _find(self, folded_tag):
+        c = bisect_right(self.first_tags, folded_tag) - 1
+        if c < 0:
+            return None
+        lines = self._chunk(c)
+        i = bisect_left(lines, folded_tag + "\t")
+        if i < len(lines) and lines[i].startswith(folded_tag + "\t"):
+            return self.starts[c] + i
+        return None
+
+    def _with_prefix(self, prefix):
+        """ Yield the number and the line of the tags starting with prefix """
+        c = max(0, bisect_left(self.first_tags, prefix) - 1)
+        i = None
+        while c < len(self.loaders):
+            lines = self._chunk(c)
+            i = bisect_left(lines, prefix) if i is None else 0
+            while i < len(lines):
+                if not lines[i].startswith(prefix):
+                    if lines[i] > prefix:
+                        return
+                else:
+                    yield self.starts[c] + i, lines[i]
+                i += 1
+            c += 1
+
+    def _cooccurrences(self, n):
+        """ Return {line: count} of the tags appearing with the tag of line n, or None if the list is truncated """
+        field = self.line(n).rsplit("\t", 1)[1]
+        if field.startswith("*"):
+            return None
+        cooccurrences = {}
+        for item in field.split(","):
+            if item:
+                m, _, count = item.partition(":")
+                cooccurrences[int(m)] = int(count or 1)
+        return cooccurrences
+
+    def complete(self, prefix, tags=(), limit=None):
+        """ Return the tags starting with prefix, compared case-insensitively, that appear along with all the given tags.
+        Suggestions are sorted by the number of keyrings they would match, most first. """
+        typed = set()
+        narrowing = []
+        for tag in tags:
+            n = self._find(fold_tag(tag))
+            if n is None:
+                return [] # no keyring holds this tag
+            typed.add(n)
+            cooccurrences = self._cooccurrences(n)
+            if cooccurrences is not None:
+                narrowing.append(cooccurrences)
+        prefix = fold_tag(prefix)
+        if narrowing: # only the lines of the co-occurring tags are needed
+            candidates = set(narrowing[0]).intersection(*narrowing[1:])
+            matches = [(n, self.line(n)) for n in sorted(candidates)]
+            matches = [(n, line) for n, line in matches if line.startswith(prefix)]
+        else:
+            matches = self._with_prefix(prefix)
+        suggestions = []
+        for n, line in matches:
+            if n not in typed:
+                fields = line.split("\t", 3)
+                count = min([cooccurrences[n] for cooccurrences in narrowing] or [int(fields[2])])
+                suggestions.append((-count, fields[0], fields[1]))
+        suggestions.sort()
+        return [display for count, folded, display in suggestions[:limit]]
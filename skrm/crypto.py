@@ -0,0 +1,287 @@
+import os
+import struct
+
+from .vault import SkrmError, DecryptError, EncryptError
+
+
+# The files of a vault (the bdd, change log segments, shards and their manifest) are encrypted by a backend,
+# chosen by the "encryption" user pref for the files written. Files are read by the backend that wrote them.
+#   gpg: every file is encrypted by gpg for the recipient, gpg also being the bulk cipher. The default.
+#   envelope: gpg only wraps a random data key for the recipient. The content is sealed in-process with AES-256-GCM
+#             from the cryptography package (pip install skrm[envelope]). An envelope file is:
+#               MAGIC | recipient length (2 bytes) | recipient | wrapped key length (4 bytes) | wrapped key | nonce | sealed content
+#             everything before the nonce being authenticated along with the content.
+# The data key of an envelope vault is unwrapped by gpg once per process, and the same wrapped key is written
+# again by every save, so that gpg only encrypts a new wrapped key when the recipient changes.
+# With the seal_keys user pref, the envelope also seals the key of each keyring on its own, under the data key
+# with a nonce of its own: a sealed key is nonce | sealed key. The bdd is then stored as a v3 bdd (see bdd_format.py),
+# so that decrypting the file only exposes the tags, and a lookup only unseals the keys of the keyrings it returns.
+# The recipient may be a comma separated list of gpg user ids, every one of them being able to decrypt the files.
+
+GPG = "gpg"
+ENVELOPE = "envelope"
+BACKENDS = [GPG, ENVELOPE]
+MAGIC = b"SKRMENV1"
+DATA_KEY_SIZE = 32
+NONCE_SIZE = 12
+KEY_AAD = b"skrm key"
+CHUNK_SIZE = 64 * 1024
+
+
+def detect(filename):
+    """ Return the name of the backend which wrote the given file """
+    try:
+        with open(filename, "rb") as f:
+            return ENVELOPE if f.read(len(MAGIC)) == MAGIC else GPG
+    except IOError:
+        return GPG
+
+
+def recipients(recipient):
+    """ Return the user ids of a comma separated list of recipients """
+    return [name.strip() for name in recipient.split(",") if name.strip()]
+
+
+def recipient_args(recipient):
+    """ Return the gpg arguments encrypting for every one of the comma separated recipients """
+    args = []
+    for name in recipients(recipient):
+        args += ["-r", name]
+    return args
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _aead():
+    """ Return the AESGCM class of cryptography and the exception it raises for a modified content """
+    try:
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise SkrmError("The envelope encryption needs the cryptography package, install it with pip install skrm[envelope].")
+    return AESGCM, InvalidTag
+
+
+class GpgBackend:
+    """ Encrypt and decrypt files with gpg """
+    name = GPG
+    streams = True # decrypt_chunks yields the content as it is decrypted
+
+    def __init__(self, vault):
+        self.vault = vault
+
+    def decrypt_args(self, filename=None):
+        """ Return the gpg command decrypting the given file, or stdin """
+        args = ["gpg", "-dq"]
+        if self.vault.passphrase:
+            args.append("--no-use-agent")
+            args.append("--passphrase")
+            args.append(self.vault.passphrase)
+        if filename is not None:
+            args.append(filename)
+        return args
+
+    def run_gpg(self, args, data=None):
+        """ Run gpg with data on its stdin, return its stdout, stderr and exit status """
+        import subprocess
+        p = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE, close_fds = True)
+        stdout, stderr = p.communicate(data)
+        return stdout, stderr.decode("utf8", "replace").strip(), p.returncode
+
+    def decrypt(self, filename):
+        """ Return the decrypted content of the given file and None, or None and the reason it can't be decrypted """
+        with self.vault.tracer.span("gpg_decrypt") as span:
+            stdout, stderr, status = self.run_gpg(self.decrypt_args(filename))
+            if self.vault.tracer.enabled:
+                span.set(bytes_in=_file_size(filename), bytes_out=len(stdout), status=status)
+        if status != 0:
+            return None, "gpg failed to decrypt " + filename + ": " + stderr
+        return stdout, None
+
+    def decrypt_chunks(self, filename):
+        """ Yield the decrypted content of the given file chunk by chunk, as gpg outputs it.
+        gpg is killed if the generator is closed before the end. """
+        import subprocess
+        import tempfile
+        with tempfile.TemporaryFile() as errors:
+            p = subprocess.Popen(self.decrypt_args(filename), stdin = subprocess.DEVNULL, stdout = subprocess.PIPE,
+                                 stderr = errors, close_fds = True)
+            complete = False
+            try:
+                while True:
+                    chunk = p.stdout.read1(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+                complete = True
+            finally:
+                if not complete:
+                    p.kill()
+                p.stdout.close()
+                p.wait()
+            if p.returncode != 0:
+                errors.seek(0)
+                raise DecryptError("gpg failed to decrypt " + filename + ": " + errors.read().decode("utf8", "replace").strip())
+
+    def encrypt(self, raw, filename, output):
+        """ Encrypt raw, the content of filename, into the output file """
+        args = ["gpg", "--yes", "-e"] + recipient_args(self.vault.recipient) + ["-o", output]
+        with self.vault.tracer.span("gpg_encrypt") as span:
+            stdout, stderr, status = self.run_gpg(args, raw)
+            if self.vault.tracer.enabled:
+                span.set(bytes_in=len(raw), bytes_out=_file_size(output), status=status)
+        if status != 0:
+            raise EncryptError("gpg failed to encrypt " + filename + ": " + stderr)
+
+    def key_ids(self, name):
+        """ Return the ids of the key and subkeys of a recipient, raising EncryptError if gpg has no key for it """
+        stdout, stderr, status = self.run_gpg(["gpg", "--batch", "--with-colons", "--list-keys", name])
+        if status != 0:
+            raise EncryptError("gpg has no public key for " + name + ": " + stderr)
+        ids = set()
+        for line in stdout.decode("utf8", "replace").splitlines():
+            fields = line.split(":")
+            if fields[0] in ("pub", "sub") and len(fields) > 4:
+                ids.add(fields[4])
+        return ids
+
+    def message_key_ids(self, message):
+        """ Return the ids of the keys a gpg message is encrypted for, without decrypting it """
+        stdout, stderr, status = self.run_gpg(["gpg", "--batch", "--list-only", "--list-packets"], message)
+        ids = set()
+        for line in stdout.decode("utf8", "replace").splitlines():
+            if line.startswith(":pubkey enc packet:") and "keyid " in line:
+                ids.add(line.rsplit("keyid ", 1)[1].strip())
+        return ids
+
+    def encrypted_for(self, filename):
+        """ Return the ids of the keys the given file is encrypted for """
+        with open(filename, "rb") as f:
+            return self.message_key_ids(f.read())
+
+
+class EnvelopeBackend(GpgBackend):
+    """ Seal files with AES-GCM under a data key wrapped by gpg """
+    name = ENVELOPE
+    streams = False
+
+    def __init__(self, vault):
+        GpgBackend.__init__(self, vault)
+        self.data_key = None
+        self.recipient = None # the recipient the data key is wrapped for
+        self.wrapped_key = None
+
+    def unwrap(self, recipient, wrapped_key):
+        """ Make the data key wrapped in wrapped_key the one of the vault, running gpg unless it already is """
+        if wrapped_key == self.wrapped_key:
+            return None
+        with self.vault.tracer.span("gpg_unwrap"):
+            data_key, stderr, status = self.run_gpg(self.decrypt_args(), wrapped_key)
+        if status != 0:
+            return "gpg failed to unwrap the data key: " + stderr
+        if len(data_key) != DATA_KEY_SIZE:
+            return "The data key is corrupted."
+        self.data_key, self.recipient, self.wrapped_key = data_key, recipient, wrapped_key
+        return None
+
+    def wrap(self):
+        """ Wrap the data key for the recipient of the vault, generating it if there is none yet """
+        if self.data_key is None:
+            self.data_key = os.urandom(DATA_KEY_SIZE)
+        with self.vault.tracer.span("gpg_wrap"):
+            wrapped_key, stderr, status = self.run_gpg(["gpg", "--yes", "-e"] + recipient_args(self.vault.recipient),
+                                                       self.data_key)
+        if status != 0:
+            raise EncryptError("gpg failed to wrap the data key for " + self.vault.recipient + ": " + stderr)
+        self.recipient, self.wrapped_key = self.vault.recipient, wrapped_key
+
+    def read_header(self, content):
+        """ Return the recipient, the wrapped key and the size of the header of an envelope file content """
+        offset = len(MAGIC)
+        length, = struct.unpack_from(">H", content, offset)
+        recipient = content[offset + 2:offset + 2 + length].decode("utf8")
+        offset += 2 + length
+        length, = struct.unpack_from(">I", content, offset)
+        wrapped_key = content[offset + 4:offset + 4 + length]
+        offset += 4 + length
+        if len(wrapped_key) != length or len(content) < offset + NONCE_SIZE:
+            raise ValueError("truncated header")
+        return recipient, wrapped_key, offset
+
+    def decrypt(self, filename):
+        AESGCM, InvalidTag = _aead()
+        with open(filename, "rb") as f:
+            content = f.read()
+        try:
+            recipient, wrapped_key, offset = self.read_header(content)
+        except (struct.error, ValueError) as e:
+            return None, "Corrupted envelope header in " + filename + ": " + str(e)
+        error = self.unwrap(recipient, wrapped_key)
+        if error is not None:
+            return None, error
+        with self.vault.tracer.span("envelope_decrypt", bytes=len(content)):
+            try:
+                raw = AESGCM(self.data_key).decrypt(content[offset:offset + NONCE_SIZE], content[offset + NONCE_SIZE:],
+                                                    content[:offset])
+            except InvalidTag:
+                return None, "The content of " + filename + " doesn't match its data key, it was modified."
+        return raw, None
+
+    def encrypted_for(self, filename):
+        with open(filename, "rb") as f:
+            content = f.read()
+        try:
+            recipient, wrapped_key, offset = self.read_header(content)
+        except (struct.error, ValueError):
+            return set()
+        return self.message_key_ids(wrapped_key)
+
+    def decrypt_chunks(self, filename):
+        """ Yield the decrypted content of the given file at once, the content being only authenticated at its end """
+        raw, error = self.decrypt(filename)
+        if error is not None:
+            raise DecryptError(error)
+        yield raw
+
+    def encrypt(self, raw, filename, output):
+        AESGCM, InvalidTag = _aead()
+        if self.wrapped_key is None or self.recipient != self.vault.recipient:
+            self.wrap()
+        recipient = self.recipient.encode("utf8")
+        header = MAGIC + struct.pack(">H", len(recipient)) + recipient + struct.pack(">I", len(self.wrapped_key)) + self.wrapped_key
+        nonce = os.urandom(NONCE_SIZE)
+        with self.vault.tracer.span("envelope_encrypt", bytes=len(raw)):
+            sealed = AESGCM(self.data_key).encrypt(nonce, raw, header)
+        with open(output, "wb") as f:
+            f.write(header + nonce + sealed)
+
+    def seal_key(self, key):
+        """ Seal the key of a keyring under the data key, generating it if the vault has none yet """
+        AESGCM, InvalidTag = _aead()
+        if self.data_key is None:
+            self.data_key = os.urandom(DATA_KEY_SIZE)
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + AESGCM(self.data_key).encrypt(nonce, key, KEY_AAD)
+
+    def open_key(self, sealed):
+        """ Return the key sealed by seal_key """
+        AESGCM, InvalidTag = _aead()
+        if self.data_key is None:
+            raise DecryptError("The data key of the vault isn't unwrapped, sealed keys can't be opened.")
+        try:
+            return AESGCM(self.data_key).decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], KEY_AAD)
+        except InvalidTag:
+            raise DecryptError("A sealed key doesn't match the data key of the vault, it was modified.")
+
+
+def create_backend(name, vault):
+    if name == GPG:
+        return GpgBackend(vault)
+    if name == ENVELOPE:
+        return EnvelopeBackend(vault)
+    raise SkrmError("Unknown encryption " + name + ", use one of " + ", ".join(BACKENDS) + ".")
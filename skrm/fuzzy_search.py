@@ -0,0 +1,119 @@
+import heapq
+from itertools import repeat
+from array import array
+from collections import Counter, defaultdict
+
+from .tag_index import fold_tag
+
+# A fuzzy search scores the keyrings by the similarity of their tags to the given terms, so that a typo still finds them.
+# The distinct tags are indexed by their trigrams. The tags sharing enough trigrams with a term are its candidates,
+# scored by their trigram overlap, or by their edit distance to the term when it is within a bound.
+# The score of a keyring is the sum, over the terms, of the best score of its tags, and the best keyrings are
+# taken from a heap.
+
+N = 3
+MIN_SIMILARITY = 0.4
+DEFAULT_LIMIT = 10
+
+
+def ngrams(tag):
+    """ Return the distinct trigrams of a case-folded tag as tuples of characters.
+    The tag is padded so that short tags and tag ends have some. """
+    padded = "\x00\x00" + tag + "\x00\x00"
+    return set(zip(padded, padded[1:], padded[2:]))
+
+
+def max_distance(term):
+    """ Return the number of edits tolerated for a term: none up to 4 characters, one, or two from 10 characters """
+    return min(2, len(term) // 5)
+
+
+def bounded_distance(a, b, bound):
+    """ Return the Levenshtein distance between a and b, or None if it is greater than bound.
+    Their common prefix and suffix are skipped, and only the band of cells within bound of the diagonal is computed. """
+    if abs(len(a) - len(b)) > bound:
+        return None
+    prefix = 0
+    shortest = min(len(a), len(b))
+    while prefix < shortest and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < shortest - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    a = a[prefix:len(a) - suffix]
+    b = b[prefix:len(b) - suffix]
+    if not a or not b:
+        return max(len(a), len(b))
+    outside = bound + 1
+    previous = [j if j <= bound else outside for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [i if i <= bound else outside] + [outside] * len(b)
+        row_min = current[0]
+        ca = a[i - 1]
+        for j in range(max(1, i - bound), min(len(b), i + bound) + 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != b[j - 1]))
+            current[j] = distance
+            if distance < row_min:
+                row_min = distance
+        if row_min > bound:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= bound else None
+
+
+class FuzzySearch:
+    """ Ranked fuzzy search over the distinct tags of a TagIndex, through a trigram index of its vocabulary """
+    def __init__(self, index):
+        self.index = index
+        self.tags = []
+        self.gram_counts = array("I")
+        self.grams = defaultdict(lambda: array("I"))
+        self.add_tags(index.vocabulary())
+
+    def add_tags(self, tags):
+        """ Index the trigrams of tags new to the vocabulary of the index """
+        for tag in tags:
+            tag_grams = ngrams(tag)
+            self.gram_counts.append(len(tag_grams))
+            for gram in tag_grams:
+                self.grams[gram].append(len(self.tags))
+            self.tags.append(tag)
+
+    def similar_tags(self, term):
+        """ Return {tag: score} for the tags similar to a term, scores ranging up to 1 for the term itself """
+        term = fold_tag(term)
+        term_grams = ngrams(term)
+        shared = Counter()
+        for gram in term_grams:
+            shared.update(self.grams.get(gram, ()))
+        bound = max_distance(term)
+        scores = {}
+        for i, count in shared.items():
+            tag = self.tags[i]
+            tag_grams = self.gram_counts[i]
+            score = 2.0 * count / (len(term_grams) + tag_grams)
+            # an edit removes at most N trigrams, tags sharing fewer trigrams can't be within the bound
+            if count >= max(len(term_grams), tag_grams) - N * bound:
+                distance = bounded_distance(term, tag, bound)
+                if distance is not None:
+                    score = max(score, 1.0 - float(distance) / max(len(term), len(tag)))
+            if score >= MIN_SIMILARITY:
+                scores[tag] = score
+        return scores
+
+    def scores(self, terms):
+        """ Return {id: score} for the keyrings having a tag similar to one of the terms """
+        totals = Counter()
+        for term in terms:
+            best = {}
+            # tags are taken by increasing score, so that the best tag of each keyring is the last written
+            for tag, score in sorted(self.similar_tags(term).items(), key=lambda item: item[1]):
+                best.update(zip(self.index.ids_for_tag(tag), repeat(score)))
+            totals.update(best)
+        return totals
+
+    def top(self, terms, limit=DEFAULT_LIMIT):
+        """ Return the ids of the limit best scored keyrings, best first, the lowest id first on ties """
+        if limit is None:
+            limit = DEFAULT_LIMIT
+        return [i for i, score in heapq.nlargest(limit, self.scores(terms).items(), key=lambda item: (item[1], -item[0]))]
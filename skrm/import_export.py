@@ -0,0 +1,168 @@
+import io
+import os
+import csv
+import sys
+import json
+import subprocess
+
+from . import bdd_format
+from .crypto import recipient_args
+from .vault import SkrmError
+
+
+# Records are imported from and exported to CSV or JSON Lines files, chosen from the file extension.
+# A trailing ".gpg" extension means the file is encrypted, it is then streamed through gpg.
+#
+# CSV files have a header row. The key is read from the key column ("key" by default), and the tags from
+# the given columns, or from every other column, skipping empty cells. Exported CSV files use the columns
+# key, tag1, tag2, ...
+# JSON Lines files hold one object per line. The key is read from the key column, and the tags from the given
+# columns, or from the "tags" list. Exported objects look like {"id": 0, "tags": ["tag1", "tag2"], "key": "pass"}.
+
+CSV = "csv"
+JSONL = "jsonl"
+DEFAULT_KEY_COLUMN = "key"
+
+
+def detect_format(filename):
+    """ Return (format, encrypted) for the given filename """
+    encrypted = filename.endswith(".gpg")
+    if encrypted:
+        filename = filename[:-len(".gpg")]
+    if filename.endswith(".csv"):
+        return CSV, encrypted
+    if filename.endswith(".jsonl") or filename.endswith(".json") or filename == "-":
+        return JSONL, encrypted
+    raise ValueError("Unknown file format for " + filename + ", use a .csv or .jsonl file.")
+
+
+def _to_bytes(field):
+    return str(field).encode("utf8", "surrogateescape")
+
+
+def _key(row, key_column, line):
+    """ Return the key of a record, raising SkrmError if it has none """
+    if key_column not in row:
+        raise SkrmError("Missing key column \"" + key_column + "\".")
+    if row[key_column] is None or row[key_column] == "": # a short CSV row has no cell for the key, JSON may hold null
+        raise SkrmError("Missing key on line " + str(line) + ".")
+    return _to_bytes(row[key_column])
+
+
+def _keyring(row, tag_columns, key_column, line):
+    key = _key(row, key_column, line)
+    return [_to_bytes(row[column]) for column in tag_columns if row.get(column)] + [key]
+
+
+def read_csv(stream, columns=None, key_column=DEFAULT_KEY_COLUMN):
+    """ Yield the keyrings of a CSV stream, one row at a time """
+    reader = csv.DictReader(stream)
+    tag_columns = columns or [c for c in (reader.fieldnames or []) if c != key_column]
+    for row in reader:
+        yield _keyring(row, tag_columns, key_column, reader.line_num)
+
+
+def read_jsonl(stream, columns=None, key_column=DEFAULT_KEY_COLUMN):
+    """ Yield the keyrings of a JSON Lines stream, one line at a time """
+    for n, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if columns is None and "tags" in row:
+            key = _key(row, key_column, n)
+            if not isinstance(row["tags"], list):
+                raise SkrmError("The tags on line " + str(n) + " must be a list.")
+            yield [_to_bytes(tag) for tag in row["tags"]] + [key]
+        else:
+            yield _keyring(row, columns or [c for c in row if c != key_column], key_column, n)
+
+
+def write_csv(bdd, stream):
+    tag_count = max([len(keyring) - 1 for keyring in bdd] or [0])
+    writer = csv.writer(stream)
+    writer.writerow([DEFAULT_KEY_COLUMN] + ["tag" + str(i + 1) for i in range(tag_count)])
+    for keyring in bdd:
+        keyring = bdd_format.keyring_to_text(keyring)
+        writer.writerow([keyring[-1]] + keyring[:-1])
+
+
+def write_jsonl(bdd, stream):
+    for i, keyring in enumerate(bdd):
+        keyring = bdd_format.keyring_to_text(keyring)
+        stream.write(json.dumps({"id": i, "tags": keyring[:-1], "key": keyring[-1]}) + "\n")
+
+
+class _GpgStream:
+    """ Text stream decrypting a gpg file, or encrypting into one, through a gpg subprocess pipe """
+    def __init__(self, args, reading):
+        self.process = subprocess.Popen(args, stdin=None if reading else subprocess.PIPE,
+                                        stdout=subprocess.PIPE if reading else None, close_fds=True)
+        pipe = self.process.stdout if reading else self.process.stdin
+        self.stream = io.TextIOWrapper(pipe, encoding="utf8", errors="surrogateescape", newline="")
+
+    def __enter__(self):
+        return self.stream
+
+    def __exit__(self, *exc):
+        self.stream.close()
+        if self.process.wait() != 0:
+            raise IOError("gpg failed with status " + str(self.process.returncode) + ".")
+
+
+class _StdStream:
+    """ Context manager giving access to stdin or stdout without closing it """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __enter__(self):
+        return self.stream
+
+    def __exit__(self, *exc):
+        self.stream.flush()
+
+
+def open_input(filename, encrypted, passphrase=""):
+    if encrypted:
+        args = ["gpg", "-dq"]
+        if passphrase:
+            args += ["--no-use-agent", "--passphrase", passphrase]
+        return _GpgStream(args + [filename], reading=True)
+    if filename == "-":
+        return _StdStream(sys.stdin)
+    return io.open(filename, "r", encoding="utf8", errors="surrogateescape", newline="")
+
+
+def open_output(filename, encrypted, recipient=""):
+    if encrypted:
+        return _GpgStream(["gpg", "--yes", "-e"] + recipient_args(recipient) + ["-o", filename], reading=False)
+    if filename == "-":
+        return _StdStream(sys.stdout)
+    # the keys are written in clear, only the owner may read them, even from a file written before
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    return io.open(fd, "w", encoding="utf8", errors="surrogateescape", newline="")
+
+
+def read_records(filename, columns=None, key_column=DEFAULT_KEY_COLUMN, passphrase=""):
+    """ Yield the keyrings of the given file, one record at a time """
+    fmt, encrypted = detect_format(filename)
+    read = read_csv if fmt == CSV else read_jsonl
+    with open_input(filename, encrypted, passphrase) as stream:
+        for keyring in read(stream, columns, key_column):
+            yield keyring
+
+
+def import_records(vault, filename, columns=None, key_column=DEFAULT_KEY_COLUMN, passphrase=""):
+    """ Add the records of the given file to the vault, without committing them. Return the number of records added. """
+    count = 0
+    for keyring in read_records(filename, columns, key_column, passphrase):
+        vault.add(keyring[:-1], keyring[-1])
+        count += 1
+    return count
+
+
+def export_records(bdd, filename, recipient=""):
+    fmt, encrypted = detect_format(filename)
+    write = write_csv if fmt == CSV else write_jsonl
+    with open_output(filename, encrypted, recipient) as stream:
+        write(bdd, stream)
@@ -1,10 +1,14 @@
 
-from __future__ import print_function
 import os
-import getopt
 import sys
-import subprocess
-import re
+
+from . import bdd_format
+from . import output
+from . import tracing
+from .vault import Vault, SkrmError, BackupError
+
+# skrm is run for every lookup of scripts and shell completions: the modules only some commands need are imported
+# by these commands, and getopt, which imports gettext and re, only parses command lines holding options.
 
 
 def exit_with_usage(error=0, msg=""):
@@ -17,10 +21,15 @@ def exit_with_usage(error=0, msg=""):
     print("\t-h, --help: Print usage.")
     print("\t-g, --get: Return keyrings matching strictly the given tags. This option is used by default. If a keyId is selected, a get or a search return only the keyring matching the keyId.")
     print("\t-s, --search: Return keyrings matching the given tags (tags are interpreted as a regex expression).")
+    print("\t--fuzzy: Return the keyrings whose tags are the most similar to the given tags, best first, tolerating typos. 10 keyrings are returned unless --limit is given.")
+    print("\t--timings: print the time spent in each phase of the command to stderr.")
+    print("\t--limit=[COUNT]: return at most COUNT keyrings from a get or a search, decrypting the file only up to the last one needed.")
+    print("\t--format=[FORMAT]: print the keyrings of a get, a search or a fuzzy search as json lines, tsv lines or null (NUL terminated fields: id, tag count, tags and key) instead of text.")
+    print("\t--only=[FIELD]: print only the keys or only the ids of the keyrings, one per line or NUL terminated with --format=null.")
     print("\t-c, --clip: Copy the key of the last matched keyring from a get or a search into the clipboard. Nothing will be printed out to the shell.")
     print("COMMANDS:")
     print("\t--file=[FILENAME]: use the given file to read/store keyrings.")
-    print("\t--recipient=[USER_ID_NAME]: set the user id name for gpg to get the key and encrypt the file.")
+    print("\t--recipient=[USER_ID_NAME]: set the user id name for gpg to get the key and encrypt the file, or a comma separated list of user id names.")
     print("\t--pass=[MASTER_PASS]: set the master pass to use when encrypting or decrypting the file.")
     print("\t--add=[KEY]: add a key to the file with the specified tags.")
     print("\t--select=[KEYID]: select a keyring using its key id. To use with a command like \"remove\" or \"update\".")
@@ -28,31 +37,63 @@ def exit_with_usage(error=0, msg=""):
     print("\t--update=[KEY]: update the selected key.")
     print("\t--backup=[HOSTDEST]: scp the bdd file to the given host destination.")
     print("\t--restore=[HOSTSRC]: scp the bdd file from the given host destination. YOU WILL LOOSE LOCAL DATA IF YOUR BACKUP IS CORRUPTED!")
+    print("\t--backup-status: report the last backup done after a save, and whether one is pending.")
     print("\t-b, --quick-backup: backup bdd file to location in user.prefs.")
     print("\t-r, --quick-restore: restore backup from location in user.prefs. YOU WILL LOOSE LOCAL DATA IF YOUR BACKUP IS CORRUPTED!")
+    print("\t--batch=[FILE]: run the get, search, add, update and remove operations listed in FILE (or stdin with -) with a single load and save.")
+    print("\t--import=[FILE]: add the records of a .csv or .jsonl file (.csv.gpg or .jsonl.gpg if encrypted).")
+    print("\t--export=[FILE]: write every keyring to a .csv or .jsonl file (.csv.gpg or .jsonl.gpg to encrypt it).")
+    print("\t--columns=[COLUMNS]: comma separated list of the columns holding the tags of imported records.")
+    print("\t--key-column=[COLUMN]: column holding the key of imported records, \"key\" by default.")
+    print("\t--shard=[DIRECTORY]: write the keyrings as a sharded vault in DIRECTORY, to use with --file=DIRECTORY.")
+    print("\t--complete=[PREFIX]: print the tags starting with PREFIX found along with the given tags, for shell completion.")
+    print("\t--compact: fold the change log segments into the bdd file.")
+    print("\t--migrate: rewrite the bdd file using the latest format version.")
+    print("\t--rekey=[RECIPIENTS]: re-encrypt the bdd files and sharded vaults given as TAGS (paths or globs, the bdd file by default) for the comma separated RECIPIENTS, verifying each file before replacing it.")
+    print("\t--from=[RECIPIENTS]: with --rekey, only re-encrypt the files encrypted for one of these recipients.")
+    print("\t--jobs=[COUNT]: with --rekey, the number of vaults re-encrypted in parallel, 8 by default.")
+    print("\t--agent: run a resident agent keeping the decrypted bdd in memory. get, search and fuzzy commands query it when it is running.")
+    print("\t--agent-stop: stop the running agent.")
+    print("\t--no-agent: do not query the agent, always decrypt the bdd file.")
     print("TAGS:")
     print("\tA list of strings to define tags you want to use for any commands keyring related management.")
     sys.exit(error)
 
 
-class KeyringManager:
+def parse_options(argv):
+    """ Return the options and arguments of argv parsed by getopt, which is only imported when there are options:
+    it imports gettext and re, which a lookup given tags alone doesn't need """
+    import getopt
+    try:
+        return getopt.getopt(argv, "hgscbr", ["help", "file=", "get", "search", "pass=", "add=", "select=",
+                                             "remove", "update=", "recipient=", "backup=", "restore=", "clip",
+                                             "quick-backup", "quick-restore", "agent", "agent-stop",
+                                             "no-agent", "migrate", "compact", "batch=", "import=",
+                                             "export=", "columns=", "key-column=",
+                                             "backup-status", "timings", "limit=", "shard=", "fuzzy", "complete=",
+                                             "format=", "only=", "rekey=", "from=", "jobs="])
+    except getopt.GetoptError:
+        exit_with_usage(1, "Bad arguments.")
+
+
+class KeyringManager(Vault):
+    """ Command line interface over a Vault """
     def __init__(self, user_pref_path, bdd_path, argv):
+        opts, args = [], list(argv)
+        if args and args[0].startswith("-") and args[0] != "-": # getopt would return the tags alone as they are
+            opts, args = parse_options(argv)
+        if ("-h", "") in opts or ("--help", "") in opts: # before reading the prefs, which help doesn't need
+            exit_with_usage()
         self.read_user_prefs(user_pref_path, bdd_path)
-        try:
-            opts, args = getopt.getopt(argv, "hgscbr", ["help", "file=", "get", "search", "pass=", "add=", "select=",
-                                                      "remove", "update=", "recipient=", "backup=", "restore=", "clip",
-                                                      "quick-backup", "quick-restore"])
-        except getopt.GetoptError:
-            exit_with_usage(1, "Bad arguments.")
         for opt, arg in opts:
-            if opt in ("-h", "--help"):
-                exit_with_usage()
-            elif opt == "--file":
+            if opt == "--file":
                 self.filename = os.path.expanduser(arg)
             elif opt in ("-g", "--get"):
                 self.command = "get"
             elif opt in ("-s", "--search"):
                 self.command = "search"
+            elif opt == "--fuzzy":
+                self.command = "fuzzy"
             elif opt == "--add":
                 self.command = "add"
                 self.key = arg
@@ -61,6 +102,11 @@ class KeyringManager:
                     self.keyId = int(arg)
                 else:
                     exit_with_usage(1, "The given keyid is not a number.")
+            elif opt == "--limit":
+                if arg.isdigit():
+                    self.limit = int(arg)
+                else:
+                    exit_with_usage(1, "The given limit is not a number.")
             elif opt == "--remove":
                 self.command = "remove"
             elif opt == "--update":
@@ -76,146 +122,139 @@ class KeyringManager:
             elif opt == "--restore":
                 self.command = "restore"
                 self.hostsrc = arg
+            elif opt == "--backup-status":
+                self.command = "backup_status"
             elif opt in ("-b", "--quick-backup"):
                 self.command = "quick_backup"
             elif opt in ("-r", "--quick-restore"):
                 self.command = "quick_restore"
             elif opt in ("-c", "--clip"):
                 self.clip = 1
+            elif opt == "--batch":
+                self.command = "batch"
+                self.batch_file = arg
+            elif opt == "--import":
+                self.command = "import"
+                self.transfer_file = arg
+            elif opt == "--export":
+                self.command = "export"
+                self.transfer_file = arg
+            elif opt == "--columns":
+                self.import_columns = arg.split(",")
+            elif opt == "--key-column":
+                self.import_key_column = arg
+            elif opt == "--shard":
+                self.command = "shard"
+                self.shard_directory = os.path.expanduser(arg)
+            elif opt == "--complete":
+                self.command = "complete"
+                self.prefix = arg
+            elif opt == "--compact":
+                self.command = "compact"
+            elif opt == "--migrate":
+                self.command = "migrate"
+            elif opt == "--rekey":
+                self.command = "rekey"
+                self.rekey_recipient = arg
+            elif opt == "--from":
+                self.rekey_from = arg
+            elif opt == "--jobs":
+                if arg.isdigit() and int(arg) > 0:
+                    self.jobs = int(arg)
+                else:
+                    exit_with_usage(1, "The given number of jobs is not a positive number.")
+            elif opt == "--agent":
+                self.command = "agent"
+            elif opt == "--agent-stop":
+                self.command = "agent_stop"
+            elif opt == "--no-agent":
+                self.use_agent = False
+            elif opt == "--timings":
+                self.timings = True
+            elif opt == "--format":
+                if arg in output.FORMATS:
+                    self.output_format = arg
+                else:
+                    exit_with_usage(1, "The given format is not one of " + ", ".join(output.FORMATS) + ".")
+            elif opt == "--only":
+                if arg in output.ONLY:
+                    self.output_only = arg
+                else:
+                    exit_with_usage(1, "The given field is not one of " + ", ".join(output.ONLY) + ".")
         for arg in args:
             self.tags.append(arg)
+        self.tracer = tracing.create_tracer(self.timings)
 
     def read_user_prefs(self, user_pref_path, bdd_path):
-        user_pref_file = user_pref_path
-        self.filename = bdd_path
+        Vault.__init__(self, bdd_path)
         self.command = "get"
-        self.passphrase = ""
         self.tags = []
         self.key = ""
         self.keyId = -1
-        self.recipient = ""
+        self.limit = None
         self.clip = 0
-        self.backup_location = None
-        self.auto_backup = False
-        try:
-            with open(user_pref_file, "r") as f:
-                for line in f:
-                    option = line.split("=")
-                    option[1] = option[1].rstrip('\n')
-                    if option[0][0] != '#':
-                        if option[0] == "file":
-                            self.filename = option[1]
-                        elif option[0] == "recipient":
-                            self.recipient = option[1]
-                        elif option[0] == "backup_location":
-                            self.backup_location = option[1]
-                        elif option[0] == "auto_backup":
-                            self.auto_backup = (option[1].lower() == "true")
-        except IOError: # use preffs not found, do nothing. args must be defined in command line arguments.
-            pass
-
-    def load_raw_bdd(self):
-        """ Decript gpg file and return the content """
-        args = ["gpg", "-dq"]
-        if self.passphrase:
-            args.append("--no-use-agent")
-            args.append("--passphrase")
-            args.append(self.passphrase)
-        args.append(self.filename)
-        p = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE, close_fds = True)
-        stdout, stderr = p.communicate(None)
-        if stderr:
-            print(stderr)
-        if stdout == "" and stdout != "":
-            print(stderr)
-            exit(1)
-        return stdout.rstrip()
-
-    def _save_raw_bdd(self, raw):
-        """ Encript gpg file """
-        args = ["gpg", "--yes", "-e", "-r", self.recipient, "-o", self.filename]
-        p = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE, close_fds = True)
-        stdout, stderr = p.communicate(raw)
-        stdout = stdout.rstrip()
-        stderr = stderr.rstrip()
-        if stdout:
-            print(stdout)
-        if stderr:
-            print(stderr)
-
-    def _scp(self, src, dst):
-        args = ["scp", src, dst]
-        print("Running backup with: " + str(args))
-        p = subprocess.Popen(args, stdin = subprocess.PIPE, stderr = subprocess.PIPE, close_fds = True)
-        stdout, stderr = p.communicate(None)
-        stderr = stderr.rstrip()
-        if stderr:
-            print(stderr)
-            print("Scp Failed with arguments: " + str(args))
-            exit(1)
+        self.timings = False
+        self.output_format = output.TEXT
+        self.output_only = None
+        self.import_columns = None
+        self.import_key_column = "key"
+        self.use_agent = True
+        self.agent_socket = os.path.expanduser("~/.skrm/agent.sock")
+        self.agent_ttl = 900
+        self.parallel_search_threshold = 100000
+        self.rekey_recipient = None
+        self.rekey_from = None
+        self.rekey_journal = os.path.expanduser("~/.skrm/rekey.journal")
+        self.jobs = 8
+        self.load_user_prefs(user_pref_path)
+
+    def apply_pref(self, name, value):
+        if name == "import_columns":
+            self.import_columns = value.split(",")
+        elif name == "import_key_column":
+            self.import_key_column = value
+        elif name == "agent_socket":
+            self.agent_socket = os.path.expanduser(value)
+        elif name == "agent_ttl":
+            self.agent_ttl = int(value)
+        elif name == "rekey_journal":
+            self.rekey_journal = os.path.expanduser(value)
+        else:
+            return Vault.apply_pref(self, name, value)
+        return True
 
     def _backup(self, dst):
         print("Backup...")
-        self._scp(self.filename, dst)
+        failed = False
+        for destination, result in sorted(self.backup(dst).items()):
+            if isinstance(result, Exception):
+                failed = True
+                print(destination + ": Failed: " + str(result))
+            else:
+                print(destination + ": " + result)
+        if failed:
+            exit(1)
         print("DONE")
 
     def _restore(self, src):
         print("Restore...")
-        self._scp(src, self.filename)
+        try:
+            location = self.restore(src)
+        except BackupError as e:
+            for location, error in e.errors:
+                print(location + ": Failed: " + error)
+            print("Restore Failed, the local bdd file is left untouched.")
+            exit(1)
+        print("Restored from " + location)
         print("DONE")
 
-    def parse_raw(self, raw):
-        bdd = []
-        if raw:
-            keyrings = raw.split(b"\x03")
-            for keyring in keyrings:
-                bdd.append(keyring.split(b"\x02"))
-        return bdd
-
-    def parse_bdd(self, bdd):
-        raw = b""
-        bddLen = len(bdd)
-        for i, keyring in enumerate(bdd):
-            keyringLen = len(keyring)
-            for j, tag in enumerate(keyring):
-                if isinstance(tag, str):
-                    tag = bytes(tag, 'utf8')
-                raw += tag
-                if j < (keyringLen - 1):
-                    raw += b"\x02"
-            if i < (bddLen - 1):
-                raw += b"\x03"
-        return raw
-
-    def save_bdd(self, bdd):
-        raw = self.parse_bdd(bdd)
-        self._save_raw_bdd(raw)
-        if self.auto_backup:
-            self._backup(self.backup_location)
-
-    def get_fonctor(self, keyring, tag):
-        keyringLen = len(keyring)
-        for i, t in enumerate(keyring):
-            if i < (keyringLen - 1):
-                if tag.upper() == t.upper().decode('utf8'):
-                    return 1
-        return 0
-
-    def search_fonctor(self, keyring, tag):
-        keyringLen = len(keyring)
-        p = re.compile(tag.upper())
-        for i, t in enumerate(keyring):
-            if i < (keyringLen - 1):
-                if p.search(t.upper().decode('utf8')) != None:
-                    return 1
-        return 0
-
     def print_keyring(self, i, keyring):
         if self.clip == 0: # print the keyring
             print(i, end='')
             print(":", end='')
             print(keyring)
         else: # copy the keyring to the clipboard
+            import subprocess
             from sys import platform as _platform
             if _platform == "linux" or _platform == "linux2": # linux
                 # use klipper if on KDE
@@ -232,89 +271,275 @@ class KeyringManager:
             elif _platform == "win32": # Windows
                 print("Can't copy on clipboard under windows, method not implemented!")
 
-    def print_matching_keyrings(self, bdd, Functor):
+    def index_matches(self, bdd, lookup):
+        """ Return the (keyId, keyring) list of the selected keyring or of the keyrings whose ids are returned by lookup(tags) """
         if self.keyId >= 0:
-            print(self.keyId, end='')
-            print(":", end='')
-            print(bdd[self.keyId])
-        else:
-            for i, keyring in enumerate(bdd):
-                if len(self.tags) == 0:
-                    print(i, end='')
-                    print(":", end='')
-                    print(keyring)
-                else:
-                    foundAll = 1
-                    for tag in self.tags:
-                        if Functor(keyring, tag) == 0:
-                            foundAll = 0
-                    if foundAll == 1:
-                        self.print_keyring(i, keyring)
-
-    def command_get(self, bdd):
-        print("GET")
-        self.print_matching_keyrings(bdd, self.get_fonctor)
-
-    def command_search(self, bdd):
-        print("SEARCH")
-        self.print_matching_keyrings(bdd, self.search_fonctor)
-
-    def command_add(self, bdd):
-        newKeyring = self.tags
-        newKeyring.append(self.key)
-        bdd.append(newKeyring)
-        self.save_bdd(bdd)
-        print("Add DONE")
+            return [(self.keyId, bdd[self.keyId])]
+        return [(i, bdd[i]) for i in lookup(self.tags)]
+
+    def structured_output(self):
+        """ Whether matches are written in a format for scripts rather than printed for humans """
+        return (self.output_format != output.TEXT or self.output_only is not None) and self.clip == 0
+
+    def print_header(self, header):
+        if not self.structured_output():
+            print(header)
+
+    def print_matches(self, matches):
+        if self.structured_output():
+            sys.stdout.flush() # anything printed before goes first
+            writer = output.OutputWriter(getattr(sys.stdout, "buffer", sys.stdout), self.output_format, self.output_only)
+            for i, keyring in matches:
+                writer.write(i, keyring)
+            writer.flush()
+            return
+        for i, keyring in matches:
+            if self.keyId >= 0 or len(self.tags) == 0:
+                print(i, end='')
+                print(":", end='')
+                print(keyring)
+            else:
+                self.print_keyring(i, keyring)
+
+    def query_agent(self):
+        """ Return the matches computed by the running agent, or None if no agent answered """
+        if not self.use_agent or not os.path.exists(self.agent_socket): # before importing the agent client and json
+            return None
+        from . import agent
+        with self.tracer.span("agent_query") as span:
+            matches = agent.query(self.agent_socket, {"command": self.command,
+                                                      "file": os.path.abspath(self.filename),
+                                                      "tags": self.tags,
+                                                      "keyId": self.keyId,
+                                                      "limit": self.limit})
+            span.set(answered=matches is not None)
+        return matches
+
+    def print_traced_matches(self, matches):
+        with self.tracer.span("output", records=len(matches)):
+            self.print_matches(matches)
+
+    def traced_matches(self, lookup):
+        """ Return the selected keyring or the matches of lookup(tags, limit).
+        Both stream the bdd file and stop decrypting it early when it isn't open yet. """
+        with self.tracer.span("match", tags=len(self.tags)) as span:
+            if self.keyId >= 0:
+                matches = [self.by_id(self.keyId)]
+            else:
+                matches = lookup(self.tags, self.limit)
+            span.set(records=len(matches))
+        return matches
 
-    def command_remove(self, bdd):
-        if (self.keyId < 0 or self.keyId >= len(bdd)):
+    def command_get(self):
+        self.print_header("GET")
+        self.print_traced_matches(self.traced_matches(self.get))
+
+    def command_search(self):
+        self.print_header("SEARCH")
+        self.print_traced_matches(self.traced_matches(self.search))
+
+    def command_fuzzy(self):
+        self.print_header("FUZZY")
+        self.print_traced_matches(self.traced_matches(self.fuzzy))
+
+    def command_complete(self):
+        try:
+            suggestions = self.complete(self.prefix, self.tags)
+        except SkrmError:
+            return # a completion prints nothing rather than an error the shell would take for a tag
+        for tag in suggestions:
+            print(tag)
+
+    def command_agent_lookup(self, matches):
+        self.print_header(self.command.upper())
+        self.print_traced_matches(matches)
+
+    def _check_selected(self):
+        if (self.keyId < 0 or self.keyId >= len(self.bdd)):
             exit_with_usage(1, "Wrong argument, the given key id must be a valid number.")
+
+    def command_add(self):
+        self.add(self.tags, self.key)
+        self.commit()
+        print("Add DONE")
+
+    def command_remove(self):
+        self._check_selected()
         print("Removing: ", end='')
-        print(bdd[self.keyId])
-        del bdd[self.keyId];
-        self.save_bdd(bdd)
+        print(self.remove(self.keyId))
+        self.commit()
         print("Remove DONE")
 
-    def command_update(self, bdd):
-        if (self.keyId < 0 or self.keyId >= len(bdd)):
-            exit_with_usage(1, "Wrong argument, the given key id must be a valid number.")
-        bdd[self.keyId][len(bdd[self.keyId]) - 1] = self.key;
+    def command_update(self):
+        self._check_selected()
+        keyring = self.update(self.keyId, self.key)
         print("New keyring: ", end='')
-        print(bdd[self.keyId])
-        self.save_bdd(bdd)
+        print(keyring)
+        self.commit()
         print("Update DONE")
 
+    def command_migrate(self):
+        self.bdd_version = bdd_format.VERSION_2
+        self.save()
+        print("Migrate DONE")
+
+    def command_rekey(self):
+        from . import rekey
+        print("Rekey...")
+        def report(filename, status, detail):
+            print(filename + ": " + status + (" (" + detail + ")" if detail else ""))
+        counts = rekey.rekey(self.tags or [self.filename], self.rekey_recipient, self.rekey_from, self.passphrase,
+                             self.rekey_journal, self.jobs, report)
+        print("Rekey " + ("FAILED" if counts[rekey.FAILED] else "DONE") + ": " +
+              ", ".join(str(counts[status]) + " " + status for status in
+                        (rekey.REKEYED, rekey.DONE, rekey.SKIPPED, rekey.FAILED)))
+        if counts[rekey.FAILED]:
+            print("Run the same command again to resume with the files left.")
+            sys.exit(1)
+
+    def command_batch(self):
+        from .batch import BatchRunner
+        runner = BatchRunner(self, sys.stdout)
+        if self.batch_file == "-":
+            errors = runner.run(sys.stdin)
+        else:
+            with open(self.batch_file, "r") as f:
+                errors = runner.run(f)
+        self.commit()
+        if errors:
+            sys.exit(1)
+
+    def command_import(self):
+        from . import import_export
+        try:
+            count = import_export.import_records(self, self.transfer_file, self.import_columns,
+                                                 self.import_key_column, self.passphrase)
+        except (IOError, ValueError, SkrmError) as e:
+            exit_with_usage(1, "Import failed: " + str(e))
+        self.commit()
+        print("Import DONE: " + str(count) + " keyrings added")
+
+    def command_export(self):
+        from . import import_export
+        try:
+            import_export.export_records(self.bdd, self.transfer_file, self.recipient)
+        except (IOError, ValueError) as e:
+            exit_with_usage(1, "Export failed: " + str(e))
+        if self.transfer_file != "-":
+            print("Export DONE: " + str(len(self.bdd)) + " keyrings exported")
+
+    def command_shard(self):
+        from . import shards
+        try:
+            shard_set = shards.create(self, self.shard_directory, self.bdd)
+        except (IOError, OSError) as e:
+            exit_with_usage(1, "Shard failed: " + str(e))
+        print("Shard DONE: " + str(len(self.bdd)) + " keyrings in " + str(len(shard_set.shard_names())) + " shards")
+
+    def command_compact(self):
+        self.save()
+        print("Compact DONE")
+
     def command_backup(self):
+        self.compact_pending()
         self._backup(self.hostdest)
 
     def command_restore(self):
         self._restore(self.hostsrc)
 
+    def command_backup_status(self):
+        from . import backup
+        print(backup.format_status(self.filename))
+
     def command_quick_backup(self):
+        self.compact_pending()
         self._backup(self.backup_location)
 
     def command_quick_restore(self):
         self._restore(self.backup_location)
 
+    def command_agent(self):
+        from . import agent
+        agent.Agent(self.agent_socket, self.agent_ttl, self.load_bdd, self.match_request).serve()
+
+    def command_agent_stop(self):
+        from . import agent
+        if agent.query(self.agent_socket, {"command": "stop"}) is None:
+            print("No agent running on " + self.agent_socket)
+
+
+    def match_request(self, cached, request):
+        """ Compute the matches of an agent request against a cached bdd """
+        self.tags = request["tags"]
+        self.keyId = request["keyId"]
+        limit = request.get("limit")
+        if request["command"] == "search":
+            return self.index_matches(cached.bdd, cached.search_engine.search)[:limit]
+        if request["command"] == "fuzzy":
+            return self.index_matches(cached.bdd, lambda tags: cached.fuzzy_search().top(tags, limit))
+        return self.index_matches(cached.bdd, cached.index.get)[:limit]
+
     def run(self):
+        try:
+            with self.tracer.span("run", command=self.command):
+                self._run()
+        except SkrmError as e:
+            print("Error: " + str(e))
+            exit(1)
+        finally:
+            self.tracer.finish()
+
+    def _run(self):
         if self.command == "backup":
             self.command_backup()
         elif self.command == "restore":
             self.command_restore()
         elif self.command == "quick_backup":
             self.command_quick_backup()
+        elif self.command == "backup_status":
+            self.command_backup_status()
         elif self.command == "quick_restore":
             self.command_quick_restore()
+        elif self.command == "agent":
+            self.command_agent()
+        elif self.command == "agent_stop":
+            self.command_agent_stop()
+        elif self.command == "complete":
+            self.command_complete()
+        elif self.command == "rekey":
+            self.command_rekey()
         else:
-            raw_bdd = self.load_raw_bdd()
-            bdd = self.parse_raw(raw_bdd)
+            matches = None
+            if self.command in ("get", "search", "fuzzy"):
+                matches = self.query_agent()
+            if matches is not None:
+                self.command_agent_lookup(matches)
+                return
             if self.command == "get":
-                self.command_get(bdd)
-            elif self.command == "search":
-                self.command_search(bdd)
-            elif self.command == "add":
-                self.command_add(bdd)
+                self.command_get()
+                return
+            if self.command == "search":
+                self.command_search()
+                return
+            if self.command == "fuzzy":
+                self.command_fuzzy()
+                return
+            self.open()
+            if self.command == "add":
+                self.command_add()
             elif self.command == "remove":
-                self.command_remove(bdd)
+                self.command_remove()
             elif self.command == "update":
-                self.command_update(bdd)
+                self.command_update()
+            elif self.command == "migrate":
+                self.command_migrate()
+            elif self.command == "compact":
+                self.command_compact()
+            elif self.command == "shard":
+                self.command_shard()
+            elif self.command == "batch":
+                self.command_batch()
+            elif self.command == "import":
+                self.command_import()
+            elif self.command == "export":
+                self.command_export()
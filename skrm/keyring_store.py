@@ -0,0 +1,234 @@
+from array import array
+from collections.abc import MutableSequence
+
+from . import bdd_format
+from .tag_index import fold_tag
+
+
+# A KeyringStore holds the keyrings of a large bdd in a few flat arrays instead of a list of lists of bytes:
+# each distinct tag is stored once in a tag table along with its case-folded form, keyrings refer to their tags
+# by id, and keys are (offset, length) slices of the decrypted buffer they were parsed from.
+# Keys added or updated afterwards are appended to a separate buffer.
+# The keys of a v3 bdd are sealed in the decrypted buffer, they are only unsealed by key_opener when a keyring is built,
+# and matching on the tags never builds the keyrings it skips.
+# Indexing the store builds the keyring as a list of bytes, so that it can be used wherever a bdd list is.
+
+_RAW = 0
+_EXTRA = 1
+
+
+class KeyringStore(MutableSequence):
+    def __init__(self, raw=b""):
+        self.buffers = (raw, bytearray())
+        self.tags = []
+        self.folded = []
+        self._tag_ids = {}
+        self.tag_start = array("Q", [0]) # keyring i has the tags tag_ids[tag_start[i]:tag_start[i + 1]]
+        self.tag_ids = array("I")
+        self.key_buffer = array("B")
+        self.key_start = array("Q")
+        self.key_length = array("I")
+        self.key_opener = None # set when the keys of the raw buffer are sealed
+
+    def tag_id(self, tag):
+        """ Return the id of a tag, adding it to the tag table if it is new """
+        tag_id = self._tag_ids.get(tag)
+        if tag_id is None:
+            tag = bytes(tag)
+            tag_id = self._tag_ids[tag] = len(self.tags)
+            self.tags.append(tag)
+            self.folded.append(fold_tag(tag))
+        return tag_id
+
+    def _append(self, tag_ids, buffer, start, length):
+        self.tag_ids.extend(tag_ids)
+        self.tag_start.append(len(self.tag_ids))
+        self.key_buffer.append(buffer)
+        self.key_start.append(start)
+        self.key_length.append(length)
+
+    def _store_key(self, key):
+        extra = self.buffers[_EXTRA]
+        start = len(extra)
+        extra += bdd_format._to_bytes(key)
+        return start, len(extra) - start
+
+    def __len__(self):
+        return len(self.key_start)
+
+    def _check(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("keyring index out of range")
+        return i
+
+    def key(self, i):
+        i = self._check(i)
+        start = self.key_start[i]
+        key = bytes(self.buffers[self.key_buffer[i]][start:start + self.key_length[i]])
+        if self.key_opener is not None and self.key_buffer[i] == _RAW:
+            return self.key_opener(key)
+        return key
+
+    def sealed_key(self, i):
+        """ Return the key of keyring i as sealed in the raw buffer, or None if it isn't sealed """
+        if self.key_opener is None or self.key_buffer[i] != _RAW:
+            return None
+        start = self.key_start[i]
+        return bytes(self.buffers[_RAW][start:start + self.key_length[i]])
+
+    def tag_ids_of(self, i):
+        return self.tag_ids[self.tag_start[i]:self.tag_start[i + 1]]
+
+    def tags_of(self, i):
+        return [self.tags[tag_id] for tag_id in self.tag_ids_of(i)]
+
+    def iter_metadata(self):
+        """ Yield the keyrings with None instead of their key, to match them on their tags without unsealing any key """
+        tags, tag_ids, tag_start = self.tags, self.tag_ids, self.tag_start
+        for i in range(len(self)):
+            yield [tags[tag_id] for tag_id in tag_ids[tag_start[i]:tag_start[i + 1]]] + [None]
+
+    def folded_tags(self, i):
+        """ Return the case-folded tags of keyring i, without decoding them again """
+        return [self.folded[tag_id] for tag_id in self.tag_ids_of(i)]
+
+    def __iter__(self):
+        if self.key_opener is not None:
+            for i in range(len(self)):
+                yield self[i]
+            return
+        tags, tag_ids, tag_start = self.tags, self.tag_ids, self.tag_start
+        buffers, key_buffer, key_start, key_length = self.buffers, self.key_buffer, self.key_start, self.key_length
+        for i in range(len(key_start)):
+            keyring = [tags[tag_id] for tag_id in tag_ids[tag_start[i]:tag_start[i + 1]]]
+            start = key_start[i]
+            keyring.append(bytes(buffers[key_buffer[i]][start:start + key_length[i]]))
+            yield keyring
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = self._check(i)
+        return self.tags_of(i) + [self.key(i)]
+
+    def insert(self, i, keyring):
+        i = max(0, min(len(self), i + len(self) if i < 0 else i))
+        tag_ids = array("I", [self.tag_id(bdd_format._to_bytes(tag)) for tag in keyring[:-1]])
+        start, length = self._store_key(keyring[-1])
+        if i == len(self):
+            self._append(tag_ids, _EXTRA, start, length)
+            return
+        position = self.tag_start[i]
+        self.tag_ids[position:position] = tag_ids
+        self.tag_start.insert(i, position)
+        for j in range(i + 1, len(self.tag_start)):
+            self.tag_start[j] += len(tag_ids)
+        self.key_buffer.insert(i, _EXTRA)
+        self.key_start.insert(i, start)
+        self.key_length.insert(i, length)
+
+    def __setitem__(self, i, keyring):
+        i = self._check(i)
+        tag_ids = array("I", [self.tag_id(bdd_format._to_bytes(tag)) for tag in keyring[:-1]])
+        if tag_ids != self.tag_ids_of(i):
+            del self[i]
+            self.insert(i, keyring)
+            return
+        self.key_start[i], self.key_length[i] = self._store_key(keyring[-1])
+        self.key_buffer[i] = _EXTRA
+
+    def __delitem__(self, i):
+        i = self._check(i)
+        start, end = self.tag_start[i], self.tag_start[i + 1]
+        del self.tag_ids[start:end]
+        del self.tag_start[i]
+        for j in range(i, len(self.tag_start)):
+            self.tag_start[j] -= end - start
+        del self.key_buffer[i]
+        del self.key_start[i]
+        del self.key_length[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, KeyringStore)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _Builder:
+    """ Collect the columns of a store in lists while parsing, they are converted to arrays once at the end """
+    def __init__(self, raw):
+        self.store = KeyringStore(raw)
+        self.tag_start = [0]
+        self.tag_ids = []
+        self.key_start = []
+        self.key_length = []
+
+    def tag_ids_of(self, tags):
+        known = self.store._tag_ids
+        ids = []
+        for tag in tags:
+            tag_id = known.get(tag)
+            if tag_id is None:
+                tag_id = self.store.tag_id(tag)
+            ids.append(tag_id)
+        return ids
+
+    def finish(self):
+        store = self.store
+        store.tag_start = array("Q", self.tag_start)
+        store.tag_ids = array("I", self.tag_ids)
+        store.key_start = array("Q", self.key_start)
+        store.key_length = array("I", self.key_length)
+        store.key_buffer = array("B", bytes(len(self.key_start))) # every key is in the raw buffer
+        return store
+
+
+def _from_v1(raw):
+    builder = _Builder(raw)
+    if not raw:
+        return builder.finish()
+    tag_separator = bdd_format.TAG_SEPARATOR
+    start = 0
+    for record in raw.split(bdd_format.KEYRING_SEPARATOR):
+        key = record.rfind(tag_separator) + 1
+        if key:
+            builder.tag_ids.extend(builder.tag_ids_of(record[:key - 1].split(tag_separator)))
+        builder.tag_start.append(len(builder.tag_ids))
+        builder.key_start.append(start + key)
+        builder.key_length.append(len(record) - key)
+        start += len(record) + 1
+    return builder.finish()
+
+
+def _from_v2(raw):
+    reader = bdd_format.V2Reader(raw) # validates the header and the offset table
+    builder = _Builder(raw)
+    view = reader.view
+    for i in range(len(reader)):
+        fields = reader.field_offsets(i)
+        if not fields:
+            raise ValueError("Corrupted bdd: empty record " + str(i) + ".")
+        key_start, key_length = fields.pop()
+        # tags are looked up in the tag table through views of the buffer, only new tags are copied
+        builder.tag_ids.extend(builder.tag_ids_of([view[start:start + length] for start, length in fields]))
+        builder.tag_start.append(len(builder.tag_ids))
+        builder.key_start.append(key_start)
+        builder.key_length.append(key_length)
+    return builder.finish()
+
+
+def parse(raw):
+    """ Parse a decrypted bdd of any version into a KeyringStore """
+    raw = bytes(raw)
+    if bdd_format.detect_version(raw) in bdd_format.RECORD_VERSIONS:
+        return _from_v2(raw)
+    return _from_v1(raw)
@@ -0,0 +1,56 @@
+import os
+
+try:
+    import fcntl
+except ImportError: # no file locks, concurrent commands are not protected from each other
+    fcntl = None
+
+
+class FileLock:
+    """ flock on the given path, shared or exclusive, a no-op where file locks are not available """
+    def __init__(self, path, shared=False, blocking=True):
+        self.path = path
+        self.shared = shared
+        self.blocking = blocking
+        self.f = None
+
+    def acquire(self):
+        if fcntl is None:
+            return True
+        self.f = open(self.path, "a")
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.f, mode | (0 if self.blocking else fcntl.LOCK_NB))
+        except (IOError, OSError):
+            self.f.close()
+            self.f = None
+            return False
+        return True
+
+    def release(self):
+        if self.f is None:
+            return
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def fsync_directory(path):
+    """ Make a rename in the directory durable, where directories can be opened """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
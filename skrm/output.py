@@ -0,0 +1,93 @@
+import io
+
+from . import bdd_format
+
+
+# Matches are printed as text for humans, or in a format for scripts, chosen by --format:
+#   json: one object per line, like the exported ones: {"id": 0, "tags": ["tag1", "tag2"], "key": "pass"}
+#   tsv: one line per keyring: id, tags and key separated by tabs. Backslashes, tabs and newlines in the fields
+#        are written \\, \t and \n.
+#   null: every field is terminated by a NUL byte: id, number of tags, tags and key, so that any tag or key can be read back.
+# --only=keys or --only=ids writes the key or the id of each keyring alone: on a line for json and tsv, with strings
+# quoted in json, and NUL terminated for null.
+# The records are written to a buffer which is flushed into the binary stdout once it holds CHUNK_SIZE bytes,
+# and at the end of the command, rather than writing each field.
+
+TEXT = "text"
+JSON = "json"
+TSV = "tsv"
+NULL = "null"
+FORMATS = [TEXT, JSON, TSV, NULL]
+KEYS = "keys"
+IDS = "ids"
+ONLY = [KEYS, IDS]
+CHUNK_SIZE = 64 * 1024
+
+_TSV_ESCAPES = [(b"\\", b"\\\\"), (b"\t", b"\\t"), (b"\n", b"\\n"), (b"\r", b"\\r")]
+
+
+def _tsv_field(field):
+    field = bdd_format._to_bytes(field)
+    for char, escape in _TSV_ESCAPES:
+        if char in field:
+            field = field.replace(char, escape)
+    return field
+
+
+class OutputWriter:
+    """ Write matches to a stream in one of FORMATS, possibly only their key or id, through a buffer """
+    def __init__(self, stream, format=TEXT, only=None, chunk_size=CHUNK_SIZE):
+        if format not in FORMATS:
+            raise ValueError("Unknown output format " + format + ", use one of " + ", ".join(FORMATS) + ".")
+        if only is not None and only not in ONLY:
+            raise ValueError("Unknown output field " + only + ", use one of " + ", ".join(ONLY) + ".")
+        self.stream = stream
+        self.format = format
+        self.only = only
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.size = 0
+        if format == JSON:
+            import json
+            self._dumps = json.dumps
+
+    def record(self, i, keyring):
+        """ Return the bytes written for the keyring of id i """
+        if self.only == IDS:
+            return b"%d\x00" % i if self.format == NULL else b"%d\n" % i
+        if self.format == JSON:
+            keyring = bdd_format.keyring_to_text(keyring)
+            if self.only == KEYS:
+                return (self._dumps(keyring[-1]) + "\n").encode("utf8")
+            return (self._dumps({"id": i, "tags": keyring[:-1], "key": keyring[-1]}) + "\n").encode("utf8")
+        if self.format == NULL:
+            if self.only == KEYS:
+                return bdd_format._to_bytes(keyring[-1]) + b"\x00"
+            fields = [b"%d" % i, b"%d" % (len(keyring) - 1)] + [bdd_format._to_bytes(field) for field in keyring]
+            return b"\x00".join(fields) + b"\x00"
+        if self.only == KEYS: # tsv, and text which only prints whole keyrings otherwise
+            return _tsv_field(keyring[-1]) + b"\n"
+        line = b"\t".join([b"%d" % i] + [bdd_format._to_bytes(field) for field in keyring])
+        # most keyrings have nothing to escape, which a single scan of the line tells
+        if line.count(b"\t") != len(keyring) or b"\\" in line or b"\n" in line or b"\r" in line:
+            line = b"\t".join([b"%d" % i] + [_tsv_field(field) for field in keyring])
+        return line + b"\n"
+
+    def write(self, i, keyring):
+        data = self.record(i, keyring)
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.chunks:
+            return
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        if isinstance(self.stream, io.TextIOBase): # stdout replaced by a text stream
+            self.stream.write(data.decode("utf8", "surrogateescape"))
+        else:
+            self.stream.write(data)
+        self.stream.flush()
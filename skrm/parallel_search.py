@@ -0,0 +1,101 @@
+import re
+import struct
+
+from . import bdd_format
+from .tag_index import fold_tag
+
+
+# A search of a large bdd file which isn't open yet is matched in parallel on the decrypted buffer, rather than parsing
+# it into a KeyringStore and indexing its tags in a single process. The buffer is copied once into a shared memory
+# block, and the records are split into contiguous ranges of ids, each one matched by a worker of a process pool which
+# reads its records from the shared memory, so that no record is pickled. Workers return the ids they matched, and the
+# ranges are concatenated in order, giving the ids in order. Only the v2 layout (and v3, the keys being skipped) can be
+# split this way, the offset table giving where each range starts.
+# It is used when the bdd holds at least parallel_search_threshold records, the records being matched in the process
+# itself when there is a single worker, which still spares parsing and indexing the whole bdd.
+
+CHUNKS_PER_WORKER = 4
+
+
+def record_count(raw):
+    """ Return the number of records of a decrypted v2 bdd """
+    return bdd_format._HEADER.unpack_from(raw, 0)[2]
+
+
+def _match_range(name, size, start, end, patterns):
+    """ Return the ids in [start, end) of the records of the bdd of the given size, held by the shared memory block name,
+    having a tag matching each pattern """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name)
+    try:
+        return match_records(shm.buf, size, start, end, patterns)
+    finally:
+        shm.close()
+
+
+def match_records(buf, size, start, end, patterns):
+    """ Return the ids in [start, end) of the records of the decrypted v2 bdd of the given size held by buf
+    having a tag matching each pattern """
+    regexes = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    every = (1 << len(regexes)) - 1
+    masks = {} # patterns matched by each distinct tag, as a bit mask
+    unpack = bdd_format._UINT.unpack_from
+    uint_size = bdd_format._UINT.size
+    count = record_count(buf)
+    records_start = bdd_format._HEADER.size + bdd_format._OFFSET.size * count
+    pos = records_start + bdd_format._OFFSET.unpack_from(buf, bdd_format._HEADER.size + bdd_format._OFFSET.size * start)[0]
+    ids = []
+    for i in range(start, end):
+        try:
+            field_count, = unpack(buf, pos)
+            pos += uint_size
+            matched = 0
+            for _ in range(field_count - 1): # the last field is the key
+                length, = unpack(buf, pos)
+                pos += uint_size
+                tag = bytes(buf[pos:pos + length])
+                pos += length
+                mask = masks.get(tag)
+                if mask is None:
+                    folded = fold_tag(tag)
+                    mask = 0
+                    for bit, regex in enumerate(regexes):
+                        if regex.search(folded) is not None:
+                            mask |= 1 << bit
+                    masks[tag] = mask
+                matched |= mask
+            length, = unpack(buf, pos)
+            pos += uint_size + length
+        except struct.error:
+            raise ValueError("Corrupted bdd: truncated record " + str(i) + ".")
+        if pos > size:
+            raise ValueError("Corrupted bdd: truncated record " + str(i) + ".")
+        if matched == every:
+            ids.append(i)
+    return ids
+
+
+def search(raw, patterns, workers):
+    """ Return the ids of the records of a decrypted v2 bdd having a tag matching each regex pattern, case-insensitively,
+    in order, matched by a pool of processes """
+    from multiprocessing import shared_memory
+    from concurrent.futures import ProcessPoolExecutor
+    count = record_count(raw)
+    if not patterns:
+        return list(range(count))
+    if workers <= 1:
+        return match_records(raw, len(raw), 0, count, patterns)
+    for pattern in patterns:
+        re.compile(pattern) # an invalid pattern raises here rather than in every worker
+    chunks = min(count, workers * CHUNKS_PER_WORKER) or 1
+    bounds = [count * k // chunks for k in range(chunks + 1)]
+    shm = shared_memory.SharedMemory(create=True, size=max(len(raw), 1))
+    try:
+        shm.buf[:len(raw)] = raw
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            ranges = executor.map(_match_range, [shm.name] * chunks, [len(raw)] * chunks, bounds[:-1], bounds[1:],
+                                  [patterns] * chunks)
+            return [i for ids in ranges for i in ids]
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,214 @@
+import os
+import json
+import glob
+import hashlib
+import tempfile
+
+from . import bdd_format
+from . import changelog
+from . import crypto
+from .shards import MANIFEST, is_sharded, list_files
+from .vault import Vault, SkrmError
+from .locking import fsync_directory
+
+
+# --rekey re-encrypts vaults for new recipients: bdd files and sharded vault directories, named by paths or globs.
+# Each vault is rekeyed by a worker of a process pool, holding the lock of the vault while it rewrites its files.
+# A file keeps the encryption it was written with. An envelope vault gets a new data key, its sealed keys being
+# sealed again under it. A bdd file is rewritten along with its change log segments, which are folded into it.
+# Every file is encrypted into a temporary file, which is verified before being renamed over the file:
+# it must be encrypted for every new recipient and for none of the old ones, and decrypt to the content written.
+# The verification needs the secret key of one of the new recipients.
+# With old recipients, files which aren't encrypted for any of them are skipped, rekeyed files thus being skipped
+# by a run started again. A journal records the vaults rekeyed, with a digest of their files, so that an interrupted
+# run resumes with the vaults left. The journal is removed once every vault is rekeyed.
+
+REKEYED = "rekeyed"
+SKIPPED = "skipped"
+FAILED = "failed"
+DONE = "already rekeyed"
+MAX_WORKERS = 8
+
+
+def _is_vault(path):
+    if is_sharded(path):
+        return os.path.exists(os.path.join(path, MANIFEST))
+    return path.endswith(".gpg") and os.path.isfile(path)
+
+
+def expand(patterns):
+    """ Return the vaults named by the given paths and globs, once each, in order.
+    Globs only match .gpg files and sharded vault directories, not the files skrm writes next to a bdd file. """
+    vaults = []
+    seen = set()
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        if glob.has_magic(pattern):
+            paths = [path for path in sorted(glob.glob(pattern)) if _is_vault(path)]
+        else:
+            paths = [pattern.rstrip(os.sep) or pattern]
+        for path in paths:
+            if os.path.abspath(path) not in seen:
+                seen.add(os.path.abspath(path))
+                vaults.append(path)
+    return vaults
+
+
+def vault_files(path):
+    """ Return the encrypted files of a vault, its change log segments aside """
+    if is_sharded(path):
+        return list_files(path)
+    return [path]
+
+
+def vault_digest(path):
+    """ Identify the content of every file of a vault """
+    h = hashlib.sha256()
+    files = vault_files(path) if os.path.exists(path) else []
+    for filename in files + ([] if is_sharded(path) else changelog.list_segments(path)):
+        h.update(os.path.basename(filename).encode("utf8") + b"\x00")
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def read_journal(path, recipient):
+    """ Return the digest of each vault the journal records as rekeyed for the recipient """
+    done = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # the last line of an interrupted run may be partly written
+                    continue
+                if entry.get("recipient") == recipient:
+                    done[entry["vault"]] = entry["digest"]
+    except IOError:
+        pass
+    return done
+
+
+def append_journal(path, entry):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    with open(path, "a") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def verify(filename, raw, recipient_ids, old_ids=None, passphrase=""):
+    """ Return why the rekeyed file isn't raw encrypted for the new recipients only, or None """
+    verifier = Vault(filename, passphrase=passphrase)
+    backend = verifier._file_backend(filename)
+    key_ids = backend.encrypted_for(filename)
+    for name, ids in sorted(recipient_ids.items()):
+        if not key_ids & ids:
+            return "not encrypted for " + name
+    new_ids = set().union(*recipient_ids.values())
+    if old_ids and key_ids & (old_ids - new_ids):
+        return "still encrypted for the old recipients"
+    content, error = backend.decrypt(filename)
+    if error is not None:
+        return error
+    if content != raw:
+        return "doesn't decrypt to the content written"
+    return None
+
+
+def _rekey_file(reader, writer, filename, recipient_ids, old_ids):
+    source = reader._file_backend(filename)
+    if old_ids is not None and not source.encrypted_for(filename) & old_ids:
+        return filename, SKIPPED, "not encrypted for the old recipients"
+    segments = [] if is_sharded(reader.filename) else changelog.list_segments(filename)
+    if segments:
+        bdd = reader.load_bdd(filename)
+    else:
+        raw = reader.load_raw_bdd(filename)
+        bdd = reader.parse_raw(raw) if bdd_format.detect_version(raw) == bdd_format.VERSION_3 else None
+    if bdd is not None: # keys are sealed again under the new data key, the file format version being kept
+        writer.bdd_version = reader.bdd_version
+        raw = writer.parse_bdd(list(bdd))
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".skrm-")
+    os.close(fd)
+    try:
+        writer.crypto_backend(source.name).encrypt(raw, filename, tmp)
+        error = verify(tmp, raw, recipient_ids, old_ids, reader.passphrase)
+        if error is not None:
+            return filename, FAILED, "verification failed, the file is left untouched: " + error
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+        fsync_directory(directory)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if segments:
+        changelog.clear_segments(filename)
+        return filename, REKEYED, source.name + ", " + str(len(segments)) + " change log segments folded"
+    return filename, REKEYED, source.name
+
+
+def rekey_vault(path, recipient, recipient_ids, old_ids=None, passphrase=""):
+    """ Re-encrypt every file of a vault for recipient, under the lock of the vault.
+    Return the (file, status, detail) of each file and the digest of the vault once rekeyed. """
+    if not os.path.exists(path):
+        return [(path, FAILED, "no such file or directory")], None
+    reader = Vault(path, passphrase=passphrase)
+    writer = Vault(path, recipient=recipient, passphrase=passphrase)
+    results = []
+    with reader.locked():
+        for filename in vault_files(path):
+            try:
+                results.append(_rekey_file(reader, writer, filename, recipient_ids, old_ids))
+            except (SkrmError, IOError, OSError, ValueError) as e:
+                results.append((filename, FAILED, str(e)))
+        return results, vault_digest(path)
+
+
+def rekey(patterns, recipient, old_recipient=None, passphrase="", journal=None, max_workers=MAX_WORKERS, report=None):
+    """ Rekey the vaults named by patterns for the comma separated recipients, max_workers vaults at a time.
+    report(filename, status, detail) is called for each file as its vault is done.
+    Return the number of files of each status. """
+    vaults = expand(patterns)
+    gpg = Vault(None, passphrase=passphrase).crypto_backend(crypto.GPG)
+    recipient_ids = dict((name, gpg.key_ids(name)) for name in crypto.recipients(recipient))
+    if not recipient_ids:
+        raise SkrmError("No recipient to rekey for.")
+    old_ids = None
+    if old_recipient:
+        old_ids = set().union(*[gpg.key_ids(name) for name in crypto.recipients(old_recipient)])
+    counts = dict((status, 0) for status in (REKEYED, SKIPPED, FAILED, DONE))
+
+    def done(path, results, digest):
+        for filename, status, detail in results:
+            counts[status] += 1
+            if report is not None:
+                report(filename, status, detail)
+        if journal and digest is not None and not [r for r in results if r[1] == FAILED]:
+            append_journal(journal, {"vault": os.path.abspath(path), "recipient": recipient, "digest": digest})
+
+    rekeyed = read_journal(journal, recipient) if journal else {}
+    pending = []
+    for path in vaults:
+        if os.path.exists(path) and rekeyed.get(os.path.abspath(path)) == vault_digest(path):
+            done(path, [(path, DONE, "")], None)
+        else:
+            pending.append(path)
+    args = (recipient, recipient_ids, old_ids, passphrase)
+    if max_workers <= 1 or len(pending) <= 1:
+        for path in pending:
+            done(path, *rekey_vault(path, *args))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            futures = dict((executor.submit(rekey_vault, path, *args), path) for path in pending)
+            for future in as_completed(futures):
+                done(futures[future], *future.result())
+    if journal and not counts[FAILED] and os.path.exists(journal):
+        os.remove(journal)
+    return counts
@@ -0,0 +1,167 @@
+import re
+
+from .tag_index import fold_tag
+
+_FLAGS_GROUP = re.compile(r"\(\?[aiLmsux-]")
+_QUANTIFIER = re.compile(r"\{\d*(,\d*)?\}")
+
+
+def _skip_class(pattern, i):
+    """ Return the index following the character class starting at pattern[i] """
+    i += 1
+    if i < len(pattern) and pattern[i] == "^":
+        i += 1
+    if i < len(pattern) and pattern[i] == "]":
+        i += 1
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
+    return i + 1
+
+
+def _skip_group(pattern, i):
+    """ Return the index following the group starting at pattern[i] """
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "[":
+            i = _skip_class(pattern, i)
+            continue
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def required_literals(pattern):
+    """ Return literal substrings that any match of the pattern must contain.
+    Only the top level sequence of the pattern is considered, and an empty list is returned whenever it can't be proven. """
+    if _FLAGS_GROUP.search(pattern):
+        return []
+    literals = []
+    current = []
+
+    def flush():
+        if current:
+            literals.append("".join(current))
+            del current[:]
+
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 >= n:
+                return []
+            char = None if pattern[i + 1].isalnum() else pattern[i + 1]
+            i += 2
+        elif c == "[":
+            char = None
+            i = _skip_class(pattern, i)
+        elif c == "(":
+            char = None
+            i = _skip_group(pattern, i)
+        elif c == "|":
+            return []
+        elif c in ".^$":
+            char = None
+            i += 1
+        elif c in "*+?{)":
+            return []
+        else:
+            char = c
+            i += 1
+
+        if i < n and pattern[i] in "*?{":
+            if pattern[i] == "{":
+                quantifier = _QUANTIFIER.match(pattern, i)
+                if quantifier is None:
+                    return []
+                i = quantifier.end()
+            else:
+                i += 1
+            flush() # the previous item is optional or repeated, the literal run stops before it
+        elif i < n and pattern[i] == "+":
+            if char is not None:
+                current.append(char)
+            flush()
+            i += 1
+        elif char is None:
+            flush()
+        else:
+            current.append(char)
+            continue
+        if i < n and pattern[i] in "?+":
+            i += 1
+    flush()
+    return literals
+
+
+def patterns_matcher(patterns):
+    """ Return a predicate telling whether a keyring has a tag matching each pattern, for searches without an index """
+    regexes = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+
+    def matcher(keyring):
+        tags = [fold_tag(keyring[j]) for j in range(len(keyring) - 1)]
+        return all(any(regex.search(tag) is not None for tag in tags) for regex in regexes)
+    return matcher
+
+
+class SearchEngine:
+    """ Regex search over the distinct tags of a TagIndex.
+    Each pattern is compiled once, and only the tags containing its required literals are matched against it. """
+    def __init__(self, index):
+        self.index = index
+        self.vocabulary = [(tag, tag.isascii()) for tag in index.vocabulary()]
+
+    def update(self, added, removed):
+        """ Follow the tags added to and removed from the vocabulary of the index """
+        if removed:
+            removed = set(removed)
+            self.vocabulary = [entry for entry in self.vocabulary if entry[0] not in removed]
+        self.vocabulary.extend((tag, tag.isascii()) for tag in added)
+
+    def matching_tags(self, pattern):
+        """ Return the distinct case-folded tags matching the pattern """
+        regex = re.compile(pattern, re.IGNORECASE)
+        literals = [literal.upper() for literal in required_literals(pattern) if literal.isascii()]
+        if len(literals) == 1 and literals[0] == pattern.upper():
+            # a plain literal pattern, the substring test is the match on ascii tags
+            literal = literals[0]
+            return [tag for tag, is_ascii in self.vocabulary
+                    if (literal in tag if is_ascii else regex.search(tag) is not None)]
+        matches = []
+        for tag, is_ascii in self.vocabulary:
+            if is_ascii and not all(literal in tag for literal in literals):
+                continue
+            if regex.search(tag) is not None:
+                matches.append(tag)
+        return matches
+
+    def ids_for_pattern(self, pattern):
+        ids = set()
+        for tag in self.matching_tags(pattern):
+            ids.update(self.index.ids_for_tag(tag))
+        return sorted(ids)
+
+    def search(self, patterns):
+        """ Return the sorted ids of the keyrings having a tag matching each pattern """
+        if not patterns:
+            return list(range(self.index.size))
+        ids = None
+        for pattern in patterns:
+            pattern_ids = self.ids_for_pattern(pattern)
+            if ids is None:
+                ids = pattern_ids
+            else:
+                allowed = set(pattern_ids)
+                ids = [i for i in ids if i in allowed]
+            if not ids:
+                break
+        return ids
@@ -0,0 +1,203 @@
+import os
+import zlib
+from bisect import bisect_left, bisect_right
+
+from .tag_index import TagIndex, fold_tag
+from .keyring_store import KeyringStore
+
+
+# A sharded vault is a directory of bdd files, the shards, along with an encrypted manifest.
+# The manifest records the tags held by each shard, so that a get only decrypts the shards holding all its tags,
+# and a search only the shards having a tag matching each of its patterns.
+# A keyring goes to the shard of the first of its tags listed in shard_tags (an environment or a team for instance),
+# or else to one of shard_count shards chosen by a hash of its tags.
+# Keyring ids are global: the shards are concatenated in the order of their names. A keyring added goes to the end
+# of its shard, so that the ids of the keyrings of the following shards are shifted by one, like the ids following
+# a keyring removed.
+# Shards are decrypted concurrently, each by its own gpg process, and a write only re-encrypts the shards it touches.
+
+MANIFEST = "manifest.gpg"
+MAX_WORKERS = 8
+
+
+def is_sharded(filename):
+    return os.path.isdir(filename)
+
+
+def list_files(directory):
+    """ Return the encrypted files of a sharded vault, the manifest first """
+    names = sorted(name for name in os.listdir(directory) if name.endswith(".gpg") and name != MANIFEST)
+    return [os.path.join(directory, name) for name in [MANIFEST] + names
+            if os.path.exists(os.path.join(directory, name))]
+
+
+class ShardSet:
+    """ The shards of a sharded vault, decrypted and encrypted through the vault gpg methods """
+    def __init__(self, vault, directory):
+        self.vault = vault
+        self.directory = directory
+        self.manifest = None
+        self.names = None # shard name of each keyring of the loaded bdd
+        self.dirty = set()
+
+    def manifest_path(self):
+        return os.path.join(self.directory, MANIFEST)
+
+    def shard_path(self, name):
+        return os.path.join(self.directory, name + ".gpg")
+
+    def load_manifest(self):
+        if self.manifest is None:
+            import json
+            raw = self.vault.load_raw_bdd(self.manifest_path())
+            if raw:
+                self.manifest = json.loads(raw.decode("utf8"))
+            else:
+                self.manifest = {"shard_tags": [fold_tag(tag) for tag in self.vault.shard_tags],
+                                 "shard_count": self.vault.shard_count, "routes": {}, "shards": {}}
+        return self.manifest
+
+    def _save_manifest(self):
+        import json
+        self.vault._save_raw_bdd(json.dumps(self.manifest, sort_keys=True).encode("utf8"), self.manifest_path())
+
+    def shard_names(self):
+        return sorted(self.load_manifest()["shards"])
+
+    def offsets(self):
+        """ Return the id of the first keyring of each shard """
+        offsets = {}
+        offset = 0
+        for name in self.shard_names():
+            offsets[name] = offset
+            offset += self.manifest["shards"][name]["count"]
+        return offsets
+
+    def assign(self, keyring):
+        """ Return the name of the shard the keyring belongs to """
+        manifest = self.load_manifest()
+        tags = [fold_tag(keyring[j]) for j in range(len(keyring) - 1)]
+        for tag in tags:
+            if tag in manifest["shard_tags"]:
+                if tag not in manifest["routes"]:
+                    manifest["routes"][tag] = "tag-%03d" % len(manifest["routes"])
+                return manifest["routes"][tag]
+        digest = zlib.crc32("\x00".join(sorted(tags)).encode("utf8", "surrogateescape"))
+        return "hash-%03d" % (digest % manifest["shard_count"])
+
+    def _decrypt_shards(self, names):
+        """ Return the parsed bdd of each given shard, decrypting them concurrently """
+        if not names:
+            return {}
+        from concurrent.futures import ThreadPoolExecutor
+        with self.vault.tracer.span("shards_decrypt", shards=len(names)):
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(names))) as executor:
+                raws = list(executor.map(lambda name: self.vault.load_raw_bdd(self.shard_path(name)), names))
+        return dict((name, self.vault.parse_raw(raw)) for name, raw in zip(names, raws))
+
+    def load(self):
+        """ Decrypt every shard and return their concatenation """
+        names = self.shard_names()
+        shards = self._decrypt_shards(names)
+        bdd = KeyringStore()
+        self.names = []
+        for name in names:
+            bdd.extend(shards[name])
+            self.names.extend([name] * len(shards[name]))
+        return bdd
+
+    def _shards_with_tag(self, folded_tag):
+        return set(name for name, shard in self.load_manifest()["shards"].items() if folded_tag in shard["tags"])
+
+    def _lookup(self, candidates, lookup):
+        """ Decrypt the candidate shards and return the (id, keyring) of the keyrings lookup(index) returns """
+        offsets = self.offsets()
+        names = sorted(candidates)
+        shards = self._decrypt_shards(names)
+        matches = []
+        for name in names:
+            for i in lookup(TagIndex(shards[name])):
+                matches.append((offsets[name] + i, shards[name][i]))
+        return matches
+
+    def get(self, tags):
+        candidates = set(self.shard_names())
+        for tag in tags:
+            candidates &= self._shards_with_tag(fold_tag(tag))
+        return self._lookup(candidates, lambda index: index.get(tags))
+
+    def search(self, patterns):
+        from .search_engine import SearchEngine
+        candidates = set(self.shard_names())
+        for pattern in patterns:
+            matching = set()
+            for name, shard in self.manifest["shards"].items():
+                if SearchEngine(_Vocabulary(shard["tags"])).matching_tags(pattern):
+                    matching.add(name)
+            candidates &= matching
+        return self._lookup(candidates, lambda index: SearchEngine(index).search(patterns))
+
+    def by_id(self, keyId):
+        """ Return the keyring of the given id decrypting only its shard, or None if there is none """
+        for name, offset in sorted(self.offsets().items(), key=lambda item: item[1]):
+            if offset <= keyId < offset + self.manifest["shards"][name]["count"]:
+                return self._decrypt_shards([name])[name][keyId - offset]
+        return None
+
+    def add(self, keyring):
+        """ Record a keyring added to the loaded bdd, return the id it must be inserted at,
+        after the last keyring of its shard: the keyrings of the following shards are renumbered """
+        name = self.assign(keyring)
+        i = bisect_right(self.names, name)
+        self.names.insert(i, name)
+        self.dirty.add(name)
+        return i
+
+    def update(self, keyId):
+        self.dirty.add(self.names[keyId])
+
+    def remove(self, keyId):
+        self.dirty.add(self.names.pop(keyId))
+
+    def save(self, bdd, everything=False):
+        """ Encrypt the modified shards of the loaded bdd, or every shard, and the manifest if it changed """
+        import json
+        manifest = self.load_manifest()
+        if everything:
+            self.dirty.update(self.names)
+            self.dirty.update(manifest["shards"])
+        before = json.dumps(manifest, sort_keys=True)
+        for name in sorted(self.dirty):
+            records = bdd[bisect_left(self.names, name):bisect_right(self.names, name)]
+            if records:
+                self.vault._save_raw_bdd(self.vault.parse_bdd(records), self.shard_path(name))
+                manifest["shards"][name] = {"count": len(records), "tags": sorted(TagIndex(records).vocabulary())}
+            else:
+                if os.path.exists(self.shard_path(name)):
+                    os.remove(self.shard_path(name))
+                manifest["shards"].pop(name, None)
+        self.dirty = set()
+        if everything or json.dumps(manifest, sort_keys=True) != before:
+            self._save_manifest()
+
+
+class _Vocabulary:
+    """ The vocabulary of a shard as recorded in the manifest, for the SearchEngine to match patterns against """
+    def __init__(self, tags):
+        self.tags = tags
+
+    def vocabulary(self):
+        return self.tags
+
+
+def create(vault, directory, bdd):
+    """ Write bdd as a new sharded vault in directory, using the sharding settings of the vault """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.listdir(directory):
+        raise IOError("The directory " + directory + " is not empty.")
+    shards = ShardSet(vault, directory)
+    assigned = sorted((shards.assign(keyring), i) for i, keyring in enumerate(bdd))
+    shards.names = [name for name, i in assigned]
+    shards.save([bdd[i] for name, i in assigned], everything=True)
+    return shards
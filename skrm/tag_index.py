@@ -0,0 +1,98 @@
+from bisect import bisect_left, insort
+
+
+def fold_tag(tag):
+    """ Return the case-folded form used to compare tags. Stored tags are bytes, tags given by the user are str. """
+    if isinstance(tag, bytes):
+        tag = tag.decode("utf8", "surrogateescape")
+    return tag.upper()
+
+
+def tags_matcher(tags):
+    """ Return a predicate telling whether a keyring holds every given tag, for lookups without an index """
+    folded = set(fold_tag(tag) for tag in tags)
+
+    def matcher(keyring):
+        return folded.issubset([fold_tag(keyring[j]) for j in range(len(keyring) - 1)])
+    return matcher
+
+
+def _contains(ids, i):
+    j = bisect_left(ids, i)
+    return j < len(ids) and ids[j] == i
+
+
+class TagIndex:
+    """ Inverted index mapping each case-folded tag to the sorted list of ids of the keyrings holding it.
+    The last element of a keyring is its key and is not indexed. """
+    def __init__(self, bdd):
+        self.size = len(bdd)
+        self.ids = {}
+        folded_tags = getattr(bdd, "folded_tags", None) # a KeyringStore already holds the folded tags
+        for i in range(self.size):
+            if folded_tags is None:
+                keyring = bdd[i]
+                tags = [fold_tag(keyring[j]) for j in range(len(keyring) - 1)]
+            else:
+                tags = folded_tags(i)
+            for tag in tags:
+                ids = self.ids.setdefault(tag, [])
+                if not ids or ids[-1] != i:
+                    ids.append(i)
+
+    def _shift(self, start, delta):
+        for ids in self.ids.values():
+            for j in range(bisect_left(ids, start), len(ids)):
+                ids[j] += delta
+
+    def insert(self, i, tags):
+        """ Index the tags of a keyring inserted at id i, the following ids being shifted.
+        Return the case-folded tags new to the vocabulary. """
+        if i < self.size:
+            self._shift(i, 1)
+        self.size += 1
+        added = []
+        for tag in dict.fromkeys(fold_tag(tag) for tag in tags):
+            ids = self.ids.get(tag)
+            if ids is None:
+                ids = self.ids[tag] = []
+                added.append(tag)
+            insort(ids, i)
+        return added
+
+    def remove(self, i, tags):
+        """ Drop the tags of the keyring of id i, the following ids being shifted.
+        Return the case-folded tags no keyring holds anymore. """
+        removed = []
+        for tag in dict.fromkeys(fold_tag(tag) for tag in tags):
+            ids = self.ids[tag]
+            del ids[bisect_left(ids, i)]
+            if not ids:
+                del self.ids[tag]
+                removed.append(tag)
+        self.size -= 1
+        self._shift(i, -1)
+        return removed
+
+    def vocabulary(self):
+        """ Return the distinct case-folded tags """
+        return self.ids.keys()
+
+    def ids_for_tag(self, folded_tag):
+        return self.ids.get(folded_tag, [])
+
+    def get(self, tags):
+        """ Return the sorted ids of the keyrings holding every given tag """
+        if not tags:
+            return list(range(self.size))
+        return intersect([self.ids_for_tag(fold_tag(tag)) for tag in tags])
+
+
+def intersect(id_lists):
+    """ Intersect sorted id lists, walking the smallest one and looking its ids up in the others """
+    id_lists = sorted(id_lists, key=len)
+    smallest = id_lists[0]
+    others = id_lists[1:]
+    if not others:
+        return list(smallest)
+    return [i for i in smallest if all(_contains(ids, i) for ids in others)]
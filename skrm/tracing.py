@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+
+
+# Phases of a command are recorded as spans holding their wall time, their cpu time, the cpu time of the
+# subprocesses (gpg, scp) they waited for, and attributes like byte and record counts.
+# --timings prints a summary of the spans to stderr, and SKRM_TRACE=file appends them to file as JSON lines.
+# When neither is set, the NULL_TRACER is used and spans cost a method call.
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+class NullTracer:
+    enabled = False
+
+    def __init__(self):
+        self._span = _NullSpan()
+
+    def span(self, name, **attrs):
+        return self._span
+
+    def finish(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+        self.depth = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.tracer._enter(self)
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        times = os.times()
+        self._children_cpu = times.children_user + times.children_system
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        times = os.times()
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self.children_cpu = times.children_user + times.children_system - self._children_cpu
+        if exc_type is not None and not issubclass(exc_type, SystemExit):
+            self.attrs["error"] = exc_type.__name__
+        self.tracer._exit(self)
+        return False
+
+    def to_dict(self):
+        record = {"name": self.name, "parent": self.parent, "start": self.start, "wall": self.wall,
+                  "cpu": self.cpu, "children_cpu": self.children_cpu}
+        record.update(self.attrs)
+        return record
+
+
+class Tracer:
+    enabled = True
+
+    def __init__(self, summary=False, trace_file=None, output=None):
+        self.summary = summary
+        self.trace_file = trace_file
+        self.output = output
+        import uuid
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._stack = []
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def _enter(self, span):
+        if self._stack:
+            span.parent = self._stack[-1].name
+        span.depth = len(self._stack)
+        self._stack.append(span)
+        self.spans.append(span)
+
+    def _exit(self, span):
+        self._stack.remove(span)
+
+    def format_summary(self):
+        lines = ["%-28s %10s %10s %10s  %s" % ("phase", "wall ms", "cpu ms", "child ms", "details")]
+        for span in self.spans:
+            if not hasattr(span, "wall"):
+                continue
+            details = " ".join("%s=%s" % (k, v) for k, v in sorted(span.attrs.items()))
+            lines.append("%-28s %10.2f %10.2f %10.2f  %s" % ("  " * span.depth + span.name, span.wall * 1000,
+                                                             span.cpu * 1000, span.children_cpu * 1000, details))
+        return "\n".join(lines) + "\n"
+
+    def finish(self):
+        """ Print the summary and append the spans to the trace file """
+        if self.summary:
+            (self.output or sys.stderr).write(self.format_summary())
+        if self.trace_file:
+            import json
+            lines = []
+            for span in self.spans:
+                if hasattr(span, "wall"):
+                    record = span.to_dict()
+                    record["trace_id"] = self.trace_id
+                    record["pid"] = os.getpid()
+                    lines.append(json.dumps(record) + "\n")
+            with open(self.trace_file, "a") as f:
+                f.write("".join(lines))
+        self.spans = []
+
+
+def create_tracer(timings):
+    """ Return a Tracer if --timings is set or SKRM_TRACE names a trace file, the NULL_TRACER otherwise """
+    trace_file = os.environ.get("SKRM_TRACE")
+    if timings or trace_file:
+        return Tracer(summary=timings, trace_file=trace_file)
+    return NULL_TRACER
@@ -0,0 +1,815 @@
+import os
+import contextlib
+from collections import namedtuple
+
+from . import bdd_format
+from . import changelog
+from . import keyring_store
+from . import tracing
+from .tag_index import TagIndex, tags_matcher
+from .shards import ShardSet, is_sharded, list_files
+from .locking import FileLock, fsync_directory
+
+# Every command line invocation imports this module, the modules only some commands need (the crypto backends running
+# gpg, re for a search, the fuzzy search and the completion cache) are imported where they are used.
+
+
+_parsed_prefs = {}
+
+
+def read_prefs(user_pref_path):
+    """ Return the (name, value) settings of a user prefs file, parsed once per process while the file is unchanged """
+    try:
+        st = os.stat(user_pref_path)
+    except OSError: # use preffs not found, do nothing. args must be defined in command line arguments.
+        return []
+    version = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _parsed_prefs.get(user_pref_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    prefs = []
+    try:
+        with open(user_pref_path, "r") as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line or line[0] == '#' or "=" not in line:
+                    continue
+                prefs.append(tuple(line.split("=", 1)))
+    except IOError:
+        return []
+    _parsed_prefs[user_pref_path] = (version, prefs)
+    return prefs
+
+
+class SkrmError(Exception):
+    """ Base class of the errors raised by skrm """
+
+
+class DecryptError(SkrmError):
+    pass
+
+
+class EncryptError(SkrmError):
+    pass
+
+
+class CorruptedBddError(SkrmError):
+    pass
+
+
+class KeyringNotFound(SkrmError):
+    pass
+
+
+class ConflictError(SkrmError):
+    pass
+
+
+class BadPatternError(SkrmError):
+    pass
+
+
+class BackupError(SkrmError):
+    """ Raised when a backup or a restore fails, errors lists the (location, error message) of each failure """
+    def __init__(self, message, errors=()):
+        SkrmError.__init__(self, message)
+        self.errors = list(errors)
+
+
+class Match(namedtuple("Match", "id keyring")):
+    """ A keyring and its id. The keyring is the list of its tags followed by its key, as bytes. """
+    __slots__ = ()
+
+    @property
+    def tags(self):
+        return self.keyring[:-1]
+
+    @property
+    def key(self):
+        return self.keyring[-1]
+
+
+def _to_bytes(field):
+    if isinstance(field, str):
+        return field.encode("utf8", "surrogateescape")
+    return field
+
+
+class Vault:
+    """ A bdd file, decrypted once and kept in memory with its tag index.
+
+    with Vault.from_prefs() as vault:
+        token = vault.get(["github", "token"])[0].key
+        vault.add(["Password", "WebSite", "Twitter"], "myPass")
+
+    Mutations are kept in memory until commit(), which encrypts the bdd once for all of them.
+    Leaving the with block commits pending mutations, unless an exception was raised.
+    Errors are raised as SkrmError subclasses. """
+
+    def __init__(self, filename, recipient="", passphrase=""):
+        self.filename = filename
+        self.recipient = recipient
+        self.passphrase = passphrase
+        self.bdd_version = bdd_format.VERSION_2
+        self.changelog = False
+        self.changelog_max_segments = 32
+        self.changelog_max_size = 1024 * 1024
+        self.backup_location = None
+        self.auto_backup = False
+        self.async_backup = True
+        self.backup_debounce = 2.0
+        self.backup_retries = 5
+        self.shard_tags = []
+        self.shard_count = 16
+        self.completion = False
+        self.encryption = "gpg"
+        self.seal_keys = False
+        self.parallel_search_threshold = 0 # records from which a search of the closed bdd scans it in parallel, 0 never
+        self.search_workers = 0 # processes of a parallel search, one per cpu if 0
+        self.tracer = tracing.NULL_TRACER
+        self.bdd = None
+        self.ops = []
+        self.originals = [] # keyring added, updated or removed by each operation, as it was before the operation
+        self.loaded_version = None
+        self._index = None
+        self._search_engine = None
+        self._fuzzy_search = None
+        self._shards = None
+        self._lock = None
+        self._crypto_backends = {}
+
+    @classmethod
+    def from_prefs(cls, user_pref_path="~/.skrm/user.prefs", bdd_path="~/.skrm/bdd.gpg", **settings):
+        """ Create a vault configured by a user prefs file, settings override the prefs """
+        vault = cls(os.path.expanduser(bdd_path))
+        vault.load_user_prefs(os.path.expanduser(user_pref_path))
+        for name, value in settings.items():
+            setattr(vault, name, value)
+        return vault
+
+    def load_user_prefs(self, user_pref_path):
+        for name, value in read_prefs(user_pref_path):
+            self.apply_pref(name, value)
+
+    def apply_pref(self, name, value):
+        """ Apply a user pref, return False if it is unknown """
+        if name == "file":
+            self.filename = value
+        elif name == "recipient":
+            self.recipient = value
+        elif name == "backup_location":
+            self.backup_location = value
+        elif name == "auto_backup":
+            self.auto_backup = (value.lower() == "true")
+        elif name == "async_backup":
+            self.async_backup = (value.lower() == "true")
+        elif name == "backup_debounce":
+            self.backup_debounce = float(value)
+        elif name == "backup_retries":
+            self.backup_retries = int(value)
+        elif name == "changelog":
+            self.changelog = (value.lower() == "true")
+        elif name == "changelog_max_segments":
+            self.changelog_max_segments = int(value)
+        elif name == "changelog_max_size":
+            self.changelog_max_size = int(value)
+        elif name == "bdd_format":
+            self.bdd_version = int(value)
+        elif name == "shard_tags":
+            self.shard_tags = [tag for tag in value.split(",") if tag]
+        elif name == "shard_count":
+            self.shard_count = int(value)
+        elif name == "completion":
+            self.completion = (value.lower() == "true")
+        elif name == "encryption":
+            self.encryption = value
+        elif name == "seal_keys":
+            self.seal_keys = (value.lower() == "true")
+        elif name == "parallel_search_threshold":
+            self.parallel_search_threshold = int(value)
+        elif name == "search_workers":
+            self.search_workers = int(value)
+        else:
+            return False
+        return True
+
+    # Encryption and storage
+
+    def crypto_backend(self, name=None):
+        """ Return the backend encrypting the files written, or the backend of the given name """
+        from . import crypto
+        name = name or self.encryption
+        if name not in self._crypto_backends:
+            self._crypto_backends[name] = crypto.create_backend(name, self)
+        return self._crypto_backends[name]
+
+    def _file_backend(self, filename):
+        """ Return the backend which wrote the given file """
+        from . import crypto
+        return self.crypto_backend(crypto.detect(filename))
+
+    def _decrypt(self, filename):
+        """ Return the decrypted content of the given file and None, or None and the reason it can't be decrypted """
+        return self._file_backend(filename).decrypt(filename)
+
+    def _decrypt_chunks(self, filename):
+        """ Yield the decrypted content of the given file chunk by chunk.
+        Decryption stops if the generator is closed before the end. """
+        return self._file_backend(filename).decrypt_chunks(filename)
+
+    @property
+    def shards(self):
+        """ The ShardSet of the vault if its file is a sharded vault directory, None otherwise """
+        if self._shards is None or self._shards.directory != self.filename:
+            self._shards = ShardSet(self, self.filename) if is_sharded(self.filename) else None
+        return self._shards
+
+    def lock_path(self):
+        return self.filename + ".lock"
+
+    @contextlib.contextmanager
+    def locked(self, shared=False):
+        """ Hold a shared lock on the bdd for reading, or an exclusive one for writing.
+        Nested calls reuse the lock already held, and there is nothing to lock to read a bdd not created yet. """
+        if self._lock is not None or (shared and not os.path.exists(self.filename)) \
+                or not os.path.isdir(os.path.dirname(os.path.abspath(self.filename))):
+            yield
+            return
+        self._lock = FileLock(self.lock_path(), shared=shared)
+        self._lock.acquire()
+        try:
+            yield
+        finally:
+            self._lock.release()
+            self._lock = None
+
+    def content_version(self):
+        """ Identify the content of the bdd files, replaced by every write """
+        if self.shards:
+            files = list_files(self.filename)
+        else:
+            files = [self.filename] + changelog.list_segments(self.filename)
+        version = []
+        for filename in files:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            version.append((filename, st.st_ino, st.st_mtime_ns, st.st_size))
+        return version
+
+    def _streamed(self):
+        """ Tell whether iter_keyrings streams the bdd file rather than iterating the open bdd """
+        return self.bdd is None and not self.shards and not changelog.list_segments(self.filename) \
+            and self._file_backend(self.filename).streams
+
+    def iter_keyrings(self):
+        """ Yield the keyrings of the bdd as they are decrypted, without holding the whole bdd in memory.
+        Closing the generator stops the decryption. The bdd is fully loaded instead when it is already open
+        or has change log segments to replay, and when its encryption can't be streamed. """
+        if not self._streamed():
+            for keyring in self.open().bdd:
+                yield keyring
+            return
+        if not os.path.exists(self.filename):
+            return
+        parser = bdd_format.StreamParser()
+        with self.locked(shared=True), self.tracer.span("stream") as span:
+            try:
+                for chunk in self._decrypt_chunks(self.filename):
+                    for keyring in parser.feed(chunk):
+                        yield keyring
+                for keyring in parser.close():
+                    yield keyring
+            except ValueError as e:
+                raise CorruptedBddError(str(e))
+            finally:
+                span.set(records=parser.parsed)
+                if parser.version is not None:
+                    self.bdd_version = parser.version
+
+    def scan(self, matcher, limit=None):
+        """ Return the keyrings for which matcher(keyring) is true, in id order, stopping the decryption
+        as soon as limit keyrings are found """
+        matches = []
+        if limit == 0:
+            return matches
+        if not self._streamed():
+            # the keyrings are matched on their tags, so that only the sealed keys of the matches are unsealed
+            bdd = self.open().bdd
+            iter_metadata = getattr(bdd, "iter_metadata", None)
+            for i, keyring in enumerate(bdd if iter_metadata is None else iter_metadata()):
+                if matcher(keyring):
+                    matches.append(Match(i, bdd[i]))
+                    if len(matches) == limit:
+                        break
+            return matches
+        keyrings = self.iter_keyrings()
+        try:
+            for i, keyring in enumerate(keyrings):
+                if matcher(keyring):
+                    matches.append(Match(i, keyring))
+                    if len(matches) == limit:
+                        break
+        finally:
+            keyrings.close()
+        return matches
+
+    def load_raw_bdd(self, filename=None):
+        """ Decript gpg file and return the content, empty if the file doesn't exist yet """
+        filename = filename or self.filename
+        if not os.path.exists(filename):
+            return b""
+        stdout, error = self._decrypt(filename)
+        if error is not None:
+            raise DecryptError(error)
+        if bdd_format.detect_version(stdout) in bdd_format.RECORD_VERSIONS:
+            return stdout
+        return stdout.rstrip()
+
+    def verify_bdd_file(self, filename):
+        """ Check that the given file can be decrypted and parsed, return an error message or None """
+        stdout, error = self._decrypt(filename)
+        if error is not None:
+            return error
+        if bdd_format.detect_version(stdout) == bdd_format.VERSION_1:
+            stdout = stdout.rstrip()
+        try:
+            bdd_format.parse(stdout)
+        except ValueError as e:
+            return str(e)
+        return None
+
+    def _save_raw_bdd(self, raw, filename=None):
+        """ Encrypt into a temporary file, synced then renamed over the file so that readers never see it half written """
+        import tempfile
+        filename = filename or self.filename
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".skrm-")
+        os.close(fd)
+        try:
+            self.crypto_backend().encrypt(raw, filename, tmp)
+            with open(tmp, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, filename)
+            fsync_directory(directory)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def parse_raw(self, raw):
+        version = bdd_format.detect_version(raw)
+        if version is not None:
+            self.bdd_version = version
+        with self.tracer.span("parse_raw", bytes=len(raw)) as span:
+            try:
+                bdd = keyring_store.parse(raw)
+            except ValueError as e:
+                raise CorruptedBddError(str(e))
+            span.set(records=len(bdd))
+        if version == bdd_format.VERSION_3:
+            bdd.key_opener = self.crypto_backend("envelope").open_key
+        return bdd
+
+    def parse_bdd(self, bdd):
+        version = self.bdd_version
+        if version == bdd_format.VERSION_1 and bdd_format.needs_v2(bdd):
+            version = bdd_format.VERSION_2
+        with self.tracer.span("parse_bdd", records=len(bdd)) as span:
+            if version == bdd_format.VERSION_3:
+                bdd = self._sealed_keys(bdd)
+            raw = bdd_format.serialize(bdd, version)
+            span.set(bytes=len(raw))
+        return raw
+
+    def _sealed_keys(self, bdd):
+        """ Return the keyrings of bdd with their keys sealed, keeping the keys of a v3 bdd sealed as they were loaded """
+        seal_key = self.crypto_backend("envelope").seal_key
+        sealed_key = getattr(bdd, "sealed_key", None)
+        keyrings = []
+        for i in range(len(bdd)):
+            key = sealed_key(i) if sealed_key is not None else None
+            if key is None:
+                keyring = bdd[i]
+                keyrings.append(keyring[:-1] + [seal_key(_to_bytes(keyring[-1]))])
+            else:
+                keyrings.append(bdd.tags_of(i) + [key])
+        return keyrings
+
+    def _record_version(self):
+        """ Return the format version a full save writes: v3 to seal the keys, as set by the seal_keys pref """
+        if self.seal_keys:
+            if self.encryption != "envelope":
+                raise SkrmError("Sealing the keys needs the envelope encryption, set encryption=envelope.")
+            return bdd_format.VERSION_3
+        if self.bdd_version == bdd_format.VERSION_3:
+            return bdd_format.VERSION_2
+        return self.bdd_version
+
+    def load_bdd(self, filename=None):
+        """ Decrypt and parse the bdd file, then replay the change log segments written since it was saved """
+        filename = filename or self.filename
+        with self.locked(shared=True):
+            if filename == self.filename:
+                self.loaded_version = self.content_version()
+            return self._load_bdd(filename)
+
+    def _load_bdd(self, filename):
+        if filename == self.filename and self.shards:
+            with self.tracer.span("load") as span:
+                bdd = self.shards.load()
+                span.set(records=len(bdd), shards=len(self.shards.shard_names()))
+            return bdd
+        with self.tracer.span("load") as span:
+            bdd = self.parse_raw(self.load_raw_bdd(filename))
+            segments = changelog.list_segments(filename)
+            for segment in segments:
+                try:
+                    changelog.apply_ops(bdd, changelog.decode_ops(self.load_raw_bdd(segment)))
+                except (ValueError, IndexError) as e:
+                    raise CorruptedBddError("Corrupted change log segment " + segment + ": " + str(e))
+            span.set(records=len(bdd), segments=len(segments))
+        return bdd
+
+    def save_bdd(self, bdd):
+        self.bdd_version = self._record_version()
+        if self.shards:
+            self._check_shards_backup()
+            with self.tracer.span("save", records=len(bdd)):
+                self.shards.save(bdd, everything=True)
+            self._refresh_completion(bdd)
+            return
+        with self.tracer.span("save", records=len(bdd)):
+            raw = self.parse_bdd(bdd)
+            self._save_raw_bdd(raw)
+            changelog.clear_segments(self.filename)
+        self._refresh_completion(bdd)
+        if self.auto_backup:
+            self._auto_backup()
+
+    def persist(self, bdd, ops):
+        """ Persist the given operations, already applied to bdd.
+        With the change log enabled, only the operations are encrypted and appended as a new segment,
+        the bdd is fully saved once there are too many segments or when it needs to be backed up.
+        A sharded vault only encrypts the shards holding the keyrings the operations touched. """
+        if self.shards:
+            self._check_shards_backup()
+            with self.tracer.span("save", records=len(bdd), ops=len(ops)):
+                self.shards.save(bdd)
+            self._refresh_completion(bdd)
+            return
+        if not self.changelog or self.auto_backup or not os.path.exists(self.filename):
+            self.save_bdd(bdd)
+            return
+        segments = changelog.list_segments(self.filename)
+        path = changelog.next_segment_path(self.filename, segments)
+        with self.tracer.span("changelog_append", ops=len(ops)):
+            self._save_raw_bdd(changelog.encode_ops(ops), path)
+        segments.append(path)
+        if len(segments) >= self.changelog_max_segments or changelog.segments_size(segments) >= self.changelog_max_size:
+            self.save_bdd(bdd)
+        else:
+            self._refresh_completion(bdd)
+
+    def _check_shards_backup(self):
+        """ Refuse to write a sharded vault that auto_backup would leave without backup """
+        if self.auto_backup:
+            raise BackupError("Backups of sharded vaults are not supported, disable auto_backup to write a sharded vault.")
+
+    def _refresh_completion(self, bdd):
+        """ Rewrite the completion cache of the bdd, when it is enabled """
+        if self.completion:
+            from . import completion
+            with self.tracer.span("completion_cache"):
+                completion.write(self.filename, bdd)
+
+    def compact_pending(self):
+        """ Fold pending change log segments into the bdd file so that it can be copied on its own """
+        with self.locked():
+            if changelog.list_segments(self.filename):
+                bdd = self.load_bdd()
+                self._save_raw_bdd(self.parse_bdd(bdd))
+                changelog.clear_segments(self.filename)
+
+    # Backups
+
+    def backup(self, dst):
+        """ Upload the bdd file to the comma separated destinations, return the result of each one """
+        from . import backup
+        if self.shards:
+            raise BackupError("Backups of sharded vaults are not supported, back up the bdd file before sharding it.")
+        destinations = backup.parse_locations(dst)
+        with self.tracer.span("backup", destinations=len(destinations)):
+            return backup.push(self.filename, self.filename, destinations)
+
+    def _backup(self, dst):
+        failed = [(d, str(r)) for d, r in sorted(self.backup(dst).items()) if isinstance(r, Exception)]
+        if failed:
+            raise BackupError("; ".join(d + ": " + r for d, r in failed), failed)
+
+    def _auto_backup(self):
+        """ Backup the bdd file after a save, from a background worker unless async_backup is disabled """
+        from . import backup
+        if self.async_backup and backup.fcntl:
+            with self.tracer.span("backup_request"):
+                backup.request_backup(self.filename, self.backup_location, self.backup_debounce, self.backup_retries)
+        else:
+            self._backup(self.backup_location)
+
+    def restore(self, src):
+        """ Fetch the backup into a temporary file, and replace the local bdd file only once it is verified.
+        Each comma separated location is tried in order, the one restored is returned. """
+        import tempfile
+        from . import backup
+        if self.shards:
+            raise BackupError("Restoring into a sharded vault is not supported.")
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+        os.close(fd)
+        errors = []
+        try:
+            for location in backup.parse_locations(src):
+                try:
+                    backup.transfer(location, tmp)
+                except (IOError, OSError) as e:
+                    errors.append((location, str(e)))
+                    continue
+                error = self.verify_bdd_file(tmp)
+                if error is not None:
+                    errors.append((location, error))
+                    continue
+                with self.locked():
+                    os.replace(tmp, self.filename)
+                    changelog.clear_segments(self.filename)
+                self.close()
+                return location
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise BackupError("; ".join(l + ": " + e for l, e in errors) or "No backup location.", errors)
+
+    # In-memory view
+
+    def open(self):
+        """ Decrypt the bdd file, unless it is already loaded """
+        if self.bdd is None:
+            self.bdd = self.load_bdd()
+        return self
+
+    def close(self):
+        """ Drop the decrypted bdd, discarding uncommitted mutations """
+        self.bdd = None
+        self.ops = []
+        self.originals = []
+        self.loaded_version = None
+        self._index = None
+        self._search_engine = None
+        self._fuzzy_search = None
+        self._shards = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+        return False
+
+    def __len__(self):
+        return len(self.open().bdd)
+
+    def index(self):
+        if self._index is None:
+            self._index = TagIndex(self.open().bdd)
+        return self._index
+
+    def search_engine(self):
+        if self._search_engine is None:
+            from .search_engine import SearchEngine
+            self._search_engine = SearchEngine(self.index())
+        return self._search_engine
+
+    def fuzzy_search(self):
+        if self._fuzzy_search is None:
+            from .fuzzy_search import FuzzySearch
+            self._fuzzy_search = FuzzySearch(self.index())
+        return self._fuzzy_search
+
+    def _matches(self, ids):
+        return [Match(i, self.bdd[i]) for i in ids]
+
+    def get(self, tags, limit=None):
+        """ Return the keyrings holding all the given tags, compared case-insensitively.
+        With a limit, only the first matches are returned, and the bdd is streamed if it isn't open yet. """
+        if self.bdd is None and self.shards:
+            with self.locked(shared=True):
+                return [Match(i, keyring) for i, keyring in self.shards.get(tags)[:limit]]
+        if limit is not None and self.bdd is None:
+            return self.scan(tags_matcher(tags), limit)
+        return self._matches(self.index().get(tags)[:limit])
+
+    def search(self, patterns, limit=None):
+        """ Return the keyrings having a tag matching each regex pattern, case-insensitively """
+        import re
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise BadPatternError("Invalid pattern \"" + pattern + "\": " + str(e) + ".")
+        if self.bdd is None and self.shards:
+            with self.locked(shared=True):
+                return [Match(i, keyring) for i, keyring in self.shards.search(patterns)[:limit]]
+        if limit is not None and self.bdd is None:
+            from .search_engine import patterns_matcher
+            return self.scan(patterns_matcher(patterns), limit)
+        if self.bdd is None and self.parallel_search_threshold:
+            matches = self._parallel_search(patterns)
+            if matches is not None:
+                return matches
+        return self._matches(self.search_engine().search(patterns)[:limit])
+
+    def _parallel_search(self, patterns):
+        """ Match the records of the bdd file across processes, without parsing nor indexing it, when it holds
+        at least parallel_search_threshold records. The bdd is left closed.
+        Otherwise return None, the bdd being opened from the buffer decrypted for the search through the index. """
+        if self.shards or changelog.list_segments(self.filename) or not os.path.exists(self.filename):
+            return None
+        from . import parallel_search
+        with self.locked(shared=True), self.tracer.span("load"):
+            version = self.content_version()
+            raw = self.load_raw_bdd()
+        reader = None
+        if bdd_format.detect_version(raw) in bdd_format.RECORD_VERSIONS:
+            try:
+                reader = bdd_format.V2Reader(raw)
+            except ValueError as e:
+                raise CorruptedBddError(str(e))
+        if reader is None or len(reader) < self.parallel_search_threshold:
+            self.bdd = self.parse_raw(raw)
+            self.loaded_version = version
+            return None
+        workers = self.search_workers or os.cpu_count() or 1
+        with self.tracer.span("parallel_search", records=len(reader), workers=workers) as span:
+            try:
+                ids = parallel_search.search(raw, patterns, workers)
+            except ValueError as e:
+                raise CorruptedBddError(str(e))
+            span.set(matches=len(ids))
+        self.bdd_version = reader.version
+        matches = []
+        for i in ids:
+            keyring = reader.record(i)
+            if reader.version == bdd_format.VERSION_3:
+                keyring[-1] = self.crypto_backend("envelope").open_key(keyring[-1])
+            matches.append(Match(i, keyring))
+        return matches
+
+    def fuzzy(self, terms, limit=None):
+        """ Return the keyrings whose tags are the most similar to the terms, best first, tolerating typos.
+        At most limit keyrings are returned, 10 by default. """
+        return self._matches(self.fuzzy_search().top(terms, limit))
+
+    def complete(self, prefix, tags=(), limit=None):
+        """ Return the tags starting with prefix that appear along with the given tags, most used first.
+        They are read from the completion cache, or from the bdd when it is already open, the bdd file is never decrypted:
+        without a cache up to date, there is no suggestion until a write command rewrites it. """
+        from . import completion
+        if self.bdd is not None:
+            vocabulary = completion.Vocabulary.from_lines(completion.build(self.bdd))
+        else:
+            vocabulary = completion.read(self.filename)
+        if vocabulary is None:
+            return []
+        return vocabulary.complete(prefix, tags, limit)
+
+    def get_many(self, queries):
+        """ Return the result of get for each list of tags """
+        return [self.get(tags) for tags in queries]
+
+    def _check_id(self, keyId):
+        if not isinstance(keyId, int) or keyId < 0 or keyId >= len(self.open().bdd):
+            raise KeyringNotFound("No keyring with id " + str(keyId) + ".")
+
+    def by_id(self, keyId):
+        """ Return the keyring of the given id. If the bdd isn't open, it is only decrypted up to that keyring,
+        or only its shard is decrypted. """
+        if self.bdd is None and self.shards:
+            with self.locked(shared=True):
+                keyring = self.shards.by_id(keyId) if isinstance(keyId, int) and keyId >= 0 else None
+            if keyring is None:
+                raise KeyringNotFound("No keyring with id " + str(keyId) + ".")
+            return Match(keyId, keyring)
+        if self._streamed():
+            keyrings = self.iter_keyrings()
+            try:
+                for i, keyring in enumerate(keyrings):
+                    if i == keyId:
+                        return Match(i, keyring)
+            finally:
+                keyrings.close()
+            raise KeyringNotFound("No keyring with id " + str(keyId) + ".")
+        self._check_id(keyId)
+        return Match(keyId, self.bdd[keyId])
+
+    def _mutated(self, op, original=None):
+        self.ops.append(op)
+        self.originals.append(original)
+
+    def _reindex(self, keyId, inserted=None, removed=None):
+        """ Update the tag index, if it is built, for a keyring inserted at or removed from keyId,
+        along with the searches built on it, rather than indexing the whole bdd again on the next lookup """
+        if self._index is None:
+            return
+        if inserted is not None:
+            added, dropped = self._index.insert(keyId, inserted[:-1]), []
+        else:
+            added, dropped = [], self._index.remove(keyId, removed[:-1])
+        if self._search_engine is not None:
+            self._search_engine.update(added, dropped)
+        if self._fuzzy_search is not None:
+            if dropped: # dropping a tag from the trigram index would renumber the others
+                self._fuzzy_search = None
+            else:
+                self._fuzzy_search.add_tags(added)
+
+    def add(self, tags, key):
+        """ Add a keyring, return its id """
+        keyring = [_to_bytes(tag) for tag in tags] + [_to_bytes(key)]
+        self.open()
+        keyId = self.shards.add(keyring) if self.shards else len(self.bdd)
+        self.bdd.insert(keyId, keyring)
+        self._reindex(keyId, inserted=keyring)
+        self._mutated(("add", keyring), list(keyring))
+        return keyId
+
+    def update(self, keyId, key):
+        self._check_id(keyId)
+        key = _to_bytes(key)
+        if self.shards:
+            self.shards.update(keyId)
+        original = self.bdd[keyId]
+        keyring = list(original)
+        keyring[-1] = key
+        self.bdd[keyId] = keyring # the tags are kept, the index stays valid
+        self._mutated(("update", keyId, key), original)
+        return self.bdd[keyId]
+
+    def remove(self, keyId):
+        self._check_id(keyId)
+        keyring = self.bdd[keyId]
+        if self.shards:
+            self.shards.remove(keyId)
+        del self.bdd[keyId]
+        self._reindex(keyId, removed=keyring)
+        self._mutated(("remove", keyId), keyring)
+        return keyring
+
+    def _rebase(self):
+        """ Reload the bdd written by another process since it was loaded, and replay the pending mutations on it.
+        Keyrings updated or removed are looked up by content, as their ids may have changed. """
+        ops, originals = self.ops, self.originals
+        version = self.bdd_version
+        self.close()
+        self.open()
+        self.bdd_version = version
+        for op, original in zip(ops, originals):
+            if op[0] == "add":
+                self.add(original[:-1], original[-1])
+                continue
+            keyId = op[1]
+            if keyId >= len(self.bdd) or self.bdd[keyId] != original:
+                try:
+                    keyId = self.bdd.index(original)
+                except ValueError:
+                    raise ConflictError("Keyring " + str(op[1]) + " was modified or removed by another process, nothing was saved.")
+            if op[0] == "update":
+                self.update(keyId, op[2])
+            else:
+                self.remove(keyId)
+
+    def commit(self):
+        """ Persist the pending mutations with a single encryption.
+        The bdd is locked while it is written, and mutations are replayed on its latest content if another
+        process wrote it since it was loaded. """
+        if not self.ops:
+            return
+        with self.locked():
+            if self.content_version() != self.loaded_version:
+                with self.tracer.span("rebase", ops=len(self.ops)):
+                    self._rebase()
+            self.persist(self.bdd, self.ops)
+            self.ops = []
+            self.originals = []
+            self.loaded_version = self.content_version()
+
+    def save(self):
+        """ Rewrite the whole bdd file, folding pending mutations and change log segments """
+        with self.locked():
+            if self.bdd is None or self.content_version() != self.loaded_version:
+                self._rebase()
+            self.save_bdd(self.bdd)
+            self.ops = []
+            self.originals = []
+            self.loaded_version = self.content_version()
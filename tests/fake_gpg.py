@@ -0,0 +1,23 @@
+import os
+
+
+# Stand-ins for KeyringManager.load_raw_bdd and KeyringManager._save_raw_bdd storing the bdd in clear,
+# for tests that don't need a gpg key.
+
+def fake_load_raw_bdd(self, filename=None):
+    filename = filename or self.filename
+    if not os.path.exists(filename):
+        return b""
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def fake_save_raw_bdd(self, raw, filename=None):
+    with open(filename or self.filename, "wb") as f:
+        f.write(raw)
+
+
+def fake_decrypt_chunks(self, filename):
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(7), b""):
+            yield chunk
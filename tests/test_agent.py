@@ -0,0 +1,80 @@
+import os
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+from skrm import agent
+from skrm.keyring_manager import KeyringManager
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, "agent.sock")
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+        self._write_bdd(b"tag1\x02tag2\x02pass1\x03tag1\x02tag3\x02pass2")
+        self.loads = 0
+
+        self.keyring_manager = KeyringManager("", self.bdd_filename, [])
+        self.agent = agent.Agent(self.socket_path, 30, self._fake_loader, self.keyring_manager.match_request)
+        self.thread = threading.Thread(target=self.agent.serve)
+        self.thread.start()
+        while not os.path.exists(self.socket_path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        agent.query(self.socket_path, {"command": "stop"})
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_bdd(self, raw):
+        with open(self.bdd_filename, "wb") as f:
+            f.write(raw)
+
+    def _fake_loader(self, filename):
+        self.loads += 1
+        with open(filename, "rb") as f:
+            return self.keyring_manager.parse_raw(f.read())
+
+    def _query(self, command, tags, keyId=-1):
+        return agent.query(self.socket_path, {"command": command, "file": self.bdd_filename,
+                                              "tags": tags, "keyId": keyId})
+
+    def test_socket_is_user_only(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+
+    def test_get_and_search(self):
+        self.assertEqual(self._query("get", ["TAG1"]), [(0, [b"tag1", b"tag2", b"pass1"]),
+                                                       (1, [b"tag1", b"tag3", b"pass2"])])
+        self.assertEqual(self._query("get", ["tag1", "tag3"]), [(1, [b"tag1", b"tag3", b"pass2"])])
+        self.assertEqual(self._query("search", ["g2"]), [(0, [b"tag1", b"tag2", b"pass1"])])
+        self.assertEqual(self._query("get", [], 1), [(1, [b"tag1", b"tag3", b"pass2"])])
+        self.assertEqual(self._query("fuzzy", ["tag33"]), [(1, [b"tag1", b"tag3", b"pass2"]),
+                                                          (0, [b"tag1", b"tag2", b"pass1"])])
+        self.assertEqual(self.loads, 1)
+
+    def test_reload_on_change(self):
+        self._query("get", ["tag1"])
+        os.utime(self.bdd_filename, ns=(0, 0))
+        self._query("get", ["tag1"])
+        self.assertEqual(self.loads, 1) # same content, only the mtime changed
+
+        self._write_bdd(b"tag4\x02pass4")
+        self.assertEqual(self._query("get", ["tag4"]), [(0, [b"tag4", b"pass4"])])
+        self.assertEqual(self.loads, 2)
+
+    def test_errors_fall_back(self):
+        self.assertIsNone(self._query("get", [], 10))
+        self.assertIsNone(agent.query(os.path.join(self.tmp_dir, "missing.sock"), {"command": "ping"}))
+
+    def test_silent_client_times_out(self):
+        self.agent.client_timeout = 0.2
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            silent.connect(self.socket_path) # never sends its request
+            self.assertEqual(self._query("get", ["tag3"]), [(1, [b"tag1", b"tag3", b"pass2"])])
+        finally:
+            silent.close()
@@ -0,0 +1,148 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import backup
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+        self.backup_filename = os.path.join(self.tmp_dir, "backup.gpg")
+        self._write_bdd(b"content 1")
+        self.uploads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_bdd(self, content):
+        with open(self.bdd_filename, "wb") as f:
+            f.write(content)
+
+    def _upload(self, src, dst):
+        self.uploads.append(dst)
+        shutil.copyfile(src, dst)
+
+    def _request(self):
+        backup.update_state(self.bdd_filename, requested=time.time(), destination=self.backup_filename)
+
+    def test_coalesce_requests(self):
+        self._request()
+        self._write_bdd(b"content 2")
+        self._request()
+        self._write_bdd(b"content 3")
+        self._request()
+        backup.run_worker(self.bdd_filename, 0.05, 0, self._upload)
+        self.assertEqual(self.uploads, [self.backup_filename])
+        with open(self.backup_filename, "rb") as f:
+            self.assertEqual(f.read(), b"content 3")
+
+        state = backup.read_state(self.bdd_filename)
+        self.assertEqual(state["last_success"]["sha256"], backup.file_digest(self.bdd_filename))
+        self.assertIn("Last backup:", backup.format_status(self.bdd_filename))
+        self.assertNotIn("Pending", backup.format_status(self.bdd_filename))
+
+    def test_retry_with_backoff(self):
+        failures = []
+
+        def flaky_upload(src, dst):
+            if len(failures) < 2:
+                failures.append(dst)
+                raise IOError("connection refused")
+            self._upload(src, dst)
+
+        self._request()
+        backup.run_worker(self.bdd_filename, 0, 3, flaky_upload, backoff=0)
+        self.assertEqual(len(failures), 2)
+        self.assertEqual(self.uploads, [self.backup_filename])
+        self.assertNotIn("Last error", backup.format_status(self.bdd_filename))
+
+    def test_give_up_after_retries(self):
+        def failing_upload(src, dst):
+            raise IOError("connection refused")
+
+        self._request()
+        backup.run_worker(self.bdd_filename, 0, 2, failing_upload, backoff=0)
+        state = backup.read_state(self.bdd_filename)
+        self.assertEqual(state["last_error"]["attempt"], 3)
+        self.assertNotIn("last_success", state)
+        self.assertIn("Last error", backup.format_status(self.bdd_filename))
+
+    def test_detached_worker(self):
+        backup.request_backup(self.bdd_filename, self.backup_filename, 0, 0)
+        for _ in range(200):
+            if "last_success" in backup.read_state(self.bdd_filename):
+                break
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(self.backup_filename))
+
+
+class TestMultiDestinationBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+        with open(self.bdd_filename, "wb") as f:
+            f.write(b"content")
+        self.destinations = [os.path.join(self.tmp_dir, "backup%d.gpg" % i) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch('sys.stderr')
+    @mock.patch('subprocess.Popen')
+    def test_scp_status(self, mocked_popen, mocked_stderr):
+        process = mocked_popen.return_value
+        process.communicate.return_value = (b"", b"Warning: Permanently added 'host' to the list of known hosts.\n")
+        process.returncode = 0
+        backup.scp(self.bdd_filename, "host:backup.gpg")
+        mocked_stderr.write.assert_called_once_with("scp: Warning: Permanently added 'host' to the list of known hosts.\n")
+        process.communicate.return_value = (b"", b"")
+        process.returncode = 1
+        with self.assertRaisesRegex(IOError, "status 1"):
+            backup.scp(self.bdd_filename, "host:backup.gpg")
+
+    def test_parse_locations(self):
+        self.assertEqual(backup.parse_locations("host:~/a.gpg, /b.gpg,"), ["host:~/a.gpg", "/b.gpg"])
+        self.assertEqual(backup.parse_locations(None), [])
+        self.assertTrue(backup.is_remote("user@host:~/.skrm/bdd.gpg"))
+        self.assertFalse(backup.is_remote("/home/user/bdd.gpg"))
+        self.assertFalse(backup.is_remote("./dir:name/bdd.gpg"))
+
+    def test_push_skips_unchanged_destinations(self):
+        results = backup.push(self.bdd_filename, self.bdd_filename, self.destinations)
+        self.assertEqual(results, dict((d, "uploaded") for d in self.destinations))
+        for destination in self.destinations:
+            self.assertEqual(backup.file_digest(destination), backup.file_digest(self.bdd_filename))
+
+        os.remove(self.destinations[2])
+        results = backup.push(self.bdd_filename, self.bdd_filename, self.destinations)
+        self.assertEqual([results[d] for d in self.destinations], ["skipped", "skipped", "uploaded"])
+
+        with open(self.bdd_filename, "wb") as f:
+            f.write(b"new content")
+        results = backup.push(self.bdd_filename, self.bdd_filename, self.destinations)
+        self.assertEqual(set(results.values()), set(["uploaded"]))
+
+    def test_push_reports_failures(self):
+        missing = os.path.join(self.tmp_dir, "missing_dir", "backup.gpg")
+        results = backup.push(self.bdd_filename, self.bdd_filename, [self.destinations[0], missing])
+        self.assertEqual(results[self.destinations[0]], "uploaded")
+        self.assertIsInstance(results[missing], OSError)
+        self.assertNotIn(missing, backup._read_json(backup.manifest_path(self.bdd_filename)))
+
+    def test_verified_restore(self):
+        from skrm.keyring_manager import KeyringManager
+        corrupted = self.destinations[0]
+        with open(corrupted, "wb") as f:
+            f.write(b"not a gpg file")
+        keyring_manager = KeyringManager("", self.bdd_filename, ["--restore=" + corrupted])
+        with self.assertRaises(SystemExit) as cm:
+            keyring_manager.run()
+        self.assertEqual(cm.exception.code, 1)
+        with open(self.bdd_filename, "rb") as f:
+            self.assertEqual(f.read(), b"content") # left untouched
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["backup0.gpg", "bdd.gpg"]) # no temporary file left
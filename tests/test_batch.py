@@ -0,0 +1,96 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm.batch import BatchRunner, parse_line
+from skrm.keyring_manager import KeyringManager
+from skrm.vault import Vault
+from skrm.tag_index import TagIndex
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+
+class TestBatch(unittest.TestCase):
+    def test_parse_line(self):
+        self.assertIsNone(parse_line("   "))
+        self.assertIsNone(parse_line("# comment"))
+        self.assertEqual(parse_line("add 'my pass' tag1 tag2"), {"op": "add", "key": "my pass", "tags": ["tag1", "tag2"]})
+        self.assertEqual(parse_line("remove 2"), {"op": "remove", "id": "2"})
+        self.assertEqual(parse_line('{"op": "get", "tags": ["tag1"]}'), {"op": "get", "tags": ["tag1"]})
+        with self.assertRaises(ValueError):
+            parse_line("update 1")
+        with self.assertRaises(ValueError):
+            parse_line('["get"]')
+
+    def test_run(self):
+        vault = Vault("")
+        vault.bdd = [[b"tag1", b"pass1"]]
+        output = io.StringIO()
+        runner = BatchRunner(vault, output)
+        errors = runner.run(["add pass2 tag1 tag2\n",
+                             "get tag1\n",
+                             '{"op": "update", "id": 0, "key": "new1"}\n',
+                             "remove 5\n",
+                             "search g2\n",
+                             "remove 1\n",
+                             "get tag2\n"])
+        self.assertEqual(errors, 1)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(results[0], {"line": 1, "op": "add", "id": 1})
+        self.assertEqual([m["id"] for m in results[1]["matches"]], [0, 1])
+        self.assertEqual(results[3]["line"], 4)
+        self.assertIn("error", results[3])
+        self.assertEqual(results[4]["matches"], [{"id": 1, "keyring": ["tag1", "tag2", "pass2"]}])
+        self.assertEqual(results[6]["matches"], [])
+        self.assertEqual(vault.bdd, [[b"tag1", b"new1"]])
+        self.assertEqual(vault.ops, [("add", [b"tag1", b"tag2", b"pass2"]), ("update", 0, b"new1"), ("remove", 1)])
+
+    def test_bad_pattern_is_a_line_error(self):
+        vault = Vault("")
+        vault.bdd = []
+        output = io.StringIO()
+        self.assertEqual(BatchRunner(vault, output).run(["add k1 a b\n", "search [\n", "get a\n"]), 1)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertIn("Invalid pattern", results[1]["error"])
+        self.assertEqual(results[2]["matches"], [{"id": 0, "keyring": ["a", "b", "k1"]}])
+        self.assertEqual(vault.ops, [("add", [b"a", b"b", b"k1"])])
+
+    def test_index_updated_by_mutations(self):
+        vault = Vault("")
+        vault.bdd = [[b"tag1", b"pass1"], [b"tag2", b"pass2"]]
+        lines = []
+        for i in range(3, 8):
+            lines += ["add pass%d tag%d shared\n" % (i, i), "get shared\n", "search ^tag\n"]
+        lines += ["update 0 new1\n", "get tag1\n", "remove 2\n", "get shared\n", "search 3\n", "remove 0\n", "search 1\n"]
+        output = io.StringIO()
+        with mock.patch('skrm.vault.TagIndex', side_effect=TagIndex) as mocked_index:
+            self.assertEqual(BatchRunner(vault, output).run(lines), 0)
+            self.assertEqual(mocked_index.call_count, 1) # built by the first get, then kept up to date
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([m["id"] for m in results[-8]["matches"]], list(range(7)))
+        self.assertEqual(results[-6]["matches"], [{"id": 0, "keyring": ["tag1", "new1"]}])
+        self.assertEqual([m["keyring"][-1] for m in results[-4]["matches"]], ["pass4", "pass5", "pass6", "pass7"])
+        self.assertEqual(results[-3]["matches"], [])
+        self.assertEqual(results[-1]["matches"], [])
+        self.assertEqual(vault.index().ids, TagIndex(vault.bdd).ids)
+
+    @mock.patch('skrm.keyring_manager.KeyringManager.load_raw_bdd', fake_load_raw_bdd)
+    @mock.patch('skrm.keyring_manager.KeyringManager._save_raw_bdd', side_effect=fake_save_raw_bdd, autospec=True)
+    def test_command_batch_saves_once(self, mocked_save):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            bdd_filename = os.path.join(tmp_dir, "bdd.gpg")
+            batch_filename = os.path.join(tmp_dir, "batch.txt")
+            with open(batch_filename, "w") as f:
+                for i in range(50):
+                    f.write("add pass%d tag%d\n" % (i, i))
+            keyring_manager = KeyringManager("", bdd_filename, ["--batch=" + batch_filename])
+            self.assertEqual(keyring_manager.command, "batch")
+            keyring_manager.run()
+            self.assertEqual(mocked_save.call_count, 1)
+            self.assertEqual(len(KeyringManager("", bdd_filename, []).load_bdd()), 50)
+        finally:
+            shutil.rmtree(tmp_dir)
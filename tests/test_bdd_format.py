@@ -0,0 +1,84 @@
+import unittest
+
+from skrm import bdd_format
+
+
+def stream_parse(chunks):
+    """ Parse the chunks the way Vault.iter_keyrings does as they are decrypted """
+    parser = bdd_format.StreamParser()
+    keyrings = []
+    for chunk in chunks:
+        keyrings += parser.feed(chunk)
+    return keyrings + parser.close()
+
+
+class TestBddFormat(unittest.TestCase):
+    def setUp(self):
+        self.bdd = [[b"Password", b"WebSite", b"myPass"],
+                    [b"Pin", "Bank", b"1234"],
+                    [b"key only"],
+                    [b"Empty", b""]]
+
+    def _bytes_bdd(self):
+        return [[f.encode("utf8") if isinstance(f, str) else f for f in keyring] for keyring in self.bdd]
+
+    def test_detect_version(self):
+        self.assertIsNone(bdd_format.detect_version(b""))
+        self.assertEqual(bdd_format.detect_version(b"tag\x02key"), bdd_format.VERSION_1)
+        self.assertEqual(bdd_format.detect_version(bdd_format.serialize_v2(self.bdd)), bdd_format.VERSION_2)
+
+    def test_v1_round_trip(self):
+        raw = bdd_format.serialize_v1(self.bdd)
+        self.assertEqual(raw, b"Password\x02WebSite\x02myPass\x03Pin\x02Bank\x021234\x03key only\x03Empty\x02")
+        self.assertEqual(bdd_format.parse(raw), self._bytes_bdd())
+        self.assertEqual(bdd_format.parse(b""), [])
+
+    def test_v2_round_trip(self):
+        raw = bdd_format.serialize_v2(self.bdd)
+        self.assertEqual(raw, b"".join(bdd_format.iter_v2_chunks(self.bdd)))
+        self.assertEqual(bdd_format.parse(raw), self._bytes_bdd())
+        self.assertEqual(bdd_format.parse(bdd_format.serialize_v2([])), [])
+
+    def test_v3_layout(self):
+        raw = bdd_format.serialize(self.bdd, bdd_format.VERSION_3)
+        self.assertEqual(bdd_format.detect_version(raw), bdd_format.VERSION_3)
+        self.assertEqual(raw[6:], bdd_format.serialize_v2(self.bdd)[6:]) # only the version differs
+        self.assertEqual(bdd_format.parse(raw), self._bytes_bdd())
+        self.assertEqual(stream_parse([raw[:10], raw[10:]]), self._bytes_bdd())
+
+    def test_v2_stores_separators(self):
+        bdd = [[b"tag", b"key\x02with\x03separators\n "]]
+        self.assertTrue(bdd_format.needs_v2(bdd))
+        self.assertFalse(bdd_format.needs_v2(self.bdd))
+        self.assertEqual(bdd_format.parse(bdd_format.serialize_v2(bdd)), bdd)
+
+    def test_v2_random_access(self):
+        reader = bdd_format.V2Reader(bdd_format.serialize_v2(self.bdd))
+        self.assertEqual(len(reader), 4)
+        self.assertEqual(reader.record(1), [b"Pin", b"Bank", b"1234"])
+        self.assertEqual(reader.record(3)[1], b"")
+        fields = reader.record_fields(1)
+        self.assertIsInstance(fields[0], memoryview)
+        self.assertEqual(fields[0].obj, reader.view.obj) # a view of the buffer, not a copy
+        self.assertEqual([field.tobytes() for field in fields], [b"Pin", b"Bank", b"1234"])
+
+    def test_v2_corrupted(self):
+        raw = bdd_format.serialize_v2(self.bdd)
+        with self.assertRaises(ValueError):
+            bdd_format.parse(raw[:-3])
+        with self.assertRaises(ValueError):
+            bdd_format.parse(raw[:8])
+
+    def test_stream_parser(self):
+        for raw in (bdd_format.serialize_v1(self.bdd) + b"\n", bdd_format.serialize_v2(self.bdd), b"", b"tag\x02key\x03 \n"):
+            expected = bdd_format.parse(raw.rstrip() if bdd_format.detect_version(raw) == bdd_format.VERSION_1 else raw)
+            for size in (1, 3, 64):
+                chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+                self.assertEqual(stream_parse(chunks), expected)
+
+        parser = bdd_format.StreamParser()
+        raw = bdd_format.serialize_v2(self.bdd)
+        self.assertEqual(parser.feed(raw[:80]), [[b"Password", b"WebSite", b"myPass"]])
+        self.assertEqual(parser.version, bdd_format.VERSION_2)
+        with self.assertRaises(ValueError):
+            parser.close()
@@ -0,0 +1,31 @@
+import unittest
+
+from benchmarks import bench_skrm
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_generate_bdd(self):
+        bdd = bench_skrm.generate_bdd(100)
+        self.assertEqual(len(bdd), 100)
+        self.assertEqual(bdd, bench_skrm.generate_bdd(100))
+        for keyring in bdd:
+            self.assertTrue(2 <= len(keyring) <= 10)
+            self.assertTrue(8 <= len(keyring[-1]) <= 256)
+
+    def test_run_benchmarks(self):
+        report = bench_skrm.run_benchmarks([200], ["fake"], repeat=1)
+        names = set(r["name"] for r in report["results"])
+        self.assertTrue(set(["parse_raw_v1", "parse_bdd_v2", "tag_index_get", "search_engine", "search_parallel",
+                             "print_matches", "write_matches_json", "run_get", "run_add"]) <= names)
+        for result in report["results"]:
+            self.assertEqual(result["size"], 200)
+            self.assertGreaterEqual(result["seconds"], 0)
+        memory = dict((m["name"], m["bytes"]) for m in report["memory"])
+        self.assertTrue(0 < memory["keyring_store"] < memory["bdd_lists"])
+
+    def test_compare(self):
+        baseline = {"results": [{"name": "run_get", "gpg": "fake", "size": 10, "seconds": 1.0}]}
+        report = {"results": [{"name": "run_get", "gpg": "fake", "size": 10, "seconds": 1.2},
+                              {"name": "run_add", "gpg": "fake", "size": 10, "seconds": 9.0}]}
+        self.assertEqual(bench_skrm.compare(report, baseline, 0.25), [])
+        self.assertEqual(len(bench_skrm.compare(report, baseline, 0.1)), 1)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import changelog
+from skrm.keyring_manager import KeyringManager
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+
+@mock.patch('skrm.keyring_manager.KeyringManager.load_raw_bdd', fake_load_raw_bdd)
+@mock.patch('skrm.keyring_manager.KeyringManager._save_raw_bdd', fake_save_raw_bdd)
+class TestChangelog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _run(self, argv, max_segments=32):
+        keyring_manager = KeyringManager("", self.bdd_filename, argv)
+        keyring_manager.changelog = True
+        keyring_manager.changelog_max_segments = max_segments
+        keyring_manager.run()
+        return keyring_manager
+
+    def _get_bdd(self):
+        return KeyringManager("", self.bdd_filename, []).load_bdd()
+
+    def test_encode_decode_ops(self):
+        ops = [("add", [b"tag1", b"pass\x02"]), ("update", 1, b"new"), ("remove", 0)]
+        self.assertEqual(changelog.decode_ops(changelog.encode_ops(ops)), ops)
+        self.assertEqual(changelog.apply_ops([[b"a", b"1"]], ops), [[b"tag1", b"new"]])
+
+    def test_writes_append_segments(self):
+        self._run(["--add=pass1", "tag1"])
+        self.assertEqual(changelog.list_segments(self.bdd_filename), []) # the first write creates the bdd file
+        self._run(["--add=pass2", "tag2"])
+        self._run(["--select=0", "--update=new1"])
+        self._run(["--select=1", "--remove"])
+        self.assertEqual(len(changelog.list_segments(self.bdd_filename)), 3)
+        self.assertEqual(self._get_bdd(), [[b"tag1", b"new1"]])
+
+        self._run(["--compact"])
+        self.assertEqual(changelog.list_segments(self.bdd_filename), [])
+        self.assertFalse(os.path.exists(changelog.segment_dir(self.bdd_filename)))
+        self.assertEqual(self._get_bdd(), [[b"tag1", b"new1"]])
+
+    def test_automatic_compaction(self):
+        self._run(["--add=pass1", "tag1"])
+        self._run(["--add=pass2", "tag2"], max_segments=2)
+        self.assertEqual(len(changelog.list_segments(self.bdd_filename)), 1)
+        self._run(["--add=pass3", "tag3"], max_segments=2)
+        self.assertEqual(changelog.list_segments(self.bdd_filename), [])
+        self.assertEqual(len(self._get_bdd()), 3)
+
+    def test_stale_segments_are_ignored(self):
+        self._run(["--add=pass1", "tag1"])
+        self._run(["--add=pass2", "tag2"])
+        segment = changelog.list_segments(self.bdd_filename)[0]
+        stale = os.path.join(self.tmp_dir, "stale.gpg")
+        shutil.copy(segment, stale)
+
+        self._run(["--compact"])
+        os.makedirs(changelog.segment_dir(self.bdd_filename))
+        shutil.copy(stale, os.path.join(changelog.segment_dir(self.bdd_filename), os.path.basename(segment)))
+        self.assertEqual(changelog.list_segments(self.bdd_filename), [])
+        self.assertEqual(len(self._get_bdd()), 2)
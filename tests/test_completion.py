@@ -0,0 +1,120 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import mock
+
+from skrm import completion
+from skrm.vault import Vault
+from skrm.keyring_manager import KeyringManager
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+
+class TestCompletion(unittest.TestCase):
+    def setUp(self):
+        self.bdd = [[b"Password", b"WebSite", b"Twitter", b"pass1"],
+                    [b"password", b"Bank", b"pass2"],
+                    [b"Pin", b"Bank", b"1234"],
+                    [b"Passport", b"pass3"],
+                    [b"tab\ttag", b"pass4"]]
+        self.vocabulary = completion.Vocabulary.from_lines(completion.build(self.bdd))
+
+    def test_complete(self):
+        self.assertEqual(self.vocabulary.complete("pa"), ["Password", "Passport"])
+        self.assertEqual(self.vocabulary.complete("PIN"), ["Pin"])
+        self.assertEqual(self.vocabulary.complete("", limit=2), ["Bank", "Password"])
+        self.assertEqual(self.vocabulary.complete("tab"), [])
+        self.assertEqual(self.vocabulary.complete("x"), [])
+
+    def test_narrowed_by_typed_tags(self):
+        self.assertEqual(self.vocabulary.complete("p", ["bank"]), ["Password", "Pin"])
+        self.assertEqual(self.vocabulary.complete("", ["bank", "pin"]), [])
+        self.assertEqual(self.vocabulary.complete("", ["twitter"]), ["Password", "WebSite"])
+        self.assertEqual(self.vocabulary.complete("", ["unknown"]), [])
+
+    def test_truncated_cooccurrences_do_not_narrow(self):
+        bdd = [[b"common", ("tag%d" % i).encode("utf8"), b"key"] for i in range(completion.MAX_COOCCURRENCES + 1)]
+        vocabulary = completion.Vocabulary.from_lines(completion.build(bdd))
+        self.assertEqual(len(vocabulary.complete("tag", ["common"])), completion.MAX_COOCCURRENCES + 1)
+        self.assertEqual(vocabulary.complete("", ["tag1"]), ["common"])
+
+
+@mock.patch('skrm.vault.Vault._save_raw_bdd', side_effect=fake_save_raw_bdd, autospec=True)
+@mock.patch('skrm.vault.Vault.load_raw_bdd', side_effect=fake_load_raw_bdd, autospec=True)
+class TestCompletionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _vault(self):
+        vault = Vault(self.bdd_filename)
+        vault.completion = True
+        return vault
+
+    def test_refreshed_on_save(self, mocked_load, mocked_save):
+        with self._vault() as vault:
+            vault.add(["Password", "Twitter"], "pass1")
+        self.assertEqual(stat.S_IMODE(os.stat(completion.cache_path(self.bdd_filename)).st_mode), 0o600)
+        with open(completion.cache_path(self.bdd_filename), "rb") as f:
+            self.assertNotIn(b"pass1", f.read())
+
+        mocked_load.reset_mock()
+        self.assertEqual(self._vault().complete("tw"), ["Twitter"])
+        self.assertEqual(mocked_load.call_count, 0)
+
+        with self._vault() as vault:
+            vault.add(["Password", "Bank"], "pass2")
+        self.assertEqual(self._vault().complete("", ["password"]), ["Bank", "Twitter"])
+        self.assertEqual(mocked_load.call_count, 1) # only the add decrypted the bdd
+
+    @mock.patch('skrm.completion.CHUNK_LINES', 2)
+    def test_only_needed_chunks_are_read(self, mocked_load, mocked_save):
+        with self._vault() as vault:
+            for i in range(10):
+                vault.add(["Tag%d" % i, "Common"], "pass%d" % i)
+            vault.add(["Tag3", "Other"], "pass")
+        with mock.patch('skrm.completion._split', side_effect=completion._split) as mocked_split:
+            self.assertEqual(self._vault().complete("tag", ["other"]), ["Tag3"])
+            self.assertEqual(mocked_split.call_count, 2) # the chunk of OTHER and the one of TAG3
+            self.assertEqual(len(self._vault().complete("TAG")), 10)
+
+    def test_unusable_cache_suggests_nothing(self, mocked_load, mocked_save):
+        with self._vault() as vault:
+            vault.add(["Password", "Twitter"], "pass1")
+        self.assertIsNotNone(completion.read(self.bdd_filename))
+        shutil.copy(self.bdd_filename, self.bdd_filename + ".restored")
+        os.replace(self.bdd_filename + ".restored", self.bdd_filename) # the bdd file replaced, by a restore
+        self.assertIsNone(completion.read(self.bdd_filename))
+        with open(completion.cache_path(self.bdd_filename), "wb") as f:
+            f.write(b"garbage")
+        self.assertIsNone(completion.read(self.bdd_filename))
+        mocked_load.reset_mock()
+        self.assertEqual(self._vault().complete("p"), []) # the bdd file is not decrypted instead
+        self.assertEqual(mocked_load.call_count, 0)
+        with self._vault() as vault: # until a write command rewrites the cache
+            vault.add(["Pin"], "1234")
+        self.assertEqual(self._vault().complete("p"), ["Password", "Pin"])
+
+    @mock.patch('builtins.print')
+    def test_command_complete_never_decrypts(self, mocked_print, mocked_load, mocked_save):
+        KeyringManager("", self.bdd_filename, ["--add=pass1", "Password", "Twitter"]).run() # no completion cache
+        mocked_load.reset_mock()
+        mocked_print.reset_mock()
+        for argv in (["--complete=t", "password"], ["--complete="], ["--complete=p"]):
+            KeyringManager("", self.bdd_filename, argv).run()
+        self.assertEqual(mocked_load.call_count, 0)
+        self.assertEqual(mocked_print.call_count, 0)
+
+    @mock.patch('builtins.print')
+    def test_command_complete(self, mocked_print, mocked_load, mocked_save):
+        prefs = os.path.join(self.tmp_dir, "user.prefs")
+        with open(prefs, "w") as f:
+            f.write("completion=True\n")
+        KeyringManager(prefs, self.bdd_filename, ["--add=pass1", "Password", "Twitter"]).run()
+        mocked_print.reset_mock()
+        KeyringManager(prefs, self.bdd_filename, ["--complete=t", "password"]).run()
+        self.assertEqual([call[0][0] for call in mocked_print.call_args_list], ["Twitter"])
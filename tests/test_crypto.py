@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import bdd_format
+from skrm import crypto
+from skrm.vault import Vault, SkrmError, DecryptError
+from skrm.keyring_manager import KeyringManager
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+RECIPIENT = "Poncin Matthieu"
+
+
+class TestGpgBackend(unittest.TestCase):
+    def test_recipients(self):
+        self.assertEqual(crypto.recipient_args("Alice, Bob <bob@example.com>,"),
+                         ["-r", "Alice", "-r", "Bob <bob@example.com>"])
+        backend = Vault("bdd.gpg", recipient=RECIPIENT + ",Alice").crypto_backend(crypto.GPG)
+        with mock.patch.object(crypto.GpgBackend, "run_gpg", return_value=(b"", "", 0), autospec=True) as mocked_gpg:
+            backend.encrypt(b"raw", "bdd.gpg", "tmp.gpg")
+        self.assertEqual(mocked_gpg.call_args[0][1], ["gpg", "--yes", "-e", "-r", RECIPIENT, "-r", "Alice", "-o", "tmp.gpg"])
+        key_ids = backend.key_ids(RECIPIENT)
+        with self.assertRaises(crypto.EncryptError):
+            backend.key_ids("Nobody Known")
+        self.assertEqual(backend.message_key_ids(backend.run_gpg(["gpg", "-e", "-r", RECIPIENT], b"raw")[0]) - key_ids, set())
+
+
+@unittest.skipUnless(cryptography, "the envelope encryption needs the cryptography package")
+class TestEnvelopeBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _vault(self, encryption=crypto.ENVELOPE, recipient=RECIPIENT):
+        vault = Vault(self.bdd_filename, recipient=recipient)
+        vault.encryption = encryption
+        return vault
+
+    def test_round_trip(self):
+        with self._vault() as vault:
+            vault.add(["Password", "Twitter"], "pass1")
+        self.assertEqual(crypto.detect(self.bdd_filename), crypto.ENVELOPE)
+        with open(self.bdd_filename, "rb") as f:
+            self.assertNotIn(b"pass1", f.read())
+        self.assertEqual(self._vault().open().bdd, [[b"Password", b"Twitter", b"pass1"]])
+        self.assertEqual(self._vault(crypto.GPG).open().bdd, [[b"Password", b"Twitter", b"pass1"]]) # read by the backend which wrote it
+        self.assertEqual([m.keyring for m in self._vault().get(["twitter"], limit=1)], [[b"Password", b"Twitter", b"pass1"]])
+
+        with self._vault(crypto.GPG) as vault: # back to gpg on the next save
+            vault.add(["Bank"], "pass2")
+        self.assertEqual(crypto.detect(self.bdd_filename), crypto.GPG)
+        self.assertEqual(len(self._vault().open().bdd), 2)
+
+    def test_data_key_wrapped_once(self):
+        with self._vault() as vault:
+            vault.add(["Password"], "pass1")
+        wrapped_key = vault.crypto_backend().wrapped_key
+        vault = self._vault()
+        with mock.patch.object(crypto.GpgBackend, "run_gpg", side_effect=crypto.GpgBackend.run_gpg, autospec=True) as mocked_gpg:
+            with vault:
+                vault.add(["Bank"], "pass2")
+            self.assertEqual(mocked_gpg.call_count, 1) # unwrapping the data key, the save reuses the wrapped one
+            with vault:
+                vault.add(["Pin"], "pass3")
+            self.assertEqual(mocked_gpg.call_count, 1)
+        self.assertEqual(vault.crypto_backend().wrapped_key, wrapped_key)
+        with open(self.bdd_filename, "rb") as f:
+            self.assertIn(wrapped_key, f.read())
+
+        vault = self._vault()
+        vault.open()
+        vault.recipient = "Another Recipient"
+        vault.add(["Card"], "pass4")
+        with mock.patch.object(crypto.GpgBackend, "run_gpg", side_effect=crypto.GpgBackend.run_gpg, autospec=True) as mocked_gpg:
+            with self.assertRaises(crypto.EncryptError): # no key for this recipient
+                vault.commit()
+            self.assertEqual(mocked_gpg.call_args[0][1][:4], ["gpg", "--yes", "-e", "-r"]) # re-wrapped for the new recipient
+
+    def test_modified_content(self):
+        with self._vault() as vault:
+            vault.add(["Password"], "pass1")
+        with open(self.bdd_filename, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+        with self.assertRaises(DecryptError):
+            self._vault().open()
+        self.assertIn("modified", self._vault().verify_bdd_file(self.bdd_filename))
+        with open(self.bdd_filename, "wb") as f:
+            f.write(crypto.MAGIC + b"\x00")
+        with self.assertRaises(DecryptError):
+            self._vault().open()
+
+
+@unittest.skipUnless(cryptography, "the envelope encryption needs the cryptography package")
+class TestSealedKeys(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _vault(self, seal_keys=True):
+        vault = Vault(self.bdd_filename, recipient=RECIPIENT)
+        vault.encryption = crypto.ENVELOPE
+        vault.seal_keys = seal_keys
+        return vault
+
+    def test_only_matched_keys_are_unsealed(self):
+        with self._vault() as vault:
+            for i in range(5):
+                vault.add(["Tag%d" % i, "Common"], "pass%d" % i)
+        vault = self._vault()
+        raw = vault.load_raw_bdd()
+        self.assertEqual(bdd_format.detect_version(raw), bdd_format.VERSION_3)
+        self.assertNotIn(b"pass", raw) # decrypting the file only exposes the tags
+        self.assertIn(b"Common", raw)
+
+        vault = self._vault()
+        with mock.patch.object(crypto.EnvelopeBackend, "open_key", side_effect=crypto.EnvelopeBackend.open_key,
+                               autospec=True) as mocked_open:
+            self.assertEqual([m.key for m in vault.get(["tag3"])], [b"pass3"])
+            self.assertEqual(mocked_open.call_count, 1)
+            with vault:
+                vault.update(1, "new1")
+                vault.add(["Tag5"], "pass5")
+            self.assertEqual(mocked_open.call_count, 2) # the original of the updated keyring, others are saved as sealed
+        self.assertEqual([keyring[-1] for keyring in self._vault().open().bdd], [b"pass0", b"new1", b"pass2", b"pass3", b"pass4", b"pass5"])
+
+        vault = self._vault()
+        vault.parallel_search_threshold = 1
+        vault.search_workers = 2
+        with mock.patch.object(crypto.EnvelopeBackend, "open_key", side_effect=crypto.EnvelopeBackend.open_key,
+                               autospec=True) as mocked_open:
+            self.assertEqual([m.key for m in vault.search(["tag[35]"])], [b"pass3", b"pass5"])
+            self.assertEqual(mocked_open.call_count, 2)
+
+    def test_keys_unsealed_when_disabled(self):
+        with self._vault() as vault:
+            vault.add(["Password"], "pass1")
+        with self._vault(seal_keys=False) as vault:
+            vault.add(["Bank"], "pass2")
+        raw = self._vault().load_raw_bdd()
+        self.assertEqual(bdd_format.detect_version(raw), bdd_format.VERSION_2)
+        self.assertIn(b"pass1", raw)
+        vault = self._vault()
+        vault.encryption = crypto.GPG
+        with self.assertRaises(SkrmError):
+            with vault:
+                vault.add(["Pin"], "pass3")
+
+    @mock.patch('builtins.print')
+    def test_command_get(self, mocked_print):
+        prefs = os.path.join(self.tmp_dir, "user.prefs")
+        with open(prefs, "w") as f:
+            f.write("encryption=envelope\nseal_keys=True\nrecipient=" + RECIPIENT + "\n")
+        KeyringManager(prefs, self.bdd_filename, ["--add=pass1", "Password", "Twitter"]).run()
+        KeyringManager(prefs, self.bdd_filename, ["--add=pass2", "Password", "Bank"]).run()
+        mocked_print.reset_mock()
+        with mock.patch.object(crypto.EnvelopeBackend, "open_key", side_effect=crypto.EnvelopeBackend.open_key,
+                               autospec=True) as mocked_open:
+            KeyringManager(prefs, self.bdd_filename, ["--no-agent", "--format=tsv", "bank"]).run()
+            self.assertEqual(mocked_open.call_count, 1)
+
+    @mock.patch('builtins.print')
+    def test_command_limit_and_select(self, mocked_print):
+        prefs = os.path.join(self.tmp_dir, "user.prefs")
+        with open(prefs, "w") as f:
+            f.write("encryption=envelope\nseal_keys=True\nrecipient=" + RECIPIENT + "\n")
+        for i in range(5):
+            KeyringManager(prefs, self.bdd_filename, ["--add=pass%d" % i, "Password", "Site%d" % i]).run()
+        for argv in (["--limit=1", "site3"], ["--limit=1", "--search", "site"], ["--select=4"]):
+            with mock.patch.object(crypto.EnvelopeBackend, "open_key", side_effect=crypto.EnvelopeBackend.open_key,
+                                   autospec=True) as mocked_open:
+                KeyringManager(prefs, self.bdd_filename, ["--no-agent", "--format=tsv"] + argv).run()
+                self.assertEqual(mocked_open.call_count, 1) # only the key printed is unsealed
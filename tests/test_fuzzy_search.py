@@ -0,0 +1,46 @@
+import unittest
+
+from skrm.fuzzy_search import FuzzySearch, bounded_distance
+from skrm.tag_index import TagIndex
+
+
+def _distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class TestFuzzySearch(unittest.TestCase):
+    def setUp(self):
+        self.bdd = [[b"Password", b"WebSite", b"Twitter", b"pass1"],
+                    [b"Password", b"twitter.com", b"pass2"],
+                    [b"Pin", b"Bank", b"Caf\xc3\xa9", b"1234"],
+                    [b"mail", b"gmail.com", b"pass3"],
+                    [b"Passport", b"pass4"]]
+        self.fuzzy = FuzzySearch(TagIndex(self.bdd))
+
+    def test_bounded_distance(self):
+        words = ["", "a", "ab", "ba", "abc", "acb", "twitter", "twiter", "twitterr", "switer", "kitten", "sitting"]
+        for a in words:
+            for b in words:
+                for bound in range(4):
+                    distance = _distance(a, b)
+                    self.assertEqual(bounded_distance(a, b, bound), distance if distance <= bound else None, (a, b, bound))
+
+    def test_similar_tags(self):
+        scores = self.fuzzy.similar_tags("twiter")
+        self.assertGreater(scores["TWITTER"], scores["TWITTER.COM"])
+        self.assertNotIn("PIN", scores)
+        self.assertEqual(self.fuzzy.similar_tags("password")["PASSWORD"], 1.0)
+        self.assertEqual(list(self.fuzzy.similar_tags("cafe")), ["CAFÉ"])
+
+    def test_top(self):
+        self.assertEqual(self.fuzzy.top(["pasword", "twiter"]), [0, 1])
+        self.assertEqual(self.fuzzy.top(["passport"]), [4, 0, 1])
+        self.assertEqual(self.fuzzy.top(["passport"], limit=2), [4, 0])
+        self.assertEqual(self.fuzzy.top(["bnk"]), [2])
+        self.assertEqual(self.fuzzy.top(["nothing"]), [])
@@ -0,0 +1,95 @@
+import io
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import import_export
+from skrm.keyring_manager import KeyringManager
+from skrm.vault import Vault, SkrmError
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+
+class TestImportExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd = [[b"Password", b"WebSite", b"Twitter", b"my,pass"],
+                    [b"Pin", b"1234"],
+                    [b"Caf\xc3\xa9", b"key\nwith newline"]]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_detect_format(self):
+        self.assertEqual(import_export.detect_format("a.csv"), ("csv", False))
+        self.assertEqual(import_export.detect_format("a.jsonl.gpg"), ("jsonl", True))
+        with self.assertRaises(ValueError):
+            import_export.detect_format("a.txt")
+
+    def test_round_trip(self):
+        for name in ("export.csv", "export.jsonl"):
+            import_export.export_records(self.bdd, self._path(name))
+            vault = Vault("")
+            vault.bdd = []
+            self.assertEqual(import_export.import_records(vault, self._path(name)), len(self.bdd))
+            self.assertEqual(vault.bdd, self.bdd)
+            self.assertEqual(vault.ops, [("add", keyring) for keyring in self.bdd])
+
+    def test_export_only_readable_by_owner(self):
+        open(self._path("export.csv"), "w").close()
+        os.chmod(self._path("export.csv"), 0o644)
+        for name in ("export.csv", "export.jsonl"):
+            import_export.export_records(self.bdd, self._path(name))
+            self.assertEqual(stat.S_IMODE(os.stat(self._path(name)).st_mode), 0o600)
+
+    def test_encrypted_round_trip(self):
+        import_export.export_records(self.bdd, self._path("export.jsonl.gpg"), "Poncin Matthieu")
+        with open(self._path("export.jsonl.gpg"), "rb") as f:
+            self.assertNotIn(b"Twitter", f.read())
+        self.assertEqual(list(import_export.read_records(self._path("export.jsonl.gpg"))), self.bdd)
+
+    def test_columns(self):
+        stream = io.StringIO("name,url,login,password,notes\nTwitter,twitter.com,me,pass1,\nBank,,,1234,pin\n")
+        keyrings = list(import_export.read_csv(stream, ["name", "url", "login"], "password"))
+        self.assertEqual(keyrings, [[b"Twitter", b"twitter.com", b"me", b"pass1"], [b"Bank", b"1234"]])
+
+        stream = io.StringIO('{"name": "Twitter", "password": "pass1"}\n\n{"name": "Bank", "password": "1234"}\n')
+        keyrings = list(import_export.read_jsonl(stream, None, "password"))
+        self.assertEqual(keyrings, [[b"Twitter", b"pass1"], [b"Bank", b"1234"]])
+
+        with self.assertRaises(SkrmError):
+            list(import_export.read_jsonl(io.StringIO('{"tags": ["a"]}\n')))
+
+    def test_missing_key(self):
+        stream = io.StringIO("name,url,password\nTwitter,twitter.com,pass1\nBank,bank.com\n")
+        with self.assertRaisesRegex(SkrmError, "line 3"):
+            list(import_export.read_csv(stream, None, "password"))
+        stream = io.StringIO('{"name": "Twitter", "password": "pass1"}\n{"name": "Bank", "password": ""}\n')
+        with self.assertRaisesRegex(SkrmError, "line 2"):
+            list(import_export.read_jsonl(stream, None, "password"))
+        for line in ('{"tags": ["a"], "key": null}', '{"tags": ["a"], "key": ""}'):
+            with self.assertRaisesRegex(SkrmError, "line 1"):
+                list(import_export.read_jsonl(io.StringIO(line + "\n")))
+        with self.assertRaisesRegex(SkrmError, "must be a list"):
+            list(import_export.read_jsonl(io.StringIO('{"tags": "abc", "key": "pass"}\n')))
+
+    @mock.patch('skrm.keyring_manager.KeyringManager.load_raw_bdd', fake_load_raw_bdd)
+    @mock.patch('skrm.keyring_manager.KeyringManager._save_raw_bdd', side_effect=fake_save_raw_bdd, autospec=True)
+    def test_command_import_saves_once(self, mocked_save):
+        bdd_filename = self._path("bdd.gpg")
+        with open(self._path("import.csv"), "w") as f:
+            f.write("site,password\n")
+            for i in range(20):
+                f.write("site%d,pass%d\n" % (i, i))
+        KeyringManager("", bdd_filename, ["--import=" + self._path("import.csv"), "--key-column=password"]).run()
+        self.assertEqual(mocked_save.call_count, 1)
+        self.assertEqual(KeyringManager("", bdd_filename, []).load_bdd()[19], [b"site19", b"pass19"])
+
+        KeyringManager("", bdd_filename, ["--export=" + self._path("export.csv")]).run()
+        with open(self._path("export.csv")) as f:
+            self.assertEqual(f.readline().strip(), "key,tag1")
@@ -1,5 +1,8 @@
 
+import io
 import os
+import shutil
+import tempfile
 import unittest
 import mock
 
@@ -58,6 +61,9 @@ class TestKeyringManager(unittest.TestCase):
 
     def _clean_bdd(self):
         self._clean_file(self.bdd_filename)
+        self._clean_file(self.bdd_filename + ".backup-manifest.json")
+        self._clean_file(self.bdd_filename + ".backup-manifest.json.lock")
+        self._clean_file(self.bdd_filename + ".lock")
 
     @staticmethod
     def _clean_file(f):
@@ -110,6 +116,26 @@ class TestKeyringManager(unittest.TestCase):
         keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--get", "tag1"]).run()
         keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--clip", "--get", "tag2"]).run()
 
+    @mock.patch('skrm.keyring_manager.KeyringManager.print_keyring', side_effect=lambda *args: None)
+    def test_command_get_limit(self, mocked_print):
+        self.test_command_add_multiple()
+        with self.assertRaises(SystemExit) as cm:
+            KeyringManager("", self.bdd_filename, self.default_arguments + ["--limit=first"])
+        self.assertEqual(cm.exception.code, 1)
+
+        keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--no-agent", "--limit=2", "tag1"])
+        self.assertEqual(keyring_manager.limit, 2)
+        keyring_manager.run()
+        self.assertEqual([call[0][0] for call in mocked_print.call_args_list], [0, 1])
+        self.assertIsNone(keyring_manager.bdd) # streamed, never fully loaded
+
+        KeyringManager("", self.bdd_filename, self.default_arguments + ["--no-agent", "--limit=1", "-s", "TAG[45]"]).run()
+        self.assertEqual(mocked_print.call_args_list[-1][0][0], 1)
+
+        with self.assertRaises(SystemExit) as cm:
+            KeyringManager("", self.bdd_filename, self.default_arguments + ["--no-agent", "--select=3"]).run()
+        self.assertEqual(cm.exception.code, 1)
+
     def _mocked_print(*args, **kwargs):
         pass
 
@@ -128,6 +154,36 @@ class TestKeyringManager(unittest.TestCase):
         KeyringManager("", self.bdd_filename, self.default_arguments + ["--search", "tag5"]).run()
         self.assertEqual(mocked_print.call_count, 6)
 
+    @mock.patch('skrm.keyring_manager.KeyringManager.print_keyring', side_effect=_mocked_print)
+    def test_command_fuzzy(self, mocked_print):
+        self.test_command_add_multiple()
+
+        keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--fuzzy", "tag"])
+        self.assertEqual(keyring_manager.command, "fuzzy")
+        keyring_manager.run()
+        self.assertEqual(mocked_print.call_count, 3)
+
+        KeyringManager("", self.bdd_filename, self.default_arguments + ["--fuzzy", "--limit=1", "tag4"]).run()
+        self.assertEqual(mocked_print.call_count, 4)
+        self.assertEqual(mocked_print.call_args[0][1][-1], b"fake_pass_2")
+
+    def test_command_format(self):
+        self.test_command_add_multiple()
+        with self.assertRaises(SystemExit) as cm:
+            KeyringManager("", self.bdd_filename, ["--format=xml"])
+        self.assertEqual(cm.exception.code, 1)
+
+        def output(arguments):
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                KeyringManager("", self.bdd_filename, self.default_arguments + ["--no-agent"] + arguments).run()
+            return stdout.getvalue()
+
+        self.assertEqual(output(["--format=tsv", "tag4"]), "1\ttag1\ttag2\ttag4\tfake_pass_2\n")
+        self.assertEqual(output(["--format=json", "--select=2"]),
+                         '{"id": 2, "tags": ["tag1", "tag5"], "key": "fake_pass_2"}\n')
+        self.assertEqual(output(["--only=keys", "tag2"]), "fake_pass_1\nfake_pass_2\n")
+        self.assertEqual(output(["--format=null", "--only=ids", "-s", "TAG[45]"]), "1\x002\x00")
+
     @mock.patch('skrm.keyring_manager.KeyringManager.print_keyring', side_effect=_mocked_print)
     def test_command_remove(self, mocked_print):
         self.test_command_add_multiple()
@@ -171,11 +227,29 @@ class TestKeyringManager(unittest.TestCase):
         new_bdd = self._get_bdd()
         self.assertEqual(new_bdd[1][-1].decode('utf8'), new_key)
 
+    def test_command_migrate(self):
+        keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--add=pass"] + ["tag1"])
+        keyring_manager.bdd_version = 1
+        keyring_manager.run()
+        keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--get"])
+        self.assertEqual(keyring_manager.load_raw_bdd(), b"tag1\x02pass")
+
+        KeyringManager("", self.bdd_filename, self.default_arguments + ["--migrate"]).run()
+        keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--get"])
+        raw_bdd = keyring_manager.load_raw_bdd()
+        self.assertEqual(keyring_manager.parse_raw(raw_bdd), [[b"tag1", b"pass"]])
+        self.assertEqual(keyring_manager.bdd_version, 2)
+
+    def _backup_dest(self):
+        """ Return a backup destination in a temporary directory removed after the test """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return os.path.join(directory, "fake_dest")
+
     def test_command_backup_and_restore(self):
         self.test_command_add_multiple()
 
-        backup_dest = "fake_dest"
-        self._clean_file(backup_dest)
+        backup_dest = self._backup_dest()
 
         keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["--backup=" + backup_dest])
         self.assertEqual(keyring_manager.command, "backup")
@@ -200,11 +274,10 @@ class TestKeyringManager(unittest.TestCase):
     def test_command_quick_backup_and_restore(self):
         self.test_command_add_multiple()
 
-        backup_dest = "fake_dest"
-        self._clean_file(backup_dest)
+        backup_dest = self._backup_dest()
 
         keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["-b"])
-        keyring_manager.backup_location = "fake_dest"
+        keyring_manager.backup_location = backup_dest
         self.assertEqual(keyring_manager.command, "quick_backup")
         keyring_manager.run()
 
@@ -216,7 +289,7 @@ class TestKeyringManager(unittest.TestCase):
         assert not os.path.exists(self.bdd_filename)
 
         keyring_manager = KeyringManager("", self.bdd_filename, self.default_arguments + ["-r"])
-        keyring_manager.backup_location = "fake_dest"
+        keyring_manager.backup_location = backup_dest
         self.assertEqual(keyring_manager.command, "quick_restore")
         keyring_manager.run()
 
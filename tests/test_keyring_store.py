@@ -0,0 +1,64 @@
+import unittest
+
+from skrm import bdd_format
+from skrm import keyring_store
+
+
+class TestKeyringStore(unittest.TestCase):
+    def setUp(self):
+        self.bdd = [[b"Password", b"WebSite", b"myPass"],
+                    [b"Pin", b"Bank", b"1234"],
+                    [b"key only"],
+                    [b"Empty", b""],
+                    [b"password", b"Bank", b"pass2"]]
+
+    def test_parse(self):
+        for raw in [bdd_format.serialize_v1(self.bdd), bdd_format.serialize_v2(self.bdd)]:
+            store = keyring_store.parse(raw)
+            self.assertEqual(store, bdd_format.parse(raw))
+            self.assertEqual(len(store), 5)
+            self.assertEqual(store[-1], [b"password", b"Bank", b"pass2"])
+            self.assertEqual(store[1:3], [[b"Pin", b"Bank", b"1234"], [b"key only"]])
+            self.assertIs(store.buffers[0], raw)
+            start = store.key_start[0]
+            self.assertEqual(raw[start:start + store.key_length[0]], b"myPass") # the key is a slice of raw
+        self.assertEqual(keyring_store.parse(b""), [])
+        with self.assertRaises(ValueError):
+            keyring_store.parse(bdd_format.serialize_v2(self.bdd)[:-3])
+
+    def test_interned_tags(self):
+        store = keyring_store.parse(bdd_format.serialize_v2(self.bdd))
+        self.assertEqual(store.tags, [b"Password", b"WebSite", b"Pin", b"Bank", b"Empty", b"password"])
+        self.assertEqual(store.folded_tags(4), ["PASSWORD", "BANK"])
+        self.assertEqual(store.tag_ids_of(1)[1], store.tag_ids_of(4)[1])
+
+    def test_sealed_keys(self):
+        sealed = [keyring[:-1] + [b"sealed:" + keyring[-1]] for keyring in self.bdd]
+        store = keyring_store.parse(bdd_format.serialize(sealed, bdd_format.VERSION_3))
+        opened = []
+        store.key_opener = lambda key: opened.append(key) or key[len(b"sealed:"):]
+        self.assertEqual([keyring[-1] for keyring in store.iter_metadata()], [None] * 5)
+        self.assertEqual(opened, [])
+        self.assertEqual(store[1], [b"Pin", b"Bank", b"1234"])
+        self.assertEqual(opened, [b"sealed:1234"]) # only the key of the keyring built
+        store[0] = [b"Password", b"WebSite", b"newPass"] # keys set afterwards are kept in clear
+        self.assertEqual(store.sealed_key(0), None)
+        self.assertEqual(store.sealed_key(1), b"sealed:1234")
+        self.assertEqual(list(store), [[b"Password", b"WebSite", b"newPass"]] + self.bdd[1:])
+
+    def test_mutations(self):
+        store = keyring_store.parse(bdd_format.serialize_v2(self.bdd))
+        store.insert(1, ["New", "Bank", "pass3"])
+        store.append([b"last", b"pass4"])
+        store[0] = [b"Password", b"WebSite", b"newPass"]
+        store[3] = [b"key", b"only"]
+        del store[2]
+        self.bdd[0][2] = b"newPass"
+        self.bdd[2] = [b"key", b"only"]
+        del self.bdd[1]
+        self.bdd.insert(1, [b"New", b"Bank", b"pass3"])
+        self.bdd.append([b"last", b"pass4"])
+        self.assertEqual(store, self.bdd)
+        self.assertEqual(bdd_format.parse(bdd_format.serialize_v2(store)), self.bdd)
+        with self.assertRaises(IndexError):
+            store[len(store)]
@@ -1,10 +1,56 @@
-
 import sys
 import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 import mock
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules only some commands need, which --help must not import
+HEAVY_MODULES = ["subprocess", "tempfile", "json", "uuid", "concurrent.futures", "shutil", "hashlib"]
+# modules a lookup given tags alone must not import before decrypting: getopt imports gettext and re,
+# the agent client imports json, which imports re
+PARSING_MODULES = ["getopt", "gettext", "re", "json", "socket"]
+RUN = """
+import sys
+from skrm.__main__ import main
+try:
+    main(%r)
+except SystemExit:
+    pass
+sys.stdout.write("\\nIMPORTED " + " ".join(sorted(m for m in %r if m in sys.modules)))
+"""
+
+
+def run(argv, modules):
+    """ Run skrm with argv in a new interpreter and an empty home directory, return the modules imported among modules """
+    home = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ, PYTHONPATH=ROOT, HOME=home)
+        p = subprocess.run([sys.executable, "-c", RUN % (argv, modules)], cwd=ROOT, env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    finally:
+        shutil.rmtree(home)
+    return p.stdout.rsplit("IMPORTED", 1)[1].split()
+
+
+def run_help():
+    """ Run skrm --help in a new interpreter, return the modules imported among HEAVY_MODULES """
+    return run(["--help"], HEAVY_MODULES)
+
 
 class TestMain(unittest.TestCase):
     def test_main(self):
         from skrm import __main__
+        with mock.patch('builtins.print'):
+            with self.assertRaises(SystemExit) as cm:
+                __main__.main(["--help"])
+        self.assertEqual(cm.exception.code, 0)
+
+    def test_cold_start(self):
+        self.assertEqual(run_help(), [])
+
+    def test_lookup_without_getopt(self):
+        self.assertEqual(run(["sometag", "other"], PARSING_MODULES), [])
+        self.assertIn("getopt", run(["--get", "sometag"], PARSING_MODULES))
@@ -0,0 +1,65 @@
+import io
+import json
+import unittest
+
+from skrm import output
+
+
+class TestOutputWriter(unittest.TestCase):
+    def setUp(self):
+        self.matches = [(0, [b"Password", b"Web\tSite", b"my\\pass"]),
+                        (3, [b"Caf\xc3\xa9", b"new\nline"]),
+                        (7, [b"key only"])]
+
+    def _write(self, format, only=None, chunk_size=output.CHUNK_SIZE):
+        stream = io.BytesIO()
+        writer = output.OutputWriter(stream, format, only, chunk_size)
+        for i, keyring in self.matches:
+            writer.write(i, keyring)
+        writer.flush()
+        return stream.getvalue()
+
+    def test_json(self):
+        lines = self._write(output.JSON).decode("utf8").splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{"id": 0, "tags": ["Password", "Web\tSite"], "key": "my\\pass"},
+                          {"id": 3, "tags": ["Café"], "key": "new\nline"},
+                          {"id": 7, "tags": [], "key": "key only"}])
+        self.assertEqual(self._write(output.JSON, output.KEYS), b'"my\\\\pass"\n"new\\nline"\n"key only"\n')
+
+    def test_tsv(self):
+        self.assertEqual(self._write(output.TSV), b"0\tPassword\tWeb\\tSite\tmy\\\\pass\n"
+                                                  b"3\tCaf\xc3\xa9\tnew\\nline\n"
+                                                  b"7\tkey only\n")
+        self.assertEqual(self._write(output.TEXT, output.KEYS), b"my\\\\pass\nnew\\nline\nkey only\n")
+
+    def test_null(self):
+        self.assertEqual(self._write(output.NULL), b"0\x002\x00Password\x00Web\tSite\x00my\\pass\x00"
+                                                   b"3\x001\x00Caf\xc3\xa9\x00new\nline\x00"
+                                                   b"7\x000\x00key only\x00")
+        self.assertEqual(self._write(output.NULL, output.IDS), b"0\x003\x007\x00")
+        self.assertEqual(self._write(output.TSV, output.IDS), b"0\n3\n7\n")
+
+    def test_buffered(self):
+        stream = io.BytesIO()
+        writer = output.OutputWriter(stream, output.TSV, output.IDS, chunk_size=4)
+        writer.write(0, [b"key"])
+        self.assertEqual(stream.getvalue(), b"") # buffered
+        writer.write(10, [b"key"])
+        self.assertEqual(stream.getvalue(), b"0\n10\n") # a chunk is full
+        writer.write(2, [b"key"])
+        writer.flush()
+        self.assertEqual(stream.getvalue(), b"0\n10\n2\n")
+
+    def test_text_stream(self):
+        stream = io.StringIO()
+        writer = output.OutputWriter(stream, output.TSV, output.KEYS)
+        writer.write(0, [b"Caf\xc3\xa9"])
+        writer.flush()
+        self.assertEqual(stream.getvalue(), "Café\n")
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            output.OutputWriter(io.BytesIO(), "xml")
+        with self.assertRaises(ValueError):
+            output.OutputWriter(io.BytesIO(), output.JSON, "tags")
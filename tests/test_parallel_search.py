@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from multiprocessing import shared_memory
+
+from skrm import bdd_format
+from skrm import parallel_search
+from skrm.search_engine import SearchEngine
+from skrm.tag_index import TagIndex
+from skrm.vault import Vault, Match, CorruptedBddError
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+PATTERNS = (["twit"], ["pass", "site"], ["^pin$"], ["\\.com"], ["mail|bank"], ["caf"], ["unknown"], ["pass1"], [])
+BDD = [[b"Password", b"WebSite", b"Twitter", b"pass1"],
+       [b"Password", b"twitter.com", b"pass2"],
+       [b"Pin", b"Bank", b"Caf\xc3\xa9", b"1234"],
+       [b"mail", b"gmail.com", b"pass3"],
+       [b"pass4"]] * 5
+
+
+class TestParallelSearch(unittest.TestCase):
+    def setUp(self):
+        self.raw = bdd_format.serialize_v2(BDD)
+        self.engine = SearchEngine(TagIndex(BDD))
+
+    def test_same_matches_as_search_engine(self):
+        for patterns in PATTERNS:
+            expected = self.engine.search(patterns)
+            for workers in (1, 2, 8): # 8 workers split the records into more ranges than there are records
+                self.assertEqual(parallel_search.search(self.raw, patterns, workers), expected)
+        self.assertEqual(parallel_search.match_records(self.raw, len(self.raw), 6, 12, ["twit"]), [6, 10, 11])
+
+    def test_shared_memory_released(self):
+        blocks = []
+        create = shared_memory.SharedMemory
+
+        def tracked(*args, **kwargs):
+            blocks.append(create(*args, **kwargs))
+            return blocks[-1]
+        with mock.patch.object(shared_memory, "SharedMemory", side_effect=tracked):
+            parallel_search.search(self.raw, ["twit"], 2)
+        self.assertEqual(len(blocks), 1)
+        with self.assertRaises(FileNotFoundError):
+            create(blocks[0].name)
+
+    def test_truncated(self):
+        for workers in (1, 2):
+            with self.assertRaises(ValueError):
+                parallel_search.search(self.raw[:-10], ["twit"], workers)
+
+
+@mock.patch('skrm.vault.Vault._save_raw_bdd', side_effect=fake_save_raw_bdd, autospec=True)
+@mock.patch('skrm.vault.Vault.load_raw_bdd', side_effect=fake_load_raw_bdd, autospec=True)
+class TestVaultParallelSearch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+        self.bdd = BDD
+        self.raw = bdd_format.serialize_v2(BDD)
+        self.engine = SearchEngine(TagIndex(BDD))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _vault(self, threshold):
+        vault = Vault(self.bdd_filename)
+        vault.parallel_search_threshold = threshold
+        vault.search_workers = 2
+        return vault
+
+    def test_search(self, mocked_load, mocked_save):
+        with open(self.bdd_filename, "wb") as f:
+            f.write(self.raw)
+        vault = self._vault(len(self.bdd))
+        matches = vault.search(["twit", "pass"])
+        self.assertEqual(matches, [Match(i, self.bdd[i]) for i in self.engine.search(["twit", "pass"])])
+        self.assertIsNone(vault.bdd) # neither parsed nor indexed
+        self.assertEqual(mocked_load.call_count, 1)
+
+        vault = self._vault(len(self.bdd) + 1)
+        self.assertEqual(vault.search(["twit", "pass"]), matches)
+        self.assertIsNotNone(vault.bdd) # opened from the buffer decrypted, below the threshold
+        self.assertEqual(vault.search(["bank"]), [Match(i, self.bdd[i]) for i in self.engine.search(["bank"])])
+        self.assertEqual(mocked_load.call_count, 2)
+
+        with open(self.bdd_filename, "wb") as f:
+            f.write(self.raw[:-10])
+        with self.assertRaises(CorruptedBddError):
+            self._vault(1).search(["twit"])
+
+    def test_change_log(self, mocked_load, mocked_save):
+        with open(self.bdd_filename, "wb") as f:
+            f.write(self.raw)
+        vault = self._vault(1)
+        vault.changelog = True
+        with vault:
+            vault.add(["Twitter"], "pass5")
+        vault = self._vault(1)
+        self.assertEqual(vault.search(["twit"])[-1], Match(len(self.bdd), [b"Twitter", b"pass5"]))
+        self.assertIsNotNone(vault.bdd) # the segments are replayed on the bdd
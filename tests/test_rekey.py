@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import crypto
+from skrm import rekey
+from skrm import shards
+from skrm.vault import Vault
+from skrm.keyring_manager import KeyringManager
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+RECIPIENT = "Poncin Matthieu"
+OLD_RECIPIENT = "Old Recipient"
+OLD_KEY_ID = "0123456789ABCDEF"
+real_key_ids = crypto.GpgBackend.key_ids
+
+
+def fake_key_ids(self, name):
+    """ An old recipient gpg has no key for, the files being encrypted for RECIPIENT only """
+    return set([OLD_KEY_ID]) if name == OLD_RECIPIENT else real_key_ids(self, name)
+
+
+class TestRekey(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp_dir, "rekey.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def _create(self, name, keyrings, **settings):
+        vault = Vault(self._path(name), recipient=RECIPIENT)
+        for setting, value in settings.items():
+            setattr(vault, setting, value)
+        for tags, key in keyrings:
+            with vault:
+                vault.add(tags, key)
+        return self._path(name)
+
+    def _rekey(self, patterns, old_recipient=None, max_workers=1):
+        reports = []
+        counts = rekey.rekey(patterns, RECIPIENT, old_recipient, journal=self.journal, max_workers=max_workers,
+                             report=lambda *report: reports.append(report))
+        return counts, sorted((os.path.relpath(f, self.tmp_dir), status) for f, status, detail in reports)
+
+    def test_expand(self):
+        for name in ["a.gpg", "a.gpg.lock", "a.gpg.backup.json", "b.gpg", "notes.txt"]:
+            open(self._path(name), "w").close()
+        os.makedirs(self._path("a.gpg.d"))
+        os.makedirs(self._path("shards"))
+        open(os.path.join(self._path("shards"), shards.MANIFEST), "w").close()
+        self.assertEqual(rekey.expand([self._path("*"), self._path("b.gpg"), self._path("shards/")]),
+                         [self._path("a.gpg"), self._path("b.gpg"), self._path("shards")])
+        self.assertEqual(rekey.expand([self._path("missing.gpg")]), [self._path("missing.gpg")])
+
+    def test_rekey(self):
+        self._create("a.gpg", [(["Password"], "pass1")])
+        self._create("b.gpg", [(["Bank"], "pass2"), (["Pin"], "pass3")], changelog=True)
+        self.assertTrue(os.path.isdir(self._path("b.gpg.d")))
+        shards.create(Vault(self._path("a.gpg"), recipient=RECIPIENT), self._path("shards"),
+                      [[b"prod", b"pass4"], [b"dev", b"pass5"]])
+        counts, reports = self._rekey([self._path("*")], max_workers=2)
+        self.assertEqual(counts[rekey.REKEYED], 2 + len(shards.list_files(self._path("shards"))))
+        self.assertEqual(reports[:2], [("a.gpg", rekey.REKEYED), ("b.gpg", rekey.REKEYED)])
+        self.assertEqual(Vault(self._path("b.gpg")).open().bdd, [[b"Bank", b"pass2"], [b"Pin", b"pass3"]])
+        self.assertFalse(os.path.exists(self._path("b.gpg.d"))) # folded into the bdd file
+        self.assertEqual(sorted(Vault(self._path("shards")).open().bdd), [[b"dev", b"pass5"], [b"prod", b"pass4"]])
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual([f for f in os.listdir(self.tmp_dir) if f.startswith(".skrm-")], [])
+
+    @unittest.skipUnless(cryptography, "the envelope encryption needs the cryptography package")
+    def test_rekey_envelope(self):
+        path = self._create("a.gpg", [(["Password"], "pass1"), (["Bank"], "pass2")], encryption=crypto.ENVELOPE,
+                            seal_keys=True)
+        vault = Vault(path)
+        vault.open()
+        data_key = vault.crypto_backend(crypto.ENVELOPE).data_key
+        self.assertEqual(self._rekey([path])[0][rekey.REKEYED], 1)
+        vault = Vault(path)
+        self.assertEqual(vault.open().bdd, [[b"Password", b"pass1"], [b"Bank", b"pass2"]])
+        self.assertEqual(crypto.detect(path), crypto.ENVELOPE)
+        self.assertEqual(vault.bdd_version, 3)
+        self.assertNotEqual(vault.crypto_backend(crypto.ENVELOPE).data_key, data_key) # keys sealed again under a new one
+
+    @mock.patch.object(crypto.GpgBackend, "key_ids", side_effect=fake_key_ids, autospec=True)
+    def test_old_recipients(self, mocked_key_ids):
+        path = self._create("a.gpg", [(["Password"], "pass1")])
+        with open(path, "rb") as f:
+            content = f.read()
+        self.assertEqual(self._rekey([path], OLD_RECIPIENT), ({rekey.REKEYED: 0, rekey.DONE: 0, rekey.SKIPPED: 1,
+                                                               rekey.FAILED: 0}, [("a.gpg", rekey.SKIPPED)]))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self._rekey([path], RECIPIENT)[1], [("a.gpg", rekey.REKEYED)])
+
+    def test_resume(self):
+        paths = [self._create(name, [([name], "pass")]) for name in ["a.gpg", "b.gpg"]]
+        with mock.patch.object(rekey, "verify", side_effect=[None, "not encrypted for " + RECIPIENT]):
+            counts, reports = self._rekey(paths)
+        self.assertEqual(reports, [("a.gpg", rekey.REKEYED), ("b.gpg", rekey.FAILED)])
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertEqual(Vault(paths[1]).open().bdd, [[b"b.gpg", b"pass"]]) # left untouched
+
+        self.assertEqual(self._rekey(paths)[1], [("a.gpg", rekey.DONE), ("b.gpg", rekey.REKEYED)])
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(self._rekey(paths)[1], [("a.gpg", rekey.REKEYED), ("b.gpg", rekey.REKEYED)])
+
+    @mock.patch('builtins.print')
+    def test_command_rekey(self, mocked_print):
+        path = self._create("a.gpg", [(["Password"], "pass1")])
+        prefs = self._path("user.prefs")
+        with open(prefs, "w") as f:
+            f.write("rekey_journal=" + self.journal + "\n")
+        KeyringManager(prefs, path, ["--rekey=" + RECIPIENT, "--jobs=2"]).run()
+        self.assertEqual(mocked_print.call_args_list[-2], mock.call(path + ": " + rekey.REKEYED + " (gpg)"))
+        self.assertEqual(mocked_print.call_args, mock.call("Rekey DONE: 1 rekeyed, 0 already rekeyed, 0 skipped, 0 failed"))
+        with self.assertRaises(SystemExit):
+            KeyringManager(prefs, path, ["--rekey=" + RECIPIENT, self._path("missing.gpg")]).run()
+        self.assertEqual(mocked_print.call_args, mock.call("Run the same command again to resume with the files left."))
@@ -0,0 +1,36 @@
+import unittest
+
+from skrm.search_engine import SearchEngine, patterns_matcher, required_literals
+from skrm.tag_index import TagIndex
+
+
+class TestSearchEngine(unittest.TestCase):
+    def setUp(self):
+        self.bdd = [[b"Password", b"WebSite", b"Twitter", b"pass1"],
+                    [b"Password", b"twitter.com", b"pass2"],
+                    [b"Pin", b"Bank", b"Caf\xc3\xa9", b"1234"],
+                    [b"mail", b"gmail.com", b"pass3"]]
+        self.engine = SearchEngine(TagIndex(self.bdd))
+
+    def test_required_literals(self):
+        self.assertEqual(required_literals("twit"), ["twit"])
+        self.assertEqual(required_literals("tw.t"), ["tw", "t"])
+        self.assertEqual(required_literals("ab*c"), ["a", "c"])
+        self.assertEqual(required_literals("a?b"), ["b"])
+        self.assertEqual(required_literals("(foo)bar"), ["bar"])
+        self.assertEqual(required_literals("x[abc]yz"), ["x", "yz"])
+        self.assertEqual(required_literals("\\.com$"), [".com"])
+        self.assertEqual(required_literals("abc{2}de"), ["ab", "de"])
+        self.assertEqual(required_literals("foo|bar"), [])
+        self.assertEqual(required_literals("(?x)f o o"), [])
+
+    def test_matching_tags_are_distinct(self):
+        self.assertEqual(sorted(self.engine.matching_tags("twit")), ["TWITTER", "TWITTER.COM"])
+        self.assertEqual(self.engine.matching_tags("caf"), ["CAFÉ"])
+        self.assertEqual(self.engine.matching_tags("CAFÉ"), ["CAFÉ"])
+
+    def test_same_matches_as_scan(self):
+        for patterns in (["twit"], ["pass", "site"], ["^pin$"], ["\\.com"], ["mail|bank"], ["a.n"], ["unknown"], ["pass1"]):
+            matcher = patterns_matcher(patterns)
+            expected = [i for i, keyring in enumerate(self.bdd) if matcher(keyring)]
+            self.assertEqual(self.engine.search(patterns), expected)
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import shards
+from skrm.vault import Vault, Match, KeyringNotFound, BackupError
+from skrm.keyring_manager import KeyringManager
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+
+@mock.patch('skrm.vault.Vault._save_raw_bdd', side_effect=fake_save_raw_bdd, autospec=True)
+@mock.patch('skrm.vault.Vault.load_raw_bdd', side_effect=fake_load_raw_bdd, autospec=True)
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+        self.shard_dir = os.path.join(self.tmp_dir, "shards")
+        self.bdd = [[b"prod", b"db", b"pass0"],
+                    [b"dev", b"db", b"pass1"],
+                    [b"Prod", b"web", b"pass2"],
+                    [b"misc", b"pass3"],
+                    [b"dev", b"web", b"pass4"]]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _create(self):
+        vault = Vault(self.bdd_filename)
+        vault.shard_tags = ["prod", "dev"]
+        vault.shard_count = 2
+        return shards.create(vault, self.shard_dir, self.bdd)
+
+    @staticmethod
+    def _loaded_files(mocked_load):
+        return sorted(os.path.basename(call[0][1]) for call in mocked_load.call_args_list)
+
+    def test_create(self, mocked_load, mocked_save):
+        shard_set = self._create()
+        self.assertEqual(len(shard_set.shard_names()), 3)
+        self.assertEqual(shards.list_files(self.shard_dir)[0], os.path.join(self.shard_dir, shards.MANIFEST))
+        bdd = Vault(self.shard_dir).open().bdd
+        self.assertEqual(sorted(bdd), sorted(self.bdd))
+        with self.assertRaises(IOError):
+            self._create()
+
+    def test_routed_lookups(self, mocked_load, mocked_save):
+        self._create()
+        all_ids = dict((tuple(keyring), i) for i, keyring in enumerate(Vault(self.shard_dir).open().bdd))
+        mocked_load.reset_mock()
+        vault = Vault(self.shard_dir)
+        matches = vault.get(["PROD"])
+        self.assertEqual([m.key for m in matches], [b"pass0", b"pass2"])
+        self.assertEqual([m.id for m in matches], [all_ids[tuple(m.keyring)] for m in matches])
+        self.assertEqual(self._loaded_files(mocked_load), ["manifest.gpg", "tag-000.gpg"])
+
+        self.assertEqual(vault.get(["prod", "dev"]), [])
+        self.assertEqual([m.key for m in vault.search(["^we"])], [b"pass2", b"pass4"])
+        self.assertEqual([m.key for m in vault.search(["^we"], limit=1)], [b"pass2"])
+        self.assertEqual(vault.by_id(all_ids[(b"misc", b"pass3")]), Match(all_ids[(b"misc", b"pass3")], [b"misc", b"pass3"]))
+        with self.assertRaises(KeyringNotFound):
+            vault.by_id(5)
+        self.assertIsNone(vault.bdd)
+
+    def test_writes_touch_only_their_shard(self, mocked_load, mocked_save):
+        self._create()
+        mocked_save.reset_mock()
+        with Vault(self.shard_dir) as vault:
+            vault.update(vault.get(["dev", "web"])[0].id, "new4")
+        self.assertEqual([os.path.basename(call[0][2]) for call in mocked_save.call_args_list], ["tag-001.gpg"])
+
+        mocked_save.reset_mock()
+        with Vault(self.shard_dir) as vault:
+            keyId = vault.add(["dev", "cache"], "pass5")
+            self.assertEqual(vault.bdd[keyId], [b"dev", b"cache", b"pass5"])
+            vault.remove(vault.get(["misc"])[0].id)
+        saved = sorted(os.path.basename(call[0][2]) for call in mocked_save.call_args_list)
+        self.assertEqual(saved, ["manifest.gpg", "tag-001.gpg"])
+
+        vault = Vault(self.shard_dir)
+        self.assertEqual([m.key for m in vault.get(["dev"])], [b"pass1", b"new4", b"pass5"])
+        self.assertEqual(vault.get(["misc"]), [])
+        self.assertEqual(len(shards.list_files(self.shard_dir)), 3) # the emptied hash shard is removed
+
+    def test_add_renumbers_following_shards(self, mocked_load, mocked_save):
+        self._create()
+        before = list(Vault(self.shard_dir).open().bdd)
+        with Vault(self.shard_dir) as vault:
+            keyId = vault.add(["prod", "cache"], "pass5")
+        self.assertEqual(keyId, max(i for i, keyring in enumerate(before) if keyring[0].lower() == b"prod") + 1)
+        self.assertLess(keyId, len(before)) # the dev shard follows
+        vault = Vault(self.shard_dir)
+        self.assertEqual(vault.by_id(keyId).keyring, [b"prod", b"cache", b"pass5"])
+        for i, keyring in enumerate(before):
+            self.assertEqual(vault.by_id(i if i < keyId else i + 1).keyring, keyring)
+
+    def test_auto_backup_rejected(self, mocked_load, mocked_save):
+        self._create()
+        mocked_save.reset_mock()
+        vault = Vault(self.shard_dir)
+        vault.auto_backup = True
+        vault.backup_location = os.path.join(self.tmp_dir, "backup.gpg")
+        with self.assertRaises(BackupError):
+            with vault:
+                vault.add(["dev", "cache"], "pass5")
+        with self.assertRaises(BackupError):
+            vault.save_bdd(self.bdd)
+        self.assertEqual(mocked_save.call_count, 0)
+
+    def test_command_shard(self, mocked_load, mocked_save):
+        KeyringManager("", self.bdd_filename, []).save_bdd(self.bdd)
+        with open(os.path.join(self.tmp_dir, "user.prefs"), "w") as f:
+            f.write("shard_tags=prod,dev\n")
+        KeyringManager(os.path.join(self.tmp_dir, "user.prefs"), self.bdd_filename, ["--shard=" + self.shard_dir]).run()
+        self.assertEqual(len(shards.list_files(self.shard_dir)), 4)
+        self.assertEqual(len(KeyringManager("", self.shard_dir, []).load_bdd()), 5)
@@ -0,0 +1,48 @@
+import unittest
+
+from skrm.tag_index import TagIndex, fold_tag, intersect, tags_matcher
+
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.bdd = [[b"Password", b"WebSite", b"Twitter", b"pass1"],
+                    [b"Password", b"twitter", b"Twitter", b"pass2"],
+                    [b"Pin", b"Bank", b"1234"],
+                    [b"password"]]
+        self.index = TagIndex(self.bdd)
+
+    def test_fold_tag(self):
+        self.assertEqual(fold_tag(b"Twitter"), fold_tag("TWITTER"))
+        self.assertEqual(fold_tag("café"), fold_tag("CAFÉ".encode("utf8")))
+
+    def test_keys_are_not_indexed(self):
+        self.assertEqual(self.index.get(["pass1"]), [])
+        self.assertEqual(self.index.get(["1234"]), [])
+        self.assertEqual(self.index.get(["password"]), [0, 1])
+
+    def test_ids_are_unique_and_sorted(self):
+        self.assertEqual(self.index.ids_for_tag("TWITTER"), [0, 1])
+        self.assertEqual(self.index.get(["twitter", "Password"]), [0, 1])
+        self.assertEqual(self.index.get(["twitter", "website"]), [0])
+        self.assertEqual(self.index.get(["twitter", "bank"]), [])
+        self.assertEqual(self.index.get([]), [0, 1, 2, 3])
+
+    def test_insert_and_remove(self):
+        keyring = [b"Bank", b"Mail", b"bank", b"pass3"]
+        self.assertEqual(self.index.insert(1, keyring[:-1]), ["MAIL"])
+        bdd = self.bdd[:1] + [keyring] + self.bdd[1:]
+        self.assertEqual(self.index.ids, TagIndex(bdd).ids)
+        self.assertEqual(self.index.size, 5)
+        self.assertEqual(self.index.remove(3, bdd[3][:-1]), ["PIN"])
+        del bdd[3]
+        self.assertEqual(self.index.ids, TagIndex(bdd).ids)
+        self.assertEqual(self.index.get([]), [0, 1, 2, 3])
+
+    def test_intersect(self):
+        self.assertEqual(intersect([[1, 3, 5, 7], [3, 7], [0, 3, 4, 7, 9]]), [3, 7])
+        self.assertEqual(intersect([[1, 2], []]), [])
+
+    def test_same_matches_as_scan(self):
+        for tags in (["twitter"], ["password", "website"], ["pin"], ["PIN", "bank"], ["unknown"], ["pass2"]):
+            matcher = tags_matcher(tags)
+            self.assertEqual(self.index.get(tags), [i for i, keyring in enumerate(self.bdd) if matcher(keyring)])
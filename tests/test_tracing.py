@@ -0,0 +1,66 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import mock
+
+from skrm import tracing
+from skrm.keyring_manager import KeyringManager
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_null_tracer(self):
+        with mock.patch.dict(os.environ, clear=True):
+            tracer = tracing.create_tracer(False)
+        self.assertIs(tracer, tracing.NULL_TRACER)
+        with tracer.span("phase", records=1) as span:
+            span.set(bytes=2)
+        tracer.finish()
+
+    def test_spans(self):
+        trace_file = os.path.join(self.tmp_dir, "trace.jsonl")
+        output = io.StringIO()
+        tracer = tracing.Tracer(summary=True, trace_file=trace_file, output=output)
+        with tracer.span("run", command="get"):
+            with tracer.span("load") as span:
+                span.set(records=3)
+            with self.assertRaises(KeyError):
+                with tracer.span("match"):
+                    raise KeyError("tag")
+        tracer.finish()
+
+        self.assertIn("  load", output.getvalue())
+        with open(trace_file) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual([span["name"] for span in spans], ["run", "load", "match"])
+        self.assertEqual(spans[1]["parent"], "run")
+        self.assertEqual(spans[1]["records"], 3)
+        self.assertEqual(spans[2]["error"], "KeyError")
+        self.assertEqual(len(set(span["trace_id"] for span in spans)), 1)
+        for span in spans:
+            self.assertGreaterEqual(span["wall"], 0)
+
+    @mock.patch('skrm.keyring_manager.KeyringManager.load_raw_bdd', fake_load_raw_bdd)
+    @mock.patch('skrm.keyring_manager.KeyringManager._save_raw_bdd', fake_save_raw_bdd)
+    def test_command_timings(self):
+        bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+        trace_file = os.path.join(self.tmp_dir, "trace.jsonl")
+        with mock.patch.dict(os.environ, {"SKRM_TRACE": trace_file}):
+            KeyringManager("", bdd_filename, ["--add=pass", "tag1"]).run()
+            with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+                KeyringManager("", bdd_filename, ["--timings", "--no-agent", "tag1"]).run()
+        self.assertIn("parse_raw", stderr.getvalue())
+        with open(trace_file) as f:
+            names = [json.loads(line)["name"] for line in f]
+        self.assertEqual(names.count("run"), 2)
+        self.assertIn("save", names)
+        self.assertIn("match", names)
@@ -0,0 +1,151 @@
+import os
+import shutil
+import multiprocessing
+import tempfile
+import unittest
+import mock
+
+from skrm.vault import Vault, Match, KeyringNotFound, DecryptError, CorruptedBddError, ConflictError
+from tests.fake_gpg import fake_load_raw_bdd, fake_save_raw_bdd, fake_decrypt_chunks
+
+
+@mock.patch('skrm.vault.Vault._save_raw_bdd', side_effect=fake_save_raw_bdd, autospec=True)
+@mock.patch('skrm.vault.Vault.load_raw_bdd', side_effect=fake_load_raw_bdd, autospec=True)
+class TestVault(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bdd_filename = os.path.join(self.tmp_dir, "bdd.gpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _fill(self):
+        with Vault(self.bdd_filename) as vault:
+            vault.add(["Password", "WebSite", "Twitter"], "pass1")
+            vault.add(["Pin", "Bank"], "1234")
+            vault.add(["Password", "Bank"], b"pass2")
+
+    def test_decrypts_once_and_encrypts_once(self, mocked_load, mocked_save):
+        self._fill()
+        self.assertEqual(mocked_save.call_count, 1)
+        mocked_load.reset_mock()
+        with Vault(self.bdd_filename) as vault:
+            self.assertEqual(vault.get(["password"]), [(0, [b"Password", b"WebSite", b"Twitter", b"pass1"]),
+                                                       (2, [b"Password", b"Bank", b"pass2"])])
+            self.assertEqual([m.id for m in vault.search(["^bank$"])], [1, 2])
+            self.assertEqual([[m.id for m in matches] for matches in vault.get_many([["bank"], ["twitter"], ["nope"]])],
+                             [[1, 2], [0], []])
+            self.assertEqual(vault.get(["twitter"])[0].key, b"pass1")
+            self.assertEqual(vault.by_id(1), Match(1, [b"Pin", b"Bank", b"1234"]))
+            self.assertEqual(vault.by_id(1).tags, [b"Pin", b"Bank"])
+            self.assertEqual([m.id for m in vault.fuzzy(["pasword", "bnk"])], [2, 0, 1])
+            self.assertEqual([m.id for m in vault.fuzzy(["twiter"], limit=1)], [0])
+        self.assertEqual(mocked_load.call_count, 1)
+        self.assertEqual(mocked_save.call_count, 1) # nothing to commit
+
+    def test_mutations(self, mocked_load, mocked_save):
+        self._fill()
+        with Vault(self.bdd_filename) as vault:
+            vault.get(["bank"])
+            vault.update(1, "4321")
+            self.assertEqual(vault.remove(0), [b"Password", b"WebSite", b"Twitter", b"pass1"])
+            self.assertEqual([m.id for m in vault.get(["bank"])], [0, 1]) # the index follows mutations
+            with self.assertRaises(KeyringNotFound):
+                vault.update(2, "new")
+        with Vault(self.bdd_filename) as vault:
+            self.assertEqual(vault.bdd, [[b"Pin", b"Bank", b"4321"], [b"Password", b"Bank", b"pass2"]])
+
+    def test_exception_discards_mutations(self, mocked_load, mocked_save):
+        self._fill()
+        with self.assertRaises(KeyringNotFound):
+            with Vault(self.bdd_filename) as vault:
+                vault.add(["tag"], "pass")
+                vault.remove(10)
+        self.assertEqual(mocked_save.call_count, 1)
+        self.assertEqual(len(Vault(self.bdd_filename).open().bdd), 3)
+
+    @mock.patch('skrm.vault.Vault._decrypt_chunks', fake_decrypt_chunks)
+    def test_streamed_lookups(self, mocked_load, mocked_save):
+        self._fill()
+        mocked_load.reset_mock()
+        vault = Vault(self.bdd_filename)
+        self.assertEqual(vault.by_id(1), Match(1, [b"Pin", b"Bank", b"1234"]))
+        self.assertEqual(vault.get(["bank"], limit=1), [Match(1, [b"Pin", b"Bank", b"1234"])])
+        self.assertEqual([m.id for m in vault.search(["^pass", "b.nk"], limit=5)], [2])
+        with self.assertRaises(KeyringNotFound):
+            vault.by_id(3)
+        self.assertEqual(mocked_load.call_count, 0)
+        self.assertIsNone(vault.bdd)
+        vault.open()
+        self.assertEqual([m.id for m in vault.get(["password"], limit=1)], [0])
+
+    def test_concurrent_writes_are_rebased(self, mocked_load, mocked_save):
+        self._fill()
+        first = Vault(self.bdd_filename).open()
+        second = Vault(self.bdd_filename).open()
+        second.remove(0)
+        second.commit()
+        first.update(2, "new2")
+        first.add(["Email"], "pass3")
+        first.update(3, "new3")
+        first.commit()
+        self.assertEqual(Vault(self.bdd_filename).open().bdd, [[b"Pin", b"Bank", b"1234"],
+                                                               [b"Password", b"Bank", b"new2"],
+                                                               [b"Email", b"new3"]])
+        third = Vault(self.bdd_filename).open()
+        first.remove(0)
+        first.commit()
+        third.update(0, "4321")
+        with self.assertRaises(ConflictError):
+            third.commit()
+
+    def test_parallel_processes(self, mocked_load, mocked_save):
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=_add_keyrings, args=(self.bdd_filename, n)) for n in range(6)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        bdd = Vault(self.bdd_filename).open().bdd
+        self.assertEqual(sorted(keyring[-1] for keyring in bdd), sorted(b"pass%d-%d" % (n, i) for n in range(6) for i in range(5)))
+
+    def test_errors(self, mocked_load, mocked_save):
+        with open(self.bdd_filename, "wb") as f:
+            f.write(b"\x00SKRM\x02")
+        with self.assertRaises(CorruptedBddError):
+            Vault(self.bdd_filename).open()
+
+    def test_from_prefs(self, mocked_load, mocked_save):
+        prefs = os.path.join(self.tmp_dir, "user.prefs")
+        with open(prefs, "w") as f:
+            f.write("# comment\nfile=" + self.bdd_filename + "\nrecipient=me=myself\nchangelog=True\nunknown\n")
+        vault = Vault.from_prefs(prefs, changelog=False)
+        self.assertEqual(vault.filename, self.bdd_filename)
+        self.assertEqual(vault.recipient, "me=myself")
+        self.assertFalse(vault.changelog)
+
+
+def _add_keyrings(filename, n):
+    for i in range(5):
+        with Vault(filename) as vault:
+            vault.add(["process%d" % n], "pass%d-%d" % (n, i))
+
+
+class TestVaultGpg(unittest.TestCase):
+    def test_decrypt_error(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "bdd.gpg")
+            with open(filename, "wb") as f:
+                f.write(b"not a gpg file")
+            with self.assertRaises(DecryptError):
+                Vault(filename).open()
+            self.assertEqual(Vault(os.path.join(tmp_dir, "missing.gpg")).open().bdd, [])
+
+            os.remove(filename)
+            with Vault(filename, recipient="Poncin Matthieu") as vault:
+                vault.add(["tag"], "pass")
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["bdd.gpg", "bdd.gpg.lock"]) # replaced by a rename
+            self.assertEqual(Vault(filename).open().bdd, [[b"tag", b"pass"]])
+        finally:
+            shutil.rmtree(tmp_dir)